@@ -0,0 +1 @@
+Add ``background_delete`` option.  Old blob backups and a replaced blobstorage are renamed into a ``.trash`` directory and removed by a background process with low priority, so the backup and restore commands do not wait for this.
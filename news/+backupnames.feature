@@ -0,0 +1 @@
+Parse the names of blob backups with one compiled regular expression, and group incremental archives in one pass, which makes finding and removing old backups much faster with many backups.
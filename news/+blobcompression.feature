@@ -0,0 +1,3 @@
+Add option ``blob_compression`` to compress blob archives with another codec than gzip, for example ``blob_compression = zstd:3``.
+Supported are ``gzip``, ``bz2``, ``xz``, and with the optional ``zstandard`` and ``lz4`` packages also ``zstd`` and ``lz4``.
+Restoring detects the codec from the archive suffix.
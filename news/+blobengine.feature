@@ -0,0 +1 @@
+Add ``blob_engine`` option.  With ``blob_engine = native`` we create the hard linked blob backups in Python instead of calling ``rsync``.
@@ -0,0 +1,2 @@
+Add option ``blob_index`` to write an index next to each blob archive, and add ``bin/restore --blob-path`` to restore only a part of the blobstorage.
+With an index, a single blob is extracted without decompressing the complete archive.
@@ -0,0 +1 @@
+With ``immutable_blobs``, native blob backups store a compact binary list of the blob files, which ``restore_mode = diff`` uses to compare the blobstorage with the backup.
@@ -0,0 +1 @@
+Added ``backup_catalog`` option: keep a catalog of the backups in each backup location, so we do not need to list the location and check each file several times per run.  Rebuild it with ``bin/backup --rebuild-catalog``.
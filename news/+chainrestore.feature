@@ -0,0 +1,2 @@
+Restore a chain of native incremental blob archives in one pass.
+Each file is extracted once, from the archive that has it, using ``copy_workers`` threads across archives.
@@ -0,0 +1 @@
+Add ``compress_workers`` and ``compress_level`` options, to compress blob archives with several threads at the same time.
@@ -0,0 +1 @@
+Add ``copy_workers`` option.  With ``use_rsync = false``, blob backups and restores can now copy files with several threads.
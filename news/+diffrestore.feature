@@ -0,0 +1 @@
+Added ``restore_mode = diff``: only restore the blob files that are missing, and remove the files that are not in the backup.
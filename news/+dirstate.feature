@@ -0,0 +1 @@
+With ``immutable_blobs``, remember the directory listings of the blob storage in the backup, and skip listing directories that have not changed since the previous backup.
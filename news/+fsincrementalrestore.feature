@@ -0,0 +1 @@
+With ``filestorage_engine = native``, a restore onto a ``Data.fs`` that was restored before from the same backups only appends the newer incremental backups.  This makes regular restores on a standby server much faster.
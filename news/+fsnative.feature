@@ -0,0 +1 @@
+Added ``filestorage_engine`` option.  With ``native`` we make full filestorage backups ourselves, compressing the ``Data.fs`` with ``compress_workers`` threads, in the same format as ``repozo``.
@@ -0,0 +1 @@
+With ``filestorage_engine = native``, restore the ``Data.fs`` without ``repozo``: all backup files of the chain are decompressed in parallel into their own part of a preallocated file, and their md5 checksums from the ``.dat`` file are checked in the same pass.
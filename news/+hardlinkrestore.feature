@@ -0,0 +1,2 @@
+Add option ``restore_mode``.  With ``restore_mode = hardlink``, restoring a blob backup directory hard links its files into place, when the backup is on the same file system.
+Otherwise we copy as usual.
@@ -0,0 +1 @@
+Add ``immutable_blobs`` option.  With the native blob engine, blob files that are already in the previous backup are hard linked without comparing them.
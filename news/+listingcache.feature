@@ -0,0 +1 @@
+Remember the listings of backup locations during one run of a script, so finding the backups to restore or remove lists and stats each location only once.
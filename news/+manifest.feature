@@ -0,0 +1,2 @@
+With ``blob_engine = native`` and ``incremental_blobs = true``, make incremental blob archives without GNU tar.
+Each archive gets a manifest, and a delta archive only has the new files plus a list of removed files.
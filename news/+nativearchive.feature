@@ -0,0 +1 @@
+With ``blob_engine = native`` and ``archive_blob = true``, write the blob archive in Python with the ``tarfile`` module, instead of calling ``tar``.
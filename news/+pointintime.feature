@@ -0,0 +1 @@
+Find the backups for a point in time restore with a binary search in a sorted index of the backups, for blobs and for the filestorage.
@@ -0,0 +1 @@
+Added ``repozo_in_process`` option: call the repozo functions of ZODB in the backup and restore scripts, instead of starting ``bin/repozo``.
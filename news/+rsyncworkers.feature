@@ -0,0 +1 @@
+Add ``rsync_workers`` option.  With a value higher than 1, the blobstorage is split in parts by directory, and each part is backed up or restored with its own ``rsync`` process, running several at the same time.
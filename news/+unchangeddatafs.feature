@@ -0,0 +1 @@
+Do not call repozo from ``bin/backup`` when the Data.fs has not changed since the last backup, according to the ``.dat`` file of that backup.
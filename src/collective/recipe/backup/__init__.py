@@ -1,5 +1,6 @@
 """Recipe backup"""
 
+from collective.recipe.backup import compression
 from collective.recipe.backup import utils
 
 import logging
@@ -13,6 +14,11 @@ logger = logging.getLogger("backup")
 
 # Standard storage key for Data.fs.
 STORAGE_KEY = "1"
+# Supported engines for blob backups to directories.
+BLOB_ENGINES = ("rsync", "native")
+FILESTORAGE_ENGINES = ("repozo", "native")
+# Supported ways of restoring blob backups.
+RESTORE_MODES = ("copy", "hardlink", "diff")
 
 
 class Recipe:
@@ -136,20 +142,33 @@ class Recipe:
                 )
 
         options.setdefault("archive_blob", "false")
+        options.setdefault("background_delete", "false")
+        options.setdefault("backup_catalog", "false")
+        options.setdefault("blob_compression", "")
+        options.setdefault("blob_engine", "rsync")
+        options.setdefault("blob_index", "false")
         options.setdefault("blob_timestamps", "true")
         options.setdefault("compress_blob", "false")
+        options.setdefault("compress_level", "6")
+        options.setdefault("compress_workers", "1")
+        options.setdefault("copy_workers", "1")
         options.setdefault("datafs", datafs)
         options.setdefault("debug", "false")
         options.setdefault("enable_snapshotrestore", "true")
         options.setdefault("enable_zipbackup", "false")
+        options.setdefault("filestorage_engine", "repozo")
         options.setdefault("full", "false")
+        options.setdefault("immutable_blobs", "false")
         options.setdefault("incremental_blobs", "false")
         options.setdefault("keep", "2")
         options.setdefault("keep_blob_days", "14")  # two weeks
         options.setdefault("only_blobs", "false")
         options.setdefault("post_command", "")
         options.setdefault("pre_command", "")
+        options.setdefault("repozo_in_process", "false")
+        options.setdefault("restore_mode", "copy")
         options.setdefault("rsync_options", "")
+        options.setdefault("rsync_workers", "1")
         options.setdefault("use_rsync", "true")
         options.setdefault("rsync_hard_links_on_first_copy", "false")
 
@@ -383,6 +402,12 @@ parser.add_option('-q', '--quiet',
 parser.add_option('-n', '--no-prompt',
                   action='store_true', dest='no_prompt', default=False,
                   help='do not ask for any user confirmation')
+parser.add_option('--blob-path',
+                  action='append', dest='blob_paths', default=None,
+                  help='restore only this path in the blobstorage')
+parser.add_option('--rebuild-catalog',
+                  action='store_true', dest='rebuild_catalog', default=False,
+                  help='rebuild the catalogs of the backup locations')
 (options, args) = parser.parse_args()
 # storage = options.storage
 # Allow the user to make the script more quiet (say in a cronjob):
@@ -413,6 +438,21 @@ logging.basicConfig(level=loglevel,
         blob_timestamps={blob_timestamps},
         incremental_blobs={incremental_blobs},
         rsync_hard_links_on_first_copy={rsync_hard_links_on_first_copy},
+        blob_engine={blob_engine!r},
+        filestorage_engine={filestorage_engine!r},
+        immutable_blobs={immutable_blobs},
+        copy_workers={copy_workers},
+        background_delete={background_delete},
+        rsync_workers={rsync_workers},
+        compress_workers={compress_workers},
+        compress_level={compress_level},
+        blob_compression={blob_compression!r},
+        blob_index={blob_index},
+        blob_paths=options.blob_paths,
+        restore_mode={restore_mode!r},
+        backup_catalog={backup_catalog},
+        repozo_in_process={repozo_in_process},
+        rebuild_catalog=options.rebuild_catalog,
         """
         # Work with a copy of the options, for safety.
         opts = self.options.copy()
@@ -553,6 +593,11 @@ logging.basicConfig(level=loglevel,
                 "blob_timestamps",
                 "incremental_blobs",
                 "rsync_hard_links_on_first_copy",
+                "immutable_blobs",
+                "background_delete",
+                "blob_index",
+                "backup_catalog",
+                "repozo_in_process",
             ],
         )
 
@@ -585,6 +630,55 @@ logging.basicConfig(level=loglevel,
                     "Cannot have backup_blobs false and enable_zipbackup "
                     "true. zipbackup is useless without blobs."
                 )
+        for key in ("copy_workers", "rsync_workers", "compress_workers"):
+            try:
+                workers = int(options.get(key, "1"))
+            except ValueError:
+                workers = 0
+            if workers < 1:
+                raise zc.buildout.UserError(
+                    "{} must be a positive integer, "
+                    "not {!r}.".format(key, options.get(key))
+                )
+        compress_level = options.get("compress_level", "6")
+        if compress_level not in [str(level) for level in range(10)]:
+            raise zc.buildout.UserError(
+                "compress_level must be a number from 0 to 9, "
+                "not {!r}.".format(compress_level)
+            )
+        try:
+            codec, level = compression.parse_compression(
+                options.get("blob_compression")
+            )
+        except ValueError as e:
+            raise zc.buildout.UserError(f"blob_compression: {e}")
+        if codec is not None and not codec.is_available():
+            raise zc.buildout.UserError(
+                "blob_compression {} needs the {} package.".format(
+                    codec.name, codec.module
+                )
+            )
+        blob_engine = options.get("blob_engine", "rsync")
+        if blob_engine not in BLOB_ENGINES:
+            raise zc.buildout.UserError(
+                "Unknown blob_engine {!r}. Choose from: {}.".format(
+                    blob_engine, ", ".join(BLOB_ENGINES)
+                )
+            )
+        filestorage_engine = options.get("filestorage_engine", "repozo")
+        if filestorage_engine not in FILESTORAGE_ENGINES:
+            raise zc.buildout.UserError(
+                "Unknown filestorage_engine {!r}. Choose from: {}.".format(
+                    filestorage_engine, ", ".join(FILESTORAGE_ENGINES)
+                )
+            )
+        restore_mode = options.get("restore_mode", "copy")
+        if restore_mode not in RESTORE_MODES:
+            raise zc.buildout.UserError(
+                "Unknown restore_mode {!r}. Choose from: {}.".format(
+                    restore_mode, ", ".join(RESTORE_MODES)
+                )
+            )
         if not to_bool(options.get("blob_timestamps", True)):
             # blob_timestamps was explicitly set to false
             if to_bool(options.get("incremental_blobs")):
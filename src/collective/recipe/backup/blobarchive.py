@@ -0,0 +1,779 @@
+"""Write blob archives in Python, without calling tar.
+
+This is the in-process alternative for 'tar cf' and 'tar czf'.
+The archive has the same members as 'tar cf archive -C source .',
+so it can be restored with tar, or with tarfile.
+
+Files are read ahead by a pool of threads, and compression is done in
+separate threads, so reading, archiving and compressing overlap.
+The codecs for compressing are in the compression module.
+
+An archive can get an index next to it: archive.tar.gz.idx.  This has
+the offset and size of each file in the uncompressed tar stream.
+Compressed archives with an index are written in separately compressed
+blocks, and the index has the compressed offset of each block.  So we
+can extract a single file by decompressing only the blocks that it is in.
+The index also has the size and modification time of the archive, and
+is only used when these are still the same.
+"""
+
+from collections import deque
+from collective.recipe.backup import compression
+from concurrent import futures
+
+import gzip
+import io
+import logging
+import os
+import queue
+import subprocess
+import tarfile
+import threading
+
+logger = logging.getLogger("blobs")
+# Files up to this size are read ahead in the thread pool.
+# Larger files are read while writing them to the archive.
+PREFETCH_MAX_SIZE = 4 * 1024 * 1024
+# Number of files that are read ahead per worker.
+PREFETCH_PER_WORKER = 16
+# Size of the chunks that are passed to the compressor thread.
+WRITE_CHUNK_SIZE = 1024 * 1024
+# Number of chunks that may wait for the compressor thread.
+WRITE_QUEUE_SIZE = 16
+TMP_SUFFIX = ".tmp"
+# Chunk size for reading the output of a command.
+READ_CHUNK_SIZE = 256 * 1024
+INDEX_SUFFIX = ".idx"
+INDEX_HEADER = "collective.recipe.backup archive index 2"
+# Only use the index when we want at most one in this many files.
+# Otherwise reading through the archive is faster.
+INDEX_MAX_FRACTION = 8
+
+
+class ArchiveStats:
+    """Statistics of writing an archive."""
+
+    __slots__ = ("dirs", "files", "symlinks", "bytes_read", "bytes_written", "missing")
+
+    def __init__(self):
+        self.missing = []
+        self.dirs = 0
+        self.files = 0
+        self.symlinks = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def __repr__(self):
+        return (
+            "<ArchiveStats dirs={} files={} symlinks={} bytes_read={} "
+            "bytes_written={}>".format(
+                self.dirs,
+                self.files,
+                self.symlinks,
+                self.bytes_read,
+                self.bytes_written,
+            )
+        )
+
+
+class CountingWriter:
+    """File-like object that counts the bytes written to it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.count += len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+class ThreadedWriter:
+    """File-like object that writes in a separate thread.
+
+    tarfile writes to us.  We pass the data in chunks to a thread that
+    writes it to the real file, usually a gzip file.  zlib releases the
+    GIL, so compressing overlaps with reading and archiving.
+    """
+
+    def __init__(self, fileobj, chunk_size=WRITE_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def _work(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            if self.error is not None:
+                # Keep emptying the queue, so write does not block.
+                continue
+            try:
+                self.fileobj.write(data)
+            except Exception as e:
+                self.error = e
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, data):
+        self._check()
+        self.buffer.append(bytes(data))
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self._send()
+
+    def _send(self):
+        if self.buffer:
+            self.queue.put(b"".join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        """Write what is left, and wait for the thread."""
+        self._send()
+        self.stop()
+        self._check()
+
+    def stop(self):
+        """Stop the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+
+class ArchiveIndex:
+    """Index of the files in an archive.
+
+    members maps the path of each regular file, without leading './', to
+    a tuple of offset, size, mtime and mode.  The offset is the start of the
+    file data in the uncompressed tar stream.  For compressed archives,
+    offsets has the compressed offset of each block of block_size
+    uncompressed bytes.
+    """
+
+    __slots__ = (
+        "archive_size",
+        "archive_mtime_ns",
+        "codec",
+        "block_size",
+        "offsets",
+        "members",
+    )
+
+    def __init__(self, codec=None, block_size=0, offsets=None, members=None):
+        self.archive_size = 0
+        self.archive_mtime_ns = 0
+        self.codec = codec
+        self.block_size = block_size
+        self.offsets = offsets or []
+        self.members = members if members is not None else {}
+
+    def __repr__(self):
+        return "<ArchiveIndex codec={} members={} blocks={}>".format(
+            self.codec.name if self.codec is not None else None,
+            len(self.members),
+            len(self.offsets),
+        )
+
+
+def get_index_path(archive):
+    return archive + INDEX_SUFFIX
+
+
+def normalize_member_path(name):
+    """Return the path of a tar member without leading './' or '/'."""
+    while name.startswith("./"):
+        name = name[2:]
+    return name.strip("/")
+
+
+def padded_size(size):
+    """Size of file data in a tar stream, which uses blocks of 512 bytes."""
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def write_index(archive, index):
+    """Write the index of an archive next to it.
+
+    Call this when the archive is complete: we store its size and
+    modification time.
+    """
+    stat = os.stat(archive)
+    path = get_index_path(archive)
+    tmp_path = path + TMP_SUFFIX
+    with gzip.open(
+        tmp_path, "wt", encoding="utf-8", errors="surrogateescape", compresslevel=1
+    ) as f:
+        f.write(INDEX_HEADER + "\n")
+        f.write(f"archive {stat.st_size} {stat.st_mtime_ns}\n")
+        codec_name = index.codec.name if index.codec is not None else "none"
+        f.write(f"codec {codec_name} {index.block_size}\n")
+        for offset in index.offsets:
+            f.write(f"b {offset}\n")
+        for name, (offset, size, mtime, mode) in index.members.items():
+            f.write(f"m {offset} {size} {mtime} {mode} {name}\n")
+    os.rename(tmp_path, path)
+
+
+def read_index(archive):
+    """Read the index of an archive.
+
+    Returns an ArchiveIndex, or None when the index is missing, unreadable,
+    or does not belong to the archive as it is now.
+    """
+    path = get_index_path(archive)
+    if not os.path.isfile(path):
+        return
+    index = ArchiveIndex()
+    try:
+        with gzip.open(path, "rt", encoding="utf-8", errors="surrogateescape") as f:
+            header = f.readline().rstrip("\n")
+            if header != INDEX_HEADER:
+                logger.warning("Ignoring %s: unknown format.", path)
+                return
+            for line in f:
+                kind, value = line.rstrip("\n").split(" ", 1)
+                if kind == "m":
+                    offset, size, mtime, mode, name = value.split(" ", 4)
+                    index.members[name] = (
+                        int(offset),
+                        int(size),
+                        int(mtime),
+                        int(mode),
+                    )
+                elif kind == "b":
+                    index.offsets.append(int(value))
+                elif kind == "archive":
+                    size, mtime_ns = value.split(" ")
+                    index.archive_size = int(size)
+                    index.archive_mtime_ns = int(mtime_ns)
+                elif kind == "codec":
+                    name, block_size = value.split(" ")
+                    if name != "none":
+                        index.codec = compression.get_codec(name)
+                    index.block_size = int(block_size)
+    except (OSError, ValueError, TypeError, KeyError, EOFError) as exc:
+        logger.warning("Ignoring %s: %s", path, exc)
+        return
+    stat = os.stat(archive)
+    if stat.st_size != index.archive_size or stat.st_mtime_ns != index.archive_mtime_ns:
+        logger.warning("Ignoring %s: the archive has changed.", path)
+        return
+    if index.codec is not None and not index.offsets:
+        logger.warning("Ignoring %s: no blocks.", path)
+        return
+    return index
+
+
+def index_tar_archive(archive):
+    """Write an index for an uncompressed tar archive made by tar.
+
+    tarfile only reads the headers, so this is quick.
+    """
+    index = ArchiveIndex()
+    with tarfile.open(archive, "r:") as tar:
+        for info in tar:
+            if info.isreg():
+                index.members[normalize_member_path(info.name)] = (
+                    info.offset_data,
+                    info.size,
+                    int(info.mtime),
+                    info.mode,
+                )
+    write_index(archive, index)
+    return index
+
+
+def list_members(archive):
+    """List the regular files and symbolic links in an archive.
+
+    Returns a dictionary of path to a tuple of size and mtime.
+    With a valid index we do not need to open the archive.  Otherwise we
+    read through it, but only look at the headers.
+    """
+    index = read_index(archive)
+    if index is not None:
+        return {name: (info[1], info[2]) for name, info in index.members.items()}
+    members = {}
+    codec = compression.get_codec_for_path(archive)
+    with open(archive, "rb") as infile:
+        reader = infile
+        if codec is not None:
+            codec.check_available()
+            reader = codec.open_reader(infile)
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=READ_CHUNK_SIZE) as tar:
+            for info in tar:
+                if info.isreg() or info.issym():
+                    members[normalize_member_path(info.name)] = (
+                        info.size,
+                        int(info.mtime),
+                    )
+    return members
+
+
+def read_file(path):
+    with open(path, "rb") as myfile:
+        return myfile.read()
+
+
+def iter_tree(source):
+    """Yield (path, arcname) for source and everything in it.
+
+    The order is like GNU tar: a directory first, then its contents,
+    sorted by name, so archives of the same tree are the same.
+    Symbolic links are not followed.
+    """
+    stack = [(source, ".")]
+    while stack:
+        path, arcname = stack.pop()
+        yield path, arcname
+        if os.path.islink(path) or not os.path.isdir(path):
+            continue
+        names = sorted(os.listdir(path), reverse=True)
+        for name in names:
+            stack.append((os.path.join(path, name), arcname + "/" + name))
+
+
+def iter_paths(source, paths):
+    """Yield (path, arcname) for the given relative paths in source.
+
+    This is for delta archives, which only have some files.
+    """
+    for rel in sorted(paths):
+        yield os.path.join(source, *rel.split("/")), "./" + rel
+
+
+def open_compressor(
+    fileobj, codec=None, compresslevel=None, compress_workers=1, blocks=False
+):
+    """Open a compressing writer, or return None when not compressing.
+
+    With blocks=True, the data is compressed in separate blocks,
+    so we can make an index.
+    """
+    if codec is None:
+        return None
+    codec.check_available()
+    if blocks:
+        return codec.open_block_writer(
+            fileobj, level=compresslevel, workers=compress_workers
+        )
+    return codec.open_writer(fileobj, level=compresslevel, workers=compress_workers)
+
+
+def stop_compressor(zfile):
+    """Stop the threads of a compressing writer, if it has them."""
+    stop = getattr(zfile, "stop", None)
+    if stop is not None:
+        stop()
+
+
+def write_archive(
+    source,
+    dest,
+    compress=False,
+    workers=4,
+    compresslevel=None,
+    compress_workers=1,
+    codec=None,
+    index=False,
+    paths=None,
+):
+    """Write a tar archive of the source directory to dest.
+
+    The archive is written to a temporary file first, and renamed to dest
+    when it is complete.  It is compressed with the codec, or with gzip
+    when compress is true and no codec is given.  compresslevel None means
+    the default level of the codec.  With index=True, we write an index
+    next to the archive.
+
+    paths can be a list of paths relative to source: then only these
+    files are archived.  Files that are gone in the meantime are
+    skipped, and listed in the missing attribute of the stats.
+
+    Returns an ArchiveStats object.
+    """
+    if codec is None and compress:
+        codec = compression.get_codec(compression.DEFAULT_CODEC)
+    if os.path.exists(dest):
+        raise Exception(f"Path already exists: {dest}")
+    workers = max(int(workers), 1)
+    stats = ArchiveStats()
+    tmp = dest + TMP_SUFFIX
+    outfile = open(tmp, "wb")
+    zfile = writer = None
+    members = {} if index else None
+    try:
+        counter = CountingWriter(outfile)
+        zfile = open_compressor(
+            counter, codec, compresslevel, compress_workers, blocks=index
+        )
+        writer = ThreadedWriter(zfile if zfile is not None else counter)
+        tar = tarfile.open(fileobj=writer, mode="w|", format=tarfile.GNU_FORMAT)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            max_pending = workers * PREFETCH_PER_WORKER
+            if paths is None:
+                entries = iter_tree(source)
+            else:
+                entries = iter_paths(source, paths)
+            for path, arcname in entries:
+                try:
+                    info = tar.gettarinfo(path, arcname)
+                except FileNotFoundError:
+                    if paths is None:
+                        raise
+                    stats.missing.append(arcname[2:])
+                    continue
+                future = None
+                if info.isreg() and info.size <= PREFETCH_MAX_SIZE:
+                    future = executor.submit(read_file, path)
+                pending.append((path, info, future))
+                if len(pending) >= max_pending:
+                    add_member(tar, *pending.popleft(), stats=stats, members=members)
+            while pending:
+                add_member(tar, *pending.popleft(), stats=stats, members=members)
+        tar.close()
+        writer.close()
+        if zfile is not None:
+            zfile.close()
+        outfile.close()
+        stats.bytes_written = counter.count
+    except BaseException:
+        if writer is not None:
+            writer.stop()
+        stop_compressor(zfile)
+        outfile.close()
+        os.remove(tmp)
+        raise
+    os.rename(tmp, dest)
+    if index:
+        write_index(dest, make_index(codec, zfile, members))
+    return stats
+
+
+def make_index(codec, zfile, members):
+    """Make an ArchiveIndex for members written to a block writer."""
+    if codec is None:
+        return ArchiveIndex(members=members)
+    return ArchiveIndex(
+        codec=codec, block_size=zfile.block_size, offsets=zfile.offsets, members=members
+    )
+
+
+class TeeReader:
+    """File-like object that writes everything that is read to a sink."""
+
+    def __init__(self, fileobj, sink):
+        self.fileobj = fileobj
+        self.sink = sink
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sink.write(data)
+        return data
+
+
+def copy_and_index(fileobj, sink):
+    """Copy a tar stream from fileobj to sink, and index its members.
+
+    Returns a dictionary like ArchiveIndex.members, or None when the
+    stream could not be parsed.  Everything is copied in both cases.
+    """
+    tee = TeeReader(fileobj, sink)
+    members = {}
+    try:
+        tar = tarfile.open(fileobj=tee, mode="r|", bufsize=READ_CHUNK_SIZE)
+        for info in tar:
+            if info.isreg():
+                members[normalize_member_path(info.name)] = (
+                    info.offset_data,
+                    info.size,
+                    int(info.mtime),
+                    info.mode,
+                )
+    except tarfile.TarError as exc:
+        logger.warning("Cannot index archive: %s", exc)
+        members = None
+    # Copy the rest, like the end of archive blocks.
+    for chunk in iter(lambda: tee.read(READ_CHUNK_SIZE), b""):
+        pass
+    return members
+
+
+def compress_command_output(
+    command, dest, workers=2, compresslevel=None, codec=None, index=False
+):
+    """Run a command and write its compressed output to dest.
+
+    This is for 'tar cf - ...', so we can compress with several
+    threads instead of letting tar call a single gzip process,
+    or with a codec that tar does not know.  The default codec is gzip.
+    stderr of the command is not captured.  The output is written to a
+    temporary file first, and only renamed to dest when the command
+    succeeds.  With index=True, we read the tar headers while
+    compressing, and write an index next to the archive.
+
+    Returns the exit code of the command.
+    """
+    if os.path.exists(dest):
+        raise Exception(f"Path already exists: {dest}")
+    if codec is None:
+        codec = compression.get_codec(compression.DEFAULT_CODEC)
+    codec.check_available()
+    tmp = dest + TMP_SUFFIX
+    process = None
+    members = None
+    with open(tmp, "wb") as outfile:
+        zfile = open_compressor(outfile, codec, compresslevel, workers, blocks=index)
+        try:
+            process = subprocess.Popen(
+                command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE
+            )
+            if index:
+                members = copy_and_index(process.stdout, zfile)
+            else:
+                for chunk in iter(lambda: process.stdout.read(READ_CHUNK_SIZE), b""):
+                    zfile.write(chunk)
+            process.stdout.close()
+            returncode = process.wait()
+            if returncode:
+                stop_compressor(zfile)
+            else:
+                zfile.close()
+        except BaseException:
+            stop_compressor(zfile)
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            outfile.close()
+            os.remove(tmp)
+            raise
+    if returncode:
+        os.remove(tmp)
+    else:
+        os.rename(tmp, dest)
+        if members is not None:
+            write_index(dest, make_index(codec, zfile, members))
+    return returncode
+
+
+def decompress_to_command(path, command, codec):
+    """Decompress the archive at path and pipe it into a command.
+
+    This is for 'tar xf - ...' with codecs that tar may not know.
+    Returns the exit code of the command.
+    """
+    codec.check_available()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        with open(path, "rb") as infile:
+            reader = codec.open_reader(infile)
+            for chunk in iter(lambda: reader.read(READ_CHUNK_SIZE), b""):
+                process.stdin.write(chunk)
+            reader.close()
+    except BrokenPipeError:
+        # The command stopped reading.  Its exit code tells why.
+        pass
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    try:
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    return process.wait()
+
+
+def add_member(tar, path, info, future, stats, members=None):
+    """Add one member to the tar file.
+
+    When members is a dictionary, we add the offset, size, mtime and mode
+    of regular files to it.
+    """
+    if info.isdir():
+        stats.dirs += 1
+        tar.addfile(info)
+        return
+    if info.issym():
+        stats.symlinks += 1
+        tar.addfile(info)
+        return
+    if not info.isreg():
+        tar.addfile(info)
+        return
+    if future is not None:
+        data = future.result()
+        if len(data) != info.size:
+            # The file changed in the meantime.  Blob files should not
+            # change, but other files might.  Use what we have read.
+            info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    else:
+        with open(path, "rb") as myfile:
+            tar.addfile(info, myfile)
+    stats.bytes_read += info.size
+    stats.files += 1
+    if members is not None:
+        members[normalize_member_path(info.name)] = (
+            tar.offset - padded_size(info.size),
+            info.size,
+            int(info.mtime),
+            # Like tarfile writes it in the header: without the file type.
+            info.mode & 0o7777,
+        )
+
+
+def matches_paths(name, paths):
+    """Is the member name one of the paths, or inside one of them?"""
+    for path in paths:
+        if name == path or name.startswith(path + "/"):
+            return True
+    return False
+
+
+def iter_index_range(fileobj, index, offset, size):
+    """Yield chunks of the uncompressed data at offset, using the index."""
+    if index.codec is None:
+        fileobj.seek(offset)
+        reader = fileobj
+        skip = 0
+    else:
+        block = offset // index.block_size
+        fileobj.seek(index.offsets[block])
+        reader = index.codec.open_reader(fileobj)
+        skip = offset - block * index.block_size
+    while skip:
+        data = reader.read(min(skip, READ_CHUNK_SIZE))
+        if not data:
+            raise EOFError("Unexpected end of archive.")
+        skip -= len(data)
+    while size:
+        data = reader.read(min(size, READ_CHUNK_SIZE))
+        if not data:
+            raise EOFError("Unexpected end of archive.")
+        size -= len(data)
+        yield data
+
+
+def check_relative_path(path):
+    """Check and normalize a path relative to the blobstorage.
+
+    We strip './' and slashes, and refuse empty paths and '..'.
+    Returns the normalized path, or raises ValueError.
+    """
+    name = normalize_member_path(path.replace(os.sep, "/"))
+    parts = name.split("/")
+    if not name or ".." in parts or "." in parts or "" in parts:
+        raise ValueError(f"Invalid path in blobstorage: {path!r}")
+    return name
+
+
+def write_extracted(destination, name, chunks, mtime, mode=None):
+    """Write chunks to the file name in destination, via a temporary file."""
+    path = os.path.join(destination, *check_relative_path(name).split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + TMP_SUFFIX
+    try:
+        with open(tmp_path, "wb") as outfile:
+            for chunk in chunks:
+                outfile.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.utime(tmp_path, (mtime, mtime))
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    os.rename(tmp_path, path)
+
+
+def write_symlink(destination, name, target):
+    """Create a symbolic link, replacing what is there."""
+    path = os.path.join(destination, *check_relative_path(name).split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.lexists(path):
+        os.remove(path)
+    os.symlink(target, path)
+
+
+def extract_matching(archive, match, destination, max_fraction=None):
+    """Extract the files for which match(name) is true.
+
+    With a valid index, we only read the parts of the archive that we need.
+    Otherwise we read through the archive until the end.  With
+    max_fraction, we only use the index when we want at most one in
+    max_fraction files of the archive.
+
+    Returns a sorted list of the extracted paths.
+    """
+    index = read_index(archive)
+    found = []
+    with open(archive, "rb") as infile:
+        if index is not None:
+            wanted = [
+                (offset, size, mtime, mode, name)
+                for name, (offset, size, mtime, mode) in index.members.items()
+                if match(name)
+            ]
+            if max_fraction is None or len(wanted) * max_fraction <= len(index.members):
+                logger.debug("Using index of %s.", archive)
+                for offset, size, mtime, mode, name in sorted(wanted):
+                    chunks = iter_index_range(infile, index, offset, size)
+                    write_extracted(destination, name, chunks, mtime, mode)
+                    found.append(name)
+                return sorted(found)
+        logger.debug("Reading the complete archive %s.", archive)
+        codec = compression.get_codec_for_path(archive)
+        reader = infile
+        if codec is not None:
+            codec.check_available()
+            reader = codec.open_reader(infile)
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=READ_CHUNK_SIZE) as tar:
+            for info in tar:
+                name = normalize_member_path(info.name)
+                if not (info.isreg() or info.issym()) or not match(name):
+                    continue
+                if info.issym():
+                    write_symlink(destination, name, info.linkname)
+                else:
+                    member = tar.extractfile(info)
+                    chunks = iter(lambda: member.read(READ_CHUNK_SIZE), b"")
+                    write_extracted(
+                        destination, name, chunks, int(info.mtime), info.mode
+                    )
+                found.append(name)
+    return sorted(found)
+
+
+def extract_paths(archive, paths, destination):
+    """Extract files at or inside paths from archive to destination.
+
+    paths are relative to the root of the archive, like '0x00/0x01'.
+    Returns a sorted list of the extracted paths.
+    """
+    return extract_matching(
+        archive, lambda name: matches_paths(name, paths), destination
+    )
+
+
+def extract_members(archive, names, destination):
+    """Extract the files with exactly these names from archive to destination.
+
+    names is a set of paths relative to the root of the archive.
+    Returns a sorted list of the extracted paths.
+    """
+    return extract_matching(
+        archive, names.__contains__, destination, max_fraction=INDEX_MAX_FRACTION
+    )
@@ -0,0 +1,358 @@
+"""Compact lists of the blob files in a blobstorage.
+
+A blobstorage can have millions of blob files.  A dictionary with the
+relative path of each file as key costs a few hundred bytes per file.
+ZODB stores each blob as <oid directories>/<tid>.blob, so we can decode
+each path to two 64 bit integers.  A BlobList keeps the oids, tids and
+sizes in three columns of 64 bit integers, sorted by oid and tid, which
+costs 24 bytes per blob.  Files that are not blob files, like .layout,
+are kept in a small dictionary.
+
+Comparing two lists is a merge of two sorted columns, without building
+path strings.  A list written to disk with write_blob_list is read back
+with mmap, so the columns are not even copied into memory.
+
+We support the two layouts of ZODB.  In the bushy layout the oid is
+split in eight directories of one byte: 0x00/0x00/0x00/0x00/0x00/0x00/
+0x01/0x2a/0x03c6f1a2b7d8e977.blob.  In the lawn layout it is one
+directory: 0x012a/0x03c6f1a2b7d8e977.blob.  Other paths, and paths that
+would not be written like this by ZODB, are kept as other files.
+"""
+
+from array import array
+
+import bisect
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+
+logger = logging.getLogger("blobs")
+# Name of the file in which we store the blob list of a snapshot.
+BLOB_LIST_FILE = "bloblist.bin"
+BLOB_LIST_MAGIC = b"CRBBLOB1"
+# Magic, layout, number of blobs, size of the other files part.
+BLOB_LIST_HEADER = struct.Struct("<8s8sQQ")
+BUSHY = "bushy"
+LAWN = "lawn"
+# An oid or tid like ZODB writes it: 0x followed by an even number of hex
+# digits, without leading zero bytes.
+ID_RE = r"0x(?:00|(?!00)(?:[0-9a-f]{2}){1,8})"
+is_blob_name = re.compile(ID_RE + r"\.blob$").match
+match_bushy = re.compile(r"((?:0x[0-9a-f]{2}/){8})(" + ID_RE + r")\.blob$").match
+match_lawn = re.compile("(" + ID_RE + ")/(" + ID_RE + r")\.blob$").match
+
+
+def id_repr(number):
+    """Format an oid or tid like ZODB does."""
+    text = f"{number:x}"
+    if len(text) % 2:
+        text = "0" + text
+    return "0x" + text
+
+
+def decode_path(rel):
+    """Decode a relative path to a tuple of layout, oid and tid.
+
+    Returns None when this is not the path of a blob file.
+    """
+    match = match_bushy(rel)
+    if match is not None:
+        oid = int(match.group(1).replace("0x", "").replace("/", ""), 16)
+        return BUSHY, oid, int(match.group(2), 16)
+    match = match_lawn(rel)
+    if match is not None:
+        return LAWN, int(match.group(1), 16), int(match.group(2), 16)
+
+
+def encode_path(layout, oid, tid):
+    """Get the relative path of a blob file."""
+    name = id_repr(tid) + ".blob"
+    if layout == BUSHY:
+        dirs = [f"0x{byte:02x}" for byte in oid.to_bytes(8, "big")]
+        return "/".join(dirs + [name])
+    return id_repr(oid) + "/" + name
+
+
+class BlobList:
+    """The files in a blobstorage.
+
+    oids, tids and sizes are columns of 64 bit integers, sorted by oid and
+    tid.  They are arrays, or memoryviews of a mapped file.  others maps
+    the relative path of each file that is not a blob file to a tuple of
+    size and mtime.
+    """
+
+    __slots__ = ("layout", "oids", "tids", "sizes", "others", "_mmap")
+
+    def __init__(self, layout=BUSHY, oids=None, tids=None, sizes=None, others=None):
+        self.layout = layout
+        self.oids = oids if oids is not None else array("Q")
+        self.tids = tids if tids is not None else array("Q")
+        self.sizes = sizes if sizes is not None else array("Q")
+        self.others = others if others is not None else {}
+        self._mmap = None
+
+    def __repr__(self):
+        return "<BlobList layout={} blobs={} others={}>".format(
+            self.layout, len(self.oids), len(self.others)
+        )
+
+    def __len__(self):
+        return len(self.oids) + len(self.others)
+
+    @classmethod
+    def from_files(cls, files):
+        """Make a list from (path, size, mtime) tuples."""
+        blobs = []
+        others = {}
+        layout = None
+        for rel, size, mtime in files:
+            decoded = decode_path(rel)
+            if decoded is not None and layout in (None, decoded[0]):
+                layout = decoded[0]
+                blobs.append((decoded[1], decoded[2], size))
+            else:
+                others[rel] = (size, mtime)
+        blobs.sort()
+        return cls(
+            layout=layout or BUSHY,
+            oids=array("Q", [blob[0] for blob in blobs]),
+            tids=array("Q", [blob[1] for blob in blobs]),
+            sizes=array("Q", [blob[2] for blob in blobs]),
+            others=others,
+        )
+
+    def find(self, oid, tid):
+        """Return the position of a blob, or -1 when it is not there."""
+        start = bisect.bisect_left(self.oids, oid)
+        end = bisect.bisect_right(self.oids, oid, start)
+        pos = bisect.bisect_left(self.tids, tid, start, end)
+        if pos < end and self.tids[pos] == tid:
+            return pos
+        return -1
+
+    def __contains__(self, rel):
+        decoded = decode_path(rel)
+        if decoded is None or decoded[0] != self.layout:
+            return rel in self.others
+        return self.find(decoded[1], decoded[2]) >= 0
+
+    def get_path(self, pos):
+        return encode_path(self.layout, self.oids[pos], self.tids[pos])
+
+    def iter_files(self):
+        """Yield tuples of path and size of all files."""
+        for pos in range(len(self.oids)):
+            yield self.get_path(pos), self.sizes[pos]
+        for rel, (size, mtime) in self.others.items():
+            yield rel, size
+
+    def close(self):
+        """Release the mapped file, if any."""
+        if self._mmap is None:
+            return
+        for name in ("oids", "tids", "sizes"):
+            column = getattr(self, name)
+            if isinstance(column, memoryview):
+                column.release()
+        self._mmap.close()
+        self._mmap = None
+
+
+def get_known_size(prev, rel):
+    """Get the size of a blob file from the list of a previous snapshot.
+
+    Returns None when the blob is not in there.
+    """
+    decoded = decode_path(rel)
+    if decoded is None or decoded[0] != prev.layout:
+        return
+    pos = prev.find(decoded[1], decoded[2])
+    if pos >= 0:
+        return prev.sizes[pos]
+
+
+def from_listing(root, listing, prev=None):
+    """Make a BlobList from the listing that blobtree.snapshot_tree made.
+
+    listing has tuples of relative path and stat result.  The stat is
+    None for blob files that were hard linked without calling stat.  We
+    take their size from prev, the list of the previous snapshot, like
+    scan does.  Only when they are not in there, we call stat on the
+    file in root.
+    """
+
+    def iter_files():
+        for rel, stat in listing:
+            if stat is None:
+                if prev is not None:
+                    size = get_known_size(prev, rel)
+                    if size is not None:
+                        yield rel, size, 0
+                        continue
+                try:
+                    stat = os.lstat(os.path.join(root, *rel.split("/")))
+                except FileNotFoundError:
+                    continue
+            yield rel, stat.st_size, int(stat.st_mtime)
+
+    return BlobList.from_files(iter_files())
+
+
+def scan(source, prev=None):
+    """Make a BlobList of the files in source.
+
+    mtime is in seconds.  Symbolic links are listed, but not followed.
+    A missing directory has no files.
+
+    prev is the list of a previous snapshot of the same blobstorage.
+    For blob files that are in there, we take the size from prev, so we
+    only need to list the directories, without calling stat.
+    """
+    if not os.path.isdir(source):
+        return BlobList()
+
+    def iter_files():
+        stack = [(source, "")]
+        while stack:
+            path, prefix = stack.pop()
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    rel = prefix + entry.name
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, rel + "/"))
+                        continue
+                    if prev is not None and is_blob_name(entry.name):
+                        size = get_known_size(prev, rel)
+                        if size is not None:
+                            yield rel, size, 0
+                            continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    yield rel, stat.st_size, int(stat.st_mtime)
+
+    return BlobList.from_files(iter_files())
+
+
+def diff_blob_lists(old, new):
+    """Compare two blob lists.
+
+    Blob files are compared by oid and tid: ZODB never changes them.
+    Other files must have the same size and mtime.
+
+    Returns a sorted list of paths that are only in new, or changed, and a
+    sorted list of paths that are only in old.
+    """
+    added = []
+    removed = []
+    old_count = len(old.oids)
+    new_count = len(new.oids)
+    if old.layout != new.layout:
+        # Nothing in common.
+        added = [new.get_path(pos) for pos in range(new_count)]
+        removed = [old.get_path(pos) for pos in range(old_count)]
+    else:
+        i = j = 0
+        while i < old_count and j < new_count:
+            old_key = (old.oids[i], old.tids[i])
+            new_key = (new.oids[j], new.tids[j])
+            if old_key == new_key:
+                i += 1
+                j += 1
+            elif old_key < new_key:
+                removed.append(old.get_path(i))
+                i += 1
+            else:
+                added.append(new.get_path(j))
+                j += 1
+        removed.extend(old.get_path(pos) for pos in range(i, old_count))
+        added.extend(new.get_path(pos) for pos in range(j, new_count))
+    for rel, info in new.others.items():
+        if old.others.get(rel) != info:
+            added.append(rel)
+    removed.extend(rel for rel in old.others if rel not in new.others)
+    return sorted(added), sorted(removed)
+
+
+def write_blob_list(path, blob_list):
+    """Write a blob list to a binary file.
+
+    The columns are stored as little endian 64 bit integers, so we can map
+    them into memory when reading.
+    """
+    columns = []
+    for column in (blob_list.oids, blob_list.tids, blob_list.sizes):
+        column = array("Q", column)
+        if sys.byteorder != "little":
+            column.byteswap()
+        columns.append(column)
+    others = "".join(
+        f"{size} {mtime} {rel}\n" for rel, (size, mtime) in blob_list.others.items()
+    ).encode("utf-8", "surrogateescape")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            BLOB_LIST_HEADER.pack(
+                BLOB_LIST_MAGIC,
+                blob_list.layout.encode("ascii"),
+                len(blob_list.oids),
+                len(others),
+            )
+        )
+        for column in columns:
+            column.tofile(f)
+        f.write(others)
+    os.rename(tmp_path, path)
+
+
+def read_blob_list(path):
+    """Read a blob list that was written with write_blob_list.
+
+    The columns are memoryviews of the mapped file.  Call close on the
+    list when you are done.  Returns None when the file is missing or
+    unreadable.
+    """
+    if not os.path.isfile(path):
+        return
+    try:
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as exc:
+        # An empty file cannot be mapped.
+        logger.warning("Ignoring %s: %s", path, exc)
+        return
+    try:
+        magic, layout, count, others_size = BLOB_LIST_HEADER.unpack_from(mapped)
+        layout = layout.rstrip(b"\0").decode("ascii")
+        if magic != BLOB_LIST_MAGIC or layout not in (BUSHY, LAWN):
+            raise ValueError("unknown format")
+        start = BLOB_LIST_HEADER.size
+        end = start + 3 * 8 * count + others_size
+        if end != len(mapped):
+            raise ValueError(f"size is {len(mapped)} instead of {end}")
+        others = {}
+        others_data = mapped[start + 3 * 8 * count : end]
+        for line in others_data.decode("utf-8", "surrogateescape").splitlines():
+            size, mtime, rel = line.split(" ", 2)
+            others[rel] = (int(size), int(mtime))
+    except (struct.error, ValueError, UnicodeDecodeError) as exc:
+        logger.warning("Ignoring %s: %s", path, exc)
+        mapped.close()
+        return
+    columns = []
+    for number in range(3):
+        column = memoryview(mapped)[start : start + 8 * count].cast("Q")
+        if sys.byteorder != "little":
+            # Swapping needs a copy.
+            column = array("Q", column)
+            column.byteswap()
+        columns.append(column)
+        start += 8 * count
+    blob_list = BlobList(layout, *columns, others=others)
+    blob_list._mmap = mapped
+    return blob_list
@@ -0,0 +1,560 @@
+"""Native handling of blob directory trees.
+
+This is an in-process alternative for 'rsync -a --link-dest'.  We walk
+the blobstorage with os.scandir and create a new snapshot directory.
+Files that are unchanged compared to the previous snapshot are hard
+linked against that snapshot, other files are copied.
+
+The idea is the same as in copyblobs: see the article by Mike Rubel:
+http://www.mikerubel.org/computers/rsync_snapshots/
+"""
+
+from concurrent import futures
+
+import errno
+import gzip
+import logging
+import os
+import re
+import shutil
+import stat
+
+logger = logging.getLogger("blobs")
+
+# Log progress after this many files.
+PROGRESS_INTERVAL = 100000
+# Number of bytes to copy in one system call.
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+# When copy_file_range or sendfile fail with one of these errors,
+# before anything has been copied, we try the next way of copying.
+COPY_FALLBACK_ERRNOS = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+)
+# Name of the file in which we store the directory state of a snapshot.
+DIR_STATE_FILE = "dirstate.gz"
+DIR_STATE_HEADER = "# collective.recipe.backup dirstate 1"
+# Modification times of directories that are this close (in nanoseconds)
+# to the start of the previous snapshot, are not trusted.
+RACY_WINDOW_NS = 2 * 10**9
+# ZODB stores each revision of a blob in a file named after the
+# transaction id, for example 0x03c6f1a2b7d8e977.blob.  Such a file is
+# never changed after it has been committed.
+is_blob_file = re.compile(r"0x[0-9a-f]+\.blob$").match
+
+
+class TreeStats:
+    """Counters for a tree operation."""
+
+    __slots__ = (
+        "dirs",
+        "files",
+        "linked",
+        "copied",
+        "bytes_copied",
+        "symlinks",
+        "pruned",
+    )
+
+    def __init__(self):
+        self.dirs = 0
+        self.pruned = 0
+        self.files = 0
+        self.linked = 0
+        self.copied = 0
+        self.bytes_copied = 0
+        self.symlinks = 0
+
+    def __repr__(self):
+        return (
+            "<TreeStats dirs={} files={} linked={} copied={} "
+            "bytes_copied={} symlinks={} pruned={}>".format(
+                self.dirs,
+                self.files,
+                self.linked,
+                self.copied,
+                self.bytes_copied,
+                self.symlinks,
+                self.pruned,
+            )
+        )
+
+
+def same_file_contents(stat1, stat2):
+    """Quick check whether two files can be considered the same.
+
+    This is what rsync does by default: compare size and modification time.
+    """
+    if stat1.st_size != stat2.st_size:
+        return False
+    return int(stat1.st_mtime) == int(stat2.st_mtime)
+
+
+def same_device(path1, path2):
+    """Are both paths on the same device, so we can hard link?
+
+    A path that does not exist yet is checked by its nearest parent that
+    does exist.
+    """
+
+    def get_device(path):
+        path = os.path.abspath(path)
+        while not os.path.exists(path):
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return os.stat(path).st_dev
+
+    return get_device(path1) == get_device(path2)
+
+
+def link_or_copy(source, dest, link_source=None, stats=None):
+    """Hard link link_source to dest, or copy source to dest.
+
+    When link_source is None, or hard linking fails because the files
+    are on different devices, the maximum number of links is reached,
+    or the link source has disappeared, we copy the source.
+    """
+    if link_source is not None:
+        try:
+            os.link(link_source, dest)
+        except OSError as exc:
+            if exc.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM, errno.ENOENT):
+                raise
+            logger.debug("Could not hard link %s: %s. Copying.", link_source, exc)
+        else:
+            if stats is not None:
+                stats.linked += 1
+            return
+    size = copy_file(source, dest)
+    if stats is not None:
+        stats.copied += 1
+        stats.bytes_copied += size
+
+
+def _copy_file_range(infd, outfd):
+    return os.copy_file_range(infd, outfd, COPY_CHUNK_SIZE)
+
+
+def _sendfile(infd, outfd):
+    return os.sendfile(outfd, infd, None, COPY_CHUNK_SIZE)
+
+
+def _read_write(infd, outfd):
+    data = os.read(infd, COPY_CHUNK_SIZE)
+    if data:
+        # os.write may write less than we asked for.
+        view = memoryview(data)
+        while view:
+            written = os.write(outfd, view)
+            view = view[written:]
+    return len(data)
+
+
+def copy_file_contents(infd, outfd):
+    """Copy all contents from one file descriptor to another.
+
+    We prefer os.copy_file_range, which lets the kernel copy the data,
+    and may even share the blocks on file systems that support this.
+    Then os.sendfile, then plain reading and writing.  All these
+    release the GIL, so several threads can copy at the same time.
+
+    Returns the number of bytes copied.
+    """
+    methods = []
+    if hasattr(os, "copy_file_range"):
+        methods.append(_copy_file_range)
+    if hasattr(os, "sendfile"):
+        methods.append(_sendfile)
+    methods.append(_read_write)
+    total = 0
+    for method in methods:
+        try:
+            while True:
+                copied = method(infd, outfd)
+                if not copied:
+                    return total
+                total += copied
+        except OSError as exc:
+            if total or exc.errno not in COPY_FALLBACK_ERRNOS:
+                raise
+            logger.debug("Falling back from %s: %s", method.__name__, exc)
+    return total
+
+
+def copy_file(source, dest):
+    """Copy source file to dest, including permissions and times.
+
+    This is like shutil.copy2, but with copy_file_range.
+
+    Returns the number of bytes copied.
+    """
+    with open(source, "rb") as fsrc, open(dest, "wb") as fdst:
+        size = copy_file_contents(fsrc.fileno(), fdst.fileno())
+    shutil.copystat(source, dest)
+    return size
+
+
+def copy_tree(source, dest, workers=1, stats=None):
+    """Copy the source directory to dest, using several threads.
+
+    dest must not exist yet.  The result is the same as with
+    shutil.copytree: symlinks are followed, and permissions and
+    modification times of files and directories are kept.
+
+    We create the directories in the main thread, and let a pool of
+    'workers' threads copy the files.
+
+    Returns a TreeStats object.
+    """
+    if stats is None:
+        stats = TreeStats()
+    if os.path.exists(dest):
+        raise Exception(f"Path already exists: {dest}")
+    workers = max(1, int(workers))
+    # Do not keep too many pending copies in memory.
+    max_pending = workers * 64
+    created = []
+    pending = set()
+
+    def finish(done):
+        for future in done:
+            size = future.result()
+            stats.copied += 1
+            stats.bytes_copied += size
+            stats.files += 1
+            if not stats.files % PROGRESS_INTERVAL:
+                logger.info(
+                    "Progress: %d files copied, %d bytes.",
+                    stats.files,
+                    stats.bytes_copied,
+                )
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        todo = [(source, dest)]
+        try:
+            while todo:
+                src_dir, dest_dir = todo.pop()
+                os.mkdir(dest_dir)
+                created.append((src_dir, dest_dir))
+                stats.dirs += 1
+                with os.scandir(src_dir) as entries:
+                    for entry in entries:
+                        dest_path = os.path.join(dest_dir, entry.name)
+                        if entry.is_dir():
+                            todo.append((entry.path, dest_path))
+                            continue
+                        pending.add(executor.submit(copy_file, entry.path, dest_path))
+                        if len(pending) >= max_pending:
+                            done, pending = futures.wait(
+                                pending, return_when=futures.FIRST_COMPLETED
+                            )
+                            finish(done)
+            done, pending = futures.wait(pending)
+            finish(done)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    # Deepest directories were created last.  Set their stats first.
+    for src_dir, dest_dir in reversed(created):
+        shutil.copystat(src_dir, dest_dir)
+    return stats
+
+
+def list_entry_types(path):
+    """List the entries in a directory.
+
+    Return a dictionary of name and a boolean saying if it is a directory.
+    Symlinks count as neither, so we return None for them.
+    This uses the file type information from the directory listing,
+    so usually no stat calls are needed.
+    """
+    result = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_symlink():
+                result[entry.name] = None
+            else:
+                result[entry.name] = entry.is_dir()
+    return result
+
+
+class DirState:
+    """Modification times and contents of the directories in a snapshot.
+
+    'dirs' maps the relative path of a directory ('.' for the top) to a
+    tuple of modification time in nanoseconds, list of file names and
+    list of subdirectory names.  'started_ns' is the time at which we
+    started making the snapshot.
+    """
+
+    __slots__ = ("dirs", "started_ns")
+
+    def __init__(self, started_ns=0):
+        self.dirs = {}
+        self.started_ns = started_ns
+
+    def get_unchanged(self, rel, mtime_ns):
+        """Get the contents of a directory if it has not changed.
+
+        The modification time of a directory changes when entries are
+        added, removed or renamed.  But if the directory changed in the
+        same tick of the clock just after we recorded it, we cannot see
+        the difference.  So we do not trust modification times that are
+        too close to the start of the previous snapshot.
+        """
+        info = self.dirs.get(rel)
+        if info is None or info[0] != mtime_ns:
+            return
+        if mtime_ns >= self.started_ns - RACY_WINDOW_NS:
+            return
+        return info
+
+
+def read_dir_state(path):
+    """Read the directory state file of a previous snapshot.
+
+    Returns a DirState, or None when the file is missing or unreadable.
+    """
+    if not os.path.isfile(path):
+        return
+    state = DirState()
+    info = None
+    try:
+        with gzip.open(path, "rt", encoding="utf-8", errors="surrogateescape") as f:
+            header = f.readline().rstrip("\n")
+            if header != DIR_STATE_HEADER:
+                logger.warning("Ignoring %s: unknown format.", path)
+                return
+            for line in f:
+                kind, value = line.rstrip("\n").split(" ", 1)
+                if kind == "f":
+                    info[1].append(value)
+                elif kind == "s":
+                    info[2].append(value)
+                elif kind == "d":
+                    mtime_ns, rel = value.split(" ", 1)
+                    info = (int(mtime_ns), [], [])
+                    state.dirs[rel] = info
+                elif kind == "started":
+                    state.started_ns = int(value)
+    except (OSError, ValueError, TypeError, EOFError) as exc:
+        logger.warning("Ignoring %s: %s", path, exc)
+        return
+    return state
+
+
+def write_dir_state(path, state):
+    """Write the directory state to a file."""
+    tmp_path = path + ".tmp"
+    with gzip.open(
+        tmp_path, "wt", encoding="utf-8", errors="surrogateescape", compresslevel=1
+    ) as f:
+        f.write(DIR_STATE_HEADER + "\n")
+        f.write(f"started {state.started_ns}\n")
+        for rel, (mtime_ns, files, dirs) in state.dirs.items():
+            f.write(f"d {mtime_ns} {rel}\n")
+            for name in files:
+                f.write(f"f {name}\n")
+            for name in dirs:
+                f.write(f"s {name}\n")
+    os.rename(tmp_path, path)
+
+
+def snapshot_tree(
+    source,
+    dest,
+    prev=None,
+    stats=None,
+    immutable=False,
+    prev_state=None,
+    state=None,
+    listing=None,
+):
+    """Create a snapshot of the source directory in dest.
+
+    dest must not exist yet.  When prev is given, this should be the
+    previous snapshot.  Files in there that have the same relative path,
+    size and modification time as in source, are hard linked instead of
+    copied.  You may pass the source itself as prev: then all files are
+    hard linked to the source.
+
+    With immutable True, we trust that ZODB never changes a committed
+    blob file.  For files with a blob name, we then only check if the
+    relative path exists in the previous snapshot, without comparing
+    size or modification time.  We list each directory in the previous
+    snapshot once, so this does not cost any extra stat calls.  Other
+    files, like .layout, are still compared.
+
+    When you pass a DirState as 'state', we record the modification time
+    and contents of each directory in it.  Pass the state of the previous
+    snapshot as 'prev_state' (this requires immutable True): then for
+    directories whose modification time has not changed, we do not list
+    the source directory, but hard link the recorded blob files from
+    the previous snapshot.  Note that we must still check all
+    subdirectories: adding a blob deep down in the bushy layout only
+    changes the modification time of the directory that gets a new entry,
+    not of its parents.
+
+    Like 'rsync -a', we keep modes and modification times, and copy
+    symlinks as symlinks.
+
+    When you pass a list as 'listing', we add a tuple of relative path,
+    with slashes, and stat result for each file and symlink.  The stat
+    is None for blob files that we hard linked without calling stat.
+    So you get a listing of the snapshot without walking it again.
+
+    Returns a TreeStats object.
+    """
+    if stats is None:
+        stats = TreeStats()
+    if os.path.exists(dest):
+        raise Exception(f"Path already exists: {dest}")
+    if prev is not None and not os.path.isdir(prev):
+        prev = None
+    if prev is None or not immutable:
+        prev_state = None
+    # Directories for which we need to set the stats after filling them.
+    # Adding files would change the modification time.
+    created = []
+    # Stack of (source dir, dest dir, prev dir, relative path).
+    todo = [(source, dest, prev, ".")]
+    while todo:
+        src_dir, dest_dir, prev_dir, rel = todo.pop()
+        prefix = "" if rel == "." else rel.replace(os.sep, "/") + "/"
+        # Get the stat before listing the directory.  If the directory
+        # changes while we are busy, the next run will see a newer time.
+        dir_stat = os.stat(src_dir)
+        os.mkdir(dest_dir)
+        created.append((dest_dir, dir_stat))
+        stats.dirs += 1
+        known = None
+        if prev_state is not None and prev_dir is not None:
+            known = prev_state.get_unchanged(rel, dir_stat.st_mtime_ns)
+        if known is not None:
+            # This directory has not changed.
+            stats.pruned += 1
+            mtime_ns, files, dirs = known
+            if state is not None:
+                state.dirs[rel] = known
+            for name in dirs:
+                todo.append(
+                    (
+                        os.path.join(src_dir, name),
+                        os.path.join(dest_dir, name),
+                        os.path.join(prev_dir, name),
+                        os.path.join(rel, name) if rel != "." else name,
+                    )
+                )
+            for name in files:
+                src_path = os.path.join(src_dir, name)
+                prev_path = os.path.join(prev_dir, name)
+                file_stat = None
+                if is_blob_file(name):
+                    link_source = prev_path
+                else:
+                    file_stat = os.lstat(src_path)
+                    link_source = get_link_source(src_path, prev_path, file_stat)
+                link_or_copy(src_path, os.path.join(dest_dir, name), link_source, stats)
+                count_file(stats)
+                if listing is not None:
+                    listing.append((prefix + name, file_stat))
+            continue
+        prev_names = None
+        if immutable and prev_dir is not None:
+            prev_names = list_entry_types(prev_dir)
+        files = []
+        dirs = []
+        # When a directory contains something else than files and
+        # directories, we do not record it.
+        recordable = True
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                dest_path = os.path.join(dest_dir, entry.name)
+                if "\n" in entry.name:
+                    recordable = False
+                if prev_dir is not None:
+                    prev_path = os.path.join(prev_dir, entry.name)
+                else:
+                    prev_path = None
+                if entry.is_symlink():
+                    os.symlink(os.readlink(entry.path), dest_path)
+                    stats.symlinks += 1
+                    recordable = False
+                    if listing is not None:
+                        listing.append(
+                            (prefix + entry.name, entry.stat(follow_symlinks=False))
+                        )
+                    continue
+                if entry.is_dir():
+                    if prev_path is not None:
+                        if prev_names is not None:
+                            if not prev_names.get(entry.name):
+                                prev_path = None
+                        elif not os.path.isdir(prev_path):
+                            prev_path = None
+                    dirs.append(entry.name)
+                    if rel == ".":
+                        sub_rel = entry.name
+                    else:
+                        sub_rel = os.path.join(rel, entry.name)
+                    todo.append((entry.path, dest_path, prev_path, sub_rel))
+                    continue
+                files.append(entry.name)
+                link_source = None
+                trusted = False
+                if prev_names is not None and is_blob_file(entry.name):
+                    # Trust the name: no need to compare anything.
+                    if prev_names.get(entry.name) is False:
+                        link_source = prev_path
+                        trusted = True
+                elif prev_path is not None:
+                    link_source = get_link_source(
+                        entry.path, prev_path, entry.stat(follow_symlinks=False)
+                    )
+                link_or_copy(entry.path, dest_path, link_source, stats)
+                count_file(stats)
+                if listing is not None:
+                    # DirEntry caches the stat result.
+                    file_stat = None if trusted else entry.stat(follow_symlinks=False)
+                    listing.append((prefix + entry.name, file_stat))
+        if state is not None and recordable:
+            state.dirs[rel] = (dir_stat.st_mtime_ns, files, dirs)
+    # Deepest directories were created last.  Set their stats first.
+    for dest_dir, dir_stat in reversed(created):
+        os.chmod(dest_dir, stat.S_IMODE(dir_stat.st_mode))
+        os.utime(dest_dir, ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns))
+    return stats
+
+
+def get_link_source(source, prev_path, source_stat=None):
+    """Return prev_path if it has the same contents as source.
+
+    Otherwise return None.
+    """
+    try:
+        prev_stat = os.lstat(prev_path)
+    except FileNotFoundError:
+        return
+    if source_stat is None:
+        source_stat = os.lstat(source)
+    if same_file_contents(source_stat, prev_stat):
+        return prev_path
+
+
+def count_file(stats):
+    """Count a file and log progress now and then."""
+    stats.files += 1
+    if not stats.files % PROGRESS_INTERVAL:
+        logger.info(
+            "Progress: %d files, %d hard linked, %d copied.",
+            stats.files,
+            stats.linked,
+            stats.copied,
+        )
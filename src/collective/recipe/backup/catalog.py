@@ -0,0 +1,487 @@
+"""Catalog of the backups in a backup location.
+
+Finding the backups to restore or remove means listing the backup
+location and getting the modification time of each file, several times
+per run.  On a slow network mount that takes long.  With the
+backup_catalog option, each backup location gets a small SQLite database
+with the name, kind, size, modification time and parent of each backup.
+
+The catalog is a cache of what is on disk.  We store the modification
+time of the backup location itself: this changes whenever a file is
+added, removed or renamed, by us, by repozo, or by hand.  When it has
+not changed, one stat call is enough to know that the catalog is still
+right.  Otherwise we list the location again and stat the entries.  We
+only look inside entries that are new, or that have another inode
+number, size or modification time: repozo appends to its .dat files,
+and the blob list of a backup directory is written after it.  All
+changes to the catalog are done in one transaction.
+
+A catalog that cannot be read is rebuilt from disk.  You can do that by
+hand with 'bin/backup --rebuild-catalog'.
+
+Within one run of a script we list the same locations several times, for
+example when finding the backup to restore for the filestorage and the
+blobs.  In a listing_cache block we remember each listing, so we list
+and stat each location at most once.  Code that changes a backup
+location calls invalidate, so the next listing is read from disk.
+"""
+
+from collective.recipe.backup import bloblist
+from collective.recipe.backup import compression
+from contextlib import contextmanager
+
+import functools
+import logging
+import os
+import re
+import sqlite3
+import time
+
+logger = logging.getLogger("catalog")
+CATALOG_FILE = ".backup-catalog.sqlite"
+CATALOG_VERSION = 1
+# Modification times of the backup location that are this close (in
+# nanoseconds) to the time we listed it, are not trusted.
+RACY_WINDOW_NS = 2 * 10**9
+# Timestamps like repozo uses, or the numbers of rotated backups.
+STAMP = r"\d{4}(?:-\d\d){5}|\d+"
+match_data_file = re.compile(r"(" + STAMP + r")\.(fs|fsz|deltafs|deltafsz)$").match
+match_backup = re.compile(
+    r"(?:(?P<base>[^.]+)\.)?(?P<stamp>" + STAMP + r")(?:\.(?P<suffix>.+))?$"
+).match
+# Listings per absolute path, while in a listing_cache block.
+_listings = None
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    stamp TEXT,
+    is_dir INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    files INTEGER,
+    parent TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+
+class Entry:
+    """A file or directory in a backup location.
+
+    kind is 'full', 'delta', 'snar', 'dir' or 'other'.  For a delta,
+    parent is the name of the backup before it in the chain.  files is
+    the number of files in a blob backup directory, when we know it.
+    """
+
+    __slots__ = (
+        "name",
+        "kind",
+        "stamp",
+        "is_dir",
+        "size",
+        "mtime",
+        "inode",
+        "files",
+        "parent",
+    )
+
+    def __init__(
+        self,
+        name,
+        kind="other",
+        stamp=None,
+        is_dir=False,
+        size=None,
+        mtime=0.0,
+        inode=0,
+        files=None,
+        parent=None,
+    ):
+        self.name = name
+        self.kind = kind
+        self.stamp = stamp
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.inode = inode
+        self.files = files
+        self.parent = parent
+
+    def __repr__(self):
+        return f"<Entry {self.name} kind={self.kind} parent={self.parent}>"
+
+    def as_row(self):
+        return (
+            self.name,
+            self.kind,
+            self.stamp,
+            int(self.is_dir),
+            self.size,
+            self.mtime,
+            self.inode,
+            self.files,
+            self.parent,
+        )
+
+
+def get_catalog_path(location):
+    return os.path.join(location, CATALOG_FILE)
+
+
+def has_catalog(location):
+    return os.path.isfile(get_catalog_path(location))
+
+
+def is_catalog_file(name):
+    """Is this the catalog, or a temporary file of SQLite?"""
+    return name.startswith(CATALOG_FILE)
+
+
+def get_kind(name, is_dir):
+    """Get the kind and stamp of a backup, based on its name."""
+    match = match_data_file(name)
+    if match is not None:
+        kind = "delta" if match.group(2).startswith("delta") else "full"
+        return kind, match.group(1)
+    match = match_backup(name)
+    if match is None:
+        return "other", None
+    stamp = match.group("stamp")
+    suffix = match.group("suffix")
+    if is_dir:
+        if suffix is None:
+            return "dir", stamp
+        return "other", stamp
+    if suffix is None:
+        return "other", stamp
+    if suffix == "snar":
+        return "snar", stamp
+    if suffix in compression.archive_suffixes(delta=True):
+        if suffix.startswith("delta."):
+            return "delta", stamp
+        return "full", stamp
+    return "other", stamp
+
+
+def make_entry(location, dir_entry, count_files=False, stat=None):
+    """Make an Entry for an os.DirEntry.
+
+    With count_files, we read the blob list of a blob backup directory to
+    get its number of files.  This opens a file, so we only do this for
+    the catalog.
+    """
+    is_dir = dir_entry.is_dir()
+    kind, stamp = get_kind(dir_entry.name, is_dir)
+    if stat is None:
+        stat = dir_entry.stat()
+    entry = Entry(
+        dir_entry.name,
+        kind=kind,
+        stamp=stamp,
+        is_dir=is_dir,
+        size=None if is_dir else stat.st_size,
+        mtime=stat.st_mtime,
+        inode=dir_entry.inode(),
+    )
+    if count_files and kind == "dir":
+        blob_list = bloblist.read_blob_list(
+            os.path.join(dir_entry.path, bloblist.BLOB_LIST_FILE)
+        )
+        if blob_list is not None:
+            entry.files = len(blob_list)
+            blob_list.close()
+    return entry
+
+
+def set_parents(entries):
+    """Set the parent of each delta to the previous backup in its chain.
+
+    A chain is a full backup followed by deltas, with the same base name
+    and kind of file.  Stamps of deltas are always timestamps, so they
+    sort in time order.
+    """
+    chains = {}
+    for entry in sorted(entries, key=lambda entry: entry.name):
+        if entry.kind not in ("full", "delta"):
+            entry.parent = None
+            continue
+        # Filestorage backups have no base name.
+        match = match_backup(entry.name)
+        key = match.group("base") if match is not None else None
+        previous = chains.get(key)
+        if entry.kind == "delta" and previous is not None:
+            entry.parent = previous.name
+        else:
+            entry.parent = None
+        chains[key] = entry
+
+
+def scan_location(location):
+    """List the entries of a backup location, without catalog."""
+    entries = []
+    with os.scandir(location) as dir_entries:
+        for dir_entry in dir_entries:
+            if is_catalog_file(dir_entry.name):
+                continue
+            try:
+                entries.append(make_entry(location, dir_entry))
+            except FileNotFoundError:
+                continue
+    set_parents(entries)
+    return entries
+
+
+class Catalog:
+    """The catalog of one backup location."""
+
+    def __init__(self, location):
+        self.location = location
+        self.path = get_catalog_path(location)
+        self.connection = None
+
+    def open(self):
+        # Keep the rollback journal in memory.  A journal file would be
+        # created and removed next to the catalog, which changes the
+        # modification time of the backup location, so we would never
+        # trust the catalog.  A catalog that is damaged by a crash is
+        # rebuilt.
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=MEMORY")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_state(self, key):
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def is_fresh(self):
+        """Is the catalog still right about the backup location?"""
+        if self.get_state("version") != CATALOG_VERSION:
+            return False
+        dir_mtime_ns = self.get_state("dir_mtime_ns")
+        synced_ns = self.get_state("synced_ns")
+        if dir_mtime_ns is None or synced_ns is None:
+            return False
+        if os.stat(self.location).st_mtime_ns != dir_mtime_ns:
+            return False
+        # A change in the same tick of the clock, just after we listed
+        # the location, would not be visible.
+        return dir_mtime_ns < synced_ns - RACY_WINDOW_NS
+
+    def get_entries(self):
+        rows = self.connection.execute(
+            "SELECT name, kind, stamp, is_dir, size, mtime, inode, files, parent "
+            "FROM backups ORDER BY name"
+        )
+        return [
+            Entry(
+                name,
+                kind=kind,
+                stamp=stamp,
+                is_dir=bool(is_dir),
+                size=size,
+                mtime=mtime,
+                inode=inode,
+                files=files,
+                parent=parent,
+            )
+            for name, kind, stamp, is_dir, size, mtime, inode, files, parent in rows
+        ]
+
+    def refresh(self, force=False):
+        """Update the catalog from disk, when needed.
+
+        Entries with the same inode number, size and modification time
+        as in the catalog are not checked again.  With force, we check
+        everything.
+
+        Returns the entries, sorted by name.
+        """
+        if not force and self.is_fresh():
+            return self.get_entries()
+        synced_ns = time.time_ns()
+        dir_mtime_ns = os.stat(self.location).st_mtime_ns
+        known = {} if force else {entry.name: entry for entry in self.get_entries()}
+        entries = []
+        with os.scandir(self.location) as dir_entries:
+            for dir_entry in dir_entries:
+                if is_catalog_file(dir_entry.name):
+                    continue
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+                entry = known.get(dir_entry.name)
+                if (
+                    entry is None
+                    or entry.inode != dir_entry.inode()
+                    or entry.mtime != stat.st_mtime
+                    or (not entry.is_dir and entry.size != stat.st_size)
+                ):
+                    entry = make_entry(
+                        self.location, dir_entry, count_files=True, stat=stat
+                    )
+                entries.append(entry)
+        set_parents(entries)
+        logger.debug(
+            "Updating catalog of %s: %d entries, %d new.",
+            self.location,
+            len(entries),
+            len([entry for entry in entries if entry.name not in known]),
+        )
+        connection = self.connection
+        connection.execute("BEGIN")
+        try:
+            connection.execute("DELETE FROM backups")
+            connection.executemany(
+                "INSERT INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [entry.as_row() for entry in entries],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO state VALUES (?, ?)",
+                [
+                    ("version", CATALOG_VERSION),
+                    ("dir_mtime_ns", dir_mtime_ns),
+                    ("synced_ns", synced_ns),
+                ],
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return sorted(entries, key=lambda entry: entry.name)
+
+
+def create_catalog(location):
+    """Create the catalog of a backup location, if it does not exist."""
+    if not location or not os.path.isdir(location) or has_catalog(location):
+        return
+    logger.info("Creating backup catalog in %s", location)
+    rebuild_catalog(location)
+
+
+def rebuild_catalog(location):
+    """Build the catalog of a backup location from scratch.
+
+    Returns the entries.
+    """
+    invalidate(location)
+    path = get_catalog_path(location)
+    if os.path.exists(path):
+        os.remove(path)
+    with Catalog(location) as catalog:
+        return catalog.refresh(force=True)
+
+
+@contextmanager
+def listing_cache():
+    """Remember the listings of backup locations in this block.
+
+    Blocks can be nested: the outer block owns the cache.
+    """
+    global _listings
+    if _listings is not None:
+        yield
+        return
+    _listings = {}
+    try:
+        yield
+    finally:
+        _listings = None
+
+
+def with_listing_cache(func):
+    """Decorator to call a function in a listing_cache block."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with listing_cache():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def invalidate(location=None):
+    """Forget the cached listing of a location, or of all locations."""
+    if _listings is None:
+        return
+    if location is None:
+        _listings.clear()
+        return
+    _listings.pop(os.path.abspath(location), None)
+
+
+def get_cached(location):
+    """Get the cached names and entries of a location.
+
+    Returns None when we do not cache.  Otherwise a list of names and
+    entries, which are None when we have not listed them yet.
+    """
+    if _listings is None:
+        return
+    return _listings.setdefault(os.path.abspath(location), [None, None])
+
+
+def list_entries(location):
+    """List the entries of a backup location, sorted by name.
+
+    We use the catalog when there is one.
+    """
+    cached = get_cached(location)
+    if cached is None:
+        return _list_entries(location)
+    if cached[1] is None:
+        cached[1] = _list_entries(location)
+        cached[0] = [entry.name for entry in cached[1]]
+    # Callers may change the list.
+    return list(cached[1])
+
+
+def _list_entries(location):
+    if not has_catalog(location):
+        return sorted(scan_location(location), key=lambda entry: entry.name)
+    try:
+        with Catalog(location) as catalog:
+            return catalog.refresh()
+    except sqlite3.DatabaseError as exc:
+        logger.warning("Rebuilding catalog of %s: %s", location, exc)
+        return rebuild_catalog(location)
+
+
+def list_names(location):
+    """List the names in a backup location, sorted.
+
+    Without catalog this only lists the directory, without stat calls.
+    """
+    cached = get_cached(location)
+    if cached is None:
+        return _list_names(location)
+    if cached[0] is None:
+        cached[0] = _list_names(location)
+    return list(cached[0])
+
+
+def _list_names(location):
+    if not has_catalog(location):
+        return sorted(
+            name for name in os.listdir(location) if not is_catalog_file(name)
+        )
+    return [entry.name for entry in _list_entries(location)]
@@ -0,0 +1,365 @@
+"""Compression codecs for blob archives.
+
+Each codec knows the suffix of its archives, like 'gz' in
+blobstorage.0.tar.gz, and how to compress and decompress a stream in
+Python.  The functions that look for archives use the suffixes of all
+registered codecs, so an archive made with any codec is found and can be
+restored, even when the blob_compression option has changed since then.
+
+zstd and lz4 need the optional zstandard and lz4 packages.
+Archives are always found by their suffix, but compressing or
+decompressing them fails when the package is not available.
+"""
+
+from collections import deque
+from concurrent import futures
+
+import abc
+import bz2
+import gzip
+import importlib
+import lzma
+import zlib
+
+# Size of the blocks that are compressed in parallel.
+GZIP_BLOCK_SIZE = 1024 * 1024
+# Number of compressed blocks that may wait for writing, per worker.
+GZIP_PENDING_PER_WORKER = 2
+# Blocks of this size are compressed separately when we want to be able
+# to seek in the archive.
+BLOCK_SIZE = GZIP_BLOCK_SIZE
+# Name of the codec that compress_blob uses.
+DEFAULT_CODEC = "gzip"
+
+
+def compress_block(data, compresslevel):
+    """Compress data to one complete gzip member.
+
+    zlib releases the GIL while compressing, so this can run in threads.
+    We use mtime 0 in the header, so the result only depends on the data.
+    """
+    return zlib.compress(data, compresslevel, wbits=31)
+
+
+class ParallelBlockWriter:
+    """File-like object that compresses data in blocks using several threads.
+
+    The data is cut in blocks, each block is compressed separately by a
+    pool of threads, and the results are written in the original order.
+    The output is a series of gzip members (or frames or streams of
+    another codec), which is a valid compressed file.
+    Compressing blocks separately costs a little in compression ratio,
+    but a reader can start decompressing at the start of any block.
+    The offsets attribute has the compressed offset of each block.
+    """
+
+    def __init__(
+        self, fileobj, codec, workers=2, compresslevel=None, block_size=BLOCK_SIZE
+    ):
+        if compresslevel is None:
+            compresslevel = codec.default_level
+        self.fileobj = fileobj
+        self.codec = codec
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.blocks = 0
+        self.offsets = []
+        self.written = 0
+        workers = max(int(workers), 1)
+        self.max_pending = workers * GZIP_PENDING_PER_WORKER
+        self.pending = deque()
+        self.executor = futures.ThreadPoolExecutor(max_workers=workers)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[: self.block_size])
+            del self.buffer[: self.block_size]
+            self._submit(block)
+
+    def _submit(self, block):
+        self.pending.append(
+            self.executor.submit(self.codec.compress_block, block, self.compresslevel)
+        )
+        self.blocks += 1
+        while len(self.pending) > self.max_pending:
+            self._write_one()
+
+    def _write_one(self):
+        data = self.pending.popleft().result()
+        self.offsets.append(self.written)
+        self.fileobj.write(data)
+        self.written += len(data)
+
+    def close(self):
+        """Compress and write what is left."""
+        if self.buffer or not self.blocks:
+            # An empty file still needs one gzip member or frame.
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_one()
+        self.executor.shutdown()
+
+    def stop(self):
+        """Stop without writing what is left."""
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown()
+
+
+class ParallelGzipWriter(ParallelBlockWriter):
+    """File-like object that gzips data using several threads."""
+
+    def __init__(self, fileobj, workers=2, compresslevel=6, block_size=GZIP_BLOCK_SIZE):
+        super().__init__(
+            fileobj,
+            get_codec("gzip"),
+            workers=workers,
+            compresslevel=compresslevel,
+            block_size=block_size,
+        )
+
+
+class Codec(abc.ABC):
+    """A compression codec.
+
+    name is what you use in the blob_compression option.
+    extension is the last part of the archive name, without dot.
+    module is the name of the module that we need, or None.
+    Subclasses implement open_writer, open_reader and compress_block.
+    """
+
+    __slots__ = ("name", "extension", "module", "default_level", "levels")
+
+    def __init__(self, name, extension, module=None, default_level=6, levels=(1, 9)):
+        self.name = name
+        self.extension = extension
+        self.module = module
+        self.default_level = default_level
+        self.levels = levels
+
+    def __repr__(self):
+        return f"<Codec {self.name}>"
+
+    def is_available(self):
+        if self.module is None:
+            return True
+        try:
+            importlib.import_module(self.module)
+        except ImportError:
+            return False
+        return True
+
+    def check_available(self):
+        if not self.is_available():
+            raise RuntimeError(
+                f"Compression {self.name} needs the {self.module} package."
+            )
+
+    def check_level(self, level):
+        low, high = self.levels
+        if not low <= level <= high:
+            raise ValueError(
+                "Compression level for {} must be from {} to {}, not {}.".format(
+                    self.name, low, high, level
+                )
+            )
+
+    @abc.abstractmethod
+    def open_writer(self, fileobj, level=None, workers=1):
+        """Return a file-like object that writes compressed data to fileobj.
+
+        Closing it does not close fileobj.
+        """
+
+    @abc.abstractmethod
+    def open_reader(self, fileobj):
+        """Return a file-like object that reads decompressed data from fileobj.
+
+        It reads from the current position of fileobj.
+        """
+
+    @abc.abstractmethod
+    def compress_block(self, data, level):
+        """Compress data to one complete member, frame or stream.
+
+        Concatenated blocks are a valid compressed file.
+        """
+
+    def open_block_writer(self, fileobj, level=None, workers=1, block_size=BLOCK_SIZE):
+        """Return a ParallelBlockWriter, for output that a reader can seek in."""
+        self.check_available()
+        return ParallelBlockWriter(
+            fileobj, self, workers=workers, compresslevel=level, block_size=block_size
+        )
+
+
+class GzipCodec(Codec):
+    def open_writer(self, fileobj, level=None, workers=1):
+        if level is None:
+            level = self.default_level
+        if int(workers) > 1:
+            return ParallelGzipWriter(fileobj, workers=workers, compresslevel=level)
+        return gzip.GzipFile(mode="wb", compresslevel=level, fileobj=fileobj, mtime=0)
+
+    def open_reader(self, fileobj):
+        # This reads concatenated gzip members too.
+        return gzip.GzipFile(mode="rb", fileobj=fileobj)
+
+    def compress_block(self, data, level):
+        return compress_block(data, level)
+
+
+class Bzip2Codec(Codec):
+    def open_writer(self, fileobj, level=None, workers=1):
+        if level is None:
+            level = self.default_level
+        return bz2.BZ2File(fileobj, mode="wb", compresslevel=level)
+
+    def open_reader(self, fileobj):
+        return bz2.BZ2File(fileobj, mode="rb")
+
+    def compress_block(self, data, level):
+        return bz2.compress(data, level)
+
+
+class XzCodec(Codec):
+    def open_writer(self, fileobj, level=None, workers=1):
+        if level is None:
+            level = self.default_level
+        return lzma.LZMAFile(fileobj, mode="wb", preset=level)
+
+    def open_reader(self, fileobj):
+        return lzma.LZMAFile(fileobj, mode="rb")
+
+    def compress_block(self, data, level):
+        return lzma.compress(data, preset=level)
+
+
+class ZstdCodec(Codec):
+    def open_writer(self, fileobj, level=None, workers=1):
+        self.check_available()
+        import zstandard
+
+        if level is None:
+            level = self.default_level
+        workers = int(workers)
+        compressor = zstandard.ZstdCompressor(
+            level=level, threads=workers if workers > 1 else 0
+        )
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def open_reader(self, fileobj):
+        self.check_available()
+        import zstandard
+
+        # read_across_frames, so we can read concatenated frames.
+        return zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_across_frames=True, closefd=False
+        )
+
+    def compress_block(self, data, level):
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class Lz4Codec(Codec):
+    def open_writer(self, fileobj, level=None, workers=1):
+        self.check_available()
+        import lz4.frame
+
+        if level is None:
+            level = self.default_level
+        return lz4.frame.LZ4FrameFile(fileobj, mode="wb", compression_level=level)
+
+    def open_reader(self, fileobj):
+        self.check_available()
+        import lz4.frame
+
+        return lz4.frame.LZ4FrameFile(fileobj, mode="rb")
+
+    def compress_block(self, data, level):
+        import lz4.frame
+
+        return lz4.frame.compress(data, compression_level=level)
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """Register a codec, replacing any codec with the same name."""
+    CODECS[codec.name] = codec
+
+
+register_codec(GzipCodec("gzip", "gz", default_level=6, levels=(0, 9)))
+register_codec(Bzip2Codec("bz2", "bz2", default_level=9, levels=(1, 9)))
+register_codec(XzCodec("xz", "xz", default_level=6, levels=(0, 9)))
+register_codec(ZstdCodec("zstd", "zst", "zstandard", default_level=3, levels=(1, 22)))
+register_codec(Lz4Codec("lz4", "lz4", "lz4", default_level=0, levels=(0, 16)))
+
+
+def get_codec(name):
+    """Get codec by name.  Raises KeyError for unknown codecs."""
+    return CODECS[name]
+
+
+def parse_compression(value):
+    """Parse a blob_compression value like 'zstd:3'.
+
+    Returns a tuple of codec and level, where level may be None.
+    An empty value or 'none' gives (None, None).
+
+    Raises ValueError for unknown codecs or wrong levels.
+    """
+    value = (value or "").strip()
+    if not value or value == "none":
+        return None, None
+    name, sep, level = value.partition(":")
+    name = name.strip()
+    if name not in CODECS:
+        raise ValueError(
+            "Unknown compression {!r}. Choose from: {}.".format(
+                name, ", ".join(sorted(CODECS))
+            )
+        )
+    codec = CODECS[name]
+    if not sep:
+        return codec, None
+    try:
+        level = int(level)
+    except ValueError:
+        raise ValueError(f"Compression level must be a number, not {level!r}.")
+    codec.check_level(level)
+    return codec, level
+
+
+def archive_suffixes(delta=False):
+    """Get all archive suffixes, without leading dot.
+
+    This is 'tar' plus 'tar.<extension>' for each codec.
+    With delta=True, we return the 'delta.tar' variants too.
+    The longest suffixes come first, so when you try them in order,
+    'delta.tar.gz' is found before 'tar.gz'.
+    """
+    suffixes = ["tar"]
+    for codec in CODECS.values():
+        suffixes.append("tar." + codec.extension)
+    if delta:
+        suffixes += ["delta." + suffix for suffix in suffixes]
+    return sorted(suffixes, key=len, reverse=True)
+
+
+def get_codec_for_path(path):
+    """Get the codec for this archive path, based on its suffix.
+
+    Returns None for a plain tar file or an unknown suffix.
+    """
+    for codec in CODECS.values():
+        if path.endswith(".tar." + codec.extension):
+            return codec
+    return None
@@ -6,46 +6,150 @@ It is based on this article by Mike Rubel:
 http://www.mikerubel.org/computers/rsync_snapshots/
 """
 
+from collective.recipe.backup import blobarchive
+from collective.recipe.backup import bloblist
+from collective.recipe.backup import blobtree
+from collective.recipe.backup import catalog
+from collective.recipe.backup import compression
+from collective.recipe.backup import manifest
+from collective.recipe.backup import trash
 from collective.recipe.backup import utils
+from concurrent import futures
 from datetime import datetime
+from datetime import timezone
 
+import bisect
+import functools
 import logging
 import os
 import re
+import shlex
 import shutil
 import sys
+import tarfile
 import time
 
 logger = logging.getLogger("blobs")
 SOURCE = "blobstorage"
 BACKUP_DIR = "backups"
+# With sharded rsync, aim for this many shards per worker,
+# so a few large shards do not keep the other workers idle.
+RSYNC_SHARDS_PER_WORKER = 4
+# Do not look deeper than this for shards.  The bushy layout has
+# eight levels, the lawn layout one.
+RSYNC_SHARDS_MAX_DEPTH = 8
+# Suffix of the directory where a restore is prepared.
+RESTORE_TMP_SUFFIX = ".restoring"
+# Files next to an archive that belong to it.
+SIDECAR_SUFFIXES = (blobarchive.INDEX_SUFFIX, manifest.MANIFEST_SUFFIX)
 # Similar to is_data_file in repozo.py:
 is_time_stamp = re.compile(r"\d{4}(?:-\d\d){5}$").match
 
 
+class BackupName:
+    """Parsed name of a backup: prefix.number.suffix.
+
+    number is an integer or a timestamp, as string.  suffix includes the
+    leading dot, and is empty when we did not look for suffixes.  key is
+    number_key(number), for sorting.
+    """
+
+    __slots__ = ("prefix", "number", "suffix", "key")
+
+    def __init__(self, prefix, number, suffix="", key=None):
+        self.prefix = prefix
+        self.number = number
+        self.suffix = suffix
+        self.key = number_key(number) if key is None else key
+
+    def __repr__(self):
+        return f"<BackupName {self.prefix}.{self.number}{self.suffix}>"
+
+
+def normalize_suffixes(suffixes):
+    """Get suffixes as tuple, with leading dot, from large to small.
+
+    Order the suffixes from large to small.  Otherwise looking for 'tar'
+    will find 'delta.tar' too, which will trip up our logic.
+    """
+    if isinstance(suffixes, utils.stringtypes):
+        suffixes = [suffixes]
+    return _normalize_suffixes(tuple(suffixes))
+
+
+@functools.cache
+def _normalize_suffixes(suffixes):
+    suffixes = [
+        suffix if suffix.startswith(".") else "." + suffix for suffix in suffixes
+    ]
+    return tuple(sorted(suffixes, key=len, reverse=True))
+
+
+@functools.cache
+def _get_backup_name_parser(prefix, suffixes):
+    if prefix is None:
+        # number or anything.number.
+        # But 'anything' should not contain dots: too tricky.
+        pattern = r"(?:(?P<prefix>[^.]*)\.)?"
+        found_prefix = None
+    else:
+        pattern = re.escape(prefix)
+        found_prefix = prefix.rstrip(".")
+    pattern += r"(?P<number>(?P<stamp>\d{4}(?:-\d\d){5})|\d+)"
+    if suffixes is not None:
+        pattern += "(?P<suffix>" + "|".join(map(re.escape, suffixes)) + ")"
+    else:
+        pattern += "(?P<suffix>)"
+    fullmatch = re.compile(pattern).fullmatch
+
+    def parse(value):
+        match = fullmatch(value)
+        if match is None:
+            return
+        this_prefix, number, stamp, suffix = match.group(
+            "prefix" if found_prefix is None else 0, "number", "stamp", "suffix"
+        )
+        if found_prefix is not None:
+            this_prefix = found_prefix
+        # This is number_key, but we know already what the number is.
+        key = (1, number) if stamp else (0, -int(number))
+        return BackupName(this_prefix or "", number, suffix, key)
+
+    return parse
+
+
+def get_backup_name_parser(prefix=None, suffixes=None):
+    """Get a function that parses backup names.
+
+    See get_prefix_and_number for the arguments.  The function gets a
+    name and returns a BackupName, or None when this is not a backup
+    name.  Get the parser once when you parse a lot of names.
+    """
+    if prefix is not None and not prefix.endswith("."):
+        # A dot at the end would be a coding error.
+        prefix += "."
+    if suffixes is not None:
+        suffixes = normalize_suffixes(suffixes)
+    return _get_backup_name_parser(prefix, suffixes)
+
+
+def parse_backup_name(value, prefix=None, suffixes=None):
+    """Parse a backup name.
+
+    We return a BackupName, or None when value is not a backup name.
+    """
+    return get_backup_name_parser(prefix=prefix, suffixes=suffixes)(value)
+
+
 def find_suffixes(value, suffixes):
     """Check that value contains one of the suffixes.
 
     If it does, return the value without suffix.
     It it does not, return None.
     """
-    if isinstance(suffixes, utils.stringtypes):
-        suffixes = [suffixes]
-    # Order the suffixes from large to small.
-    # Otherwise looking for 'tar' will find 'delta.tar' too,
-    # which will trip up our logic.
-    suffixes = sorted(suffixes, key=len, reverse=True)
-    found = False
-    for suffix in suffixes:
-        if not suffix.startswith("."):
-            suffix = "." + suffix
+    for suffix in normalize_suffixes(suffixes):
         if value.endswith(suffix):
-            found = True
-            break
-    if not found:
-        return
-    value = value[: -len(suffix)]
-    return value
+            return value[: -len(suffix)]
 
 
 def get_prefix_and_number(value, prefix=None, suffixes=None):
@@ -63,42 +167,13 @@ def get_prefix_and_number(value, prefix=None, suffixes=None):
 
     For suffix it must be an explicit suffix or nothing.
 
-    We return None or a string containing the number.
-
-    This can probably be done with one regular expression,
-    but it would be hard to read.
+    We return None or a tuple with the prefix and a string containing
+    the number.  See parse_backup_name for the details.
     """
-    if suffixes is not None:
-        value = find_suffixes(value, suffixes)
-        if value is None:
-            return
-    if prefix is None:
-        # number or anything.number.
-        # But 'anything' should not contain dots: too tricky.
-        dots = value.count(".")
-        if dots > 1:
-            return
-        if dots == 1:
-            prefix, value = value.split(".")
-        else:
-            prefix = ""
-    else:
-        # A dot at the end would be a coding error.
-        if not prefix.endswith("."):
-            prefix += "."
-        if not value.startswith(prefix):
-            return
-        value = value[len(prefix) :]
-    # At this point, we really should only have a number left.
-    try:
-        int(value)
-    except ValueError:
-        if not is_time_stamp(value):
-            return
-    if prefix:
-        # return prefix without dot
-        prefix = prefix.rstrip(".")
-    return prefix, value
+    name = parse_backup_name(value, prefix=prefix, suffixes=suffixes)
+    if name is None:
+        return
+    return name.prefix, name.number
 
 
 def number_key(value):
@@ -120,16 +195,13 @@ def number_key(value):
     Sample input may be '0', '1', '2', '10', '2000-12-31-23-59-30',
     '1999-12-31-23-59-30'.
     """
+    if is_time_stamp(value):
+        return (1, value)
     try:
         # make number negative
-        value = -int(value)
-        type_indicator = 0
+        return (0, -int(value))
     except ValueError:
-        if not is_time_stamp(value):
-            raise ValueError(f"No integer and no timestamp in {value}.")
-        # timestamp
-        type_indicator = 1
-    return (type_indicator, value)
+        raise ValueError(f"No integer and no timestamp in {value}.")
 
 
 def first_number_key(value):
@@ -180,7 +252,7 @@ def part_of_same_archive_backup(values):
     """
     if not values:
         return True
-    suffixes = [".tar", ".tar.gz"]
+    suffixes = ["." + suffix for suffix in compression.archive_suffixes()]
     cleaned = []
     for candidate in values:
         correct = False
@@ -212,7 +284,7 @@ def archive_backup_key(value):
     so we can assume that value is something like blobstorage.0.tar.gz or
     blobstorage.1999-12-31-23-59-30.tar.
     """
-    suffixes = [".tar", ".tar.gz"]
+    suffixes = ["." + suffix for suffix in compression.archive_suffixes()]
     for suffix in suffixes:
         if value.endswith(suffix):
             value = value[: -len(suffix)]
@@ -292,6 +364,15 @@ def get_valid_directories(container, name):
     return valid_entries
 
 
+def get_archive_re(name):
+    """Get regular expression for numbered archives that start with 'name'.
+
+    The groups are the number and the suffix, like 'tar.gz'.
+    """
+    suffixes = "|".join(re.escape(suffix) for suffix in compression.archive_suffixes())
+    return re.compile(rf"^{name}\.(\d+)\.({suffixes})$")
+
+
 def get_valid_archives(container, name):
     """Get gzip files in container that start with 'name'.
 
@@ -300,7 +381,7 @@ def get_valid_archives(container, name):
     not actually a file as this will mess up our logic further
     on.  No one should manually add files or directories here.
 
-    Both tar and tar.gz are accepted.
+    Both tar and compressed archives like tar.gz are accepted.
 
     Note: timestamps are not accepted here.  This function is not used
     in scenarios that use timestamps.
@@ -334,8 +415,9 @@ def get_valid_archives(container, name):
     >>> remove('dirtest')
     """
     valid_entries = []
+    archive_re = get_archive_re(name)
     for entry in sorted(os.listdir(container)):
-        matched = re.match(rf"^{name}\.(\d+)\.tar(\.gz)?$", entry)
+        matched = archive_re.match(entry)
         if matched is None:
             continue
         match = matched.groups()[0]
@@ -392,12 +474,13 @@ def rotate_directories(container, name):
         new_name = f"{name}.{new_num}"
         logger.info("Renaming %s to %s.", directory, new_name)
         os.rename(os.path.join(container, directory), os.path.join(container, new_name))
+    catalog.invalidate(container)
 
 
 def rotate_archives(container, name):
     """Rotate archive files in container that start with 'name'.
 
-    Both tar and tar.gz are accepted.
+    Both tar and compressed archives like tar.gz are accepted.
 
     Note: timestamps are not handled here.  This function is not used
     in scenarios that use timestamps.
@@ -434,15 +517,19 @@ def rotate_archives(container, name):
     previous_backups = get_valid_archives(container, name)
     sorted_backups = sorted(previous_backups, key=archive_backup_key)
     # Rotate the directories.
+    archive_re = get_archive_re(name)
     for entry in sorted_backups:
-        matched = re.match(rf"^{name}\.(\d+)\.tar(\.gz)?$", entry)
-        old_num, gz = matched.groups()
+        matched = archive_re.match(entry)
+        old_num, suffix = matched.groups()
         new_num = int(old_num) + 1
-        if gz is None:
-            gz = ""
-        new_name = f"{name}.{new_num}.tar{gz}"
+        new_name = f"{name}.{new_num}.{suffix}"
         logger.info("Renaming %s to %s.", entry, new_name)
         os.rename(os.path.join(container, entry), os.path.join(container, new_name))
+        for sidecar in SIDECAR_SUFFIXES:
+            sidecar_path = os.path.join(container, entry + sidecar)
+            if os.path.exists(sidecar_path):
+                os.rename(sidecar_path, os.path.join(container, new_name + sidecar))
+    catalog.invalidate(container)
 
 
 def get_blob_backup_dirs(backup_location, only_timestamps=False):
@@ -451,46 +538,47 @@ def get_blob_backup_dirs(backup_location, only_timestamps=False):
     If only_timestamps is True, we only return backups that have timestamps.
     That is useful when restoring.
     """
-    filenames = sorted(os.listdir(backup_location))
+    entries = catalog.list_entries(backup_location)
     logger.debug(
         "Looked up filenames in the target dir: %s found. %r.",
-        len(filenames),
-        filenames,
+        len(entries),
+        [entry.name for entry in entries],
     )
     backup_dirs = []
     prefix = ""
-    for filename in filenames:
+    parse = get_backup_name_parser()
+    for entry in entries:
         # We only want directories of the form prefix.X, where X is an
         # integer or a timestamp.  There should not be anything else,
         # but we like to be safe.
+        filename = entry.name
         full_path = os.path.join(backup_location, filename)
-        if not os.path.isdir(full_path):
+        if not entry.is_dir:
             continue
         if filename in (os.curdir, os.pardir):
             # These should not be listed by os.listdir, but again: we
             # like to be safe.
             continue
-        parts = get_prefix_and_number(filename)
-        if parts is None:
+        name = parse(filename)
+        if name is None:
             continue
-        num = parts[1]
+        num = name.number
         if only_timestamps and not is_time_stamp(num):
             continue
         if prefix:
-            if parts[0] != prefix:
+            if name.prefix != prefix:
                 logger.error(
                     "Different backup prefixes found in %s (%s, %s). Are you "
                     "mixing two backups in one directory? For safety we will "
                     "exit, because we cannot get a correct sort order.",
                     backup_location,
                     prefix,
-                    parts[0],
+                    name.prefix,
                 )
                 sys.exit(1)
         else:
-            prefix = parts[0]
-        mod_time = os.path.getmtime(full_path)
-        backup_dirs.append((num, mod_time, full_path))
+            prefix = name.prefix
+        backup_dirs.append((num, entry.mtime, full_path))
     # We always sort by backup number:
     backup_dirs = sorted(backup_dirs, key=first_number_key, reverse=True)
     # Check if this is the same as reverse sorting by modification time:
@@ -514,55 +602,56 @@ def get_blob_backup_archives(
 ):
     """Get blob backup archive files from this location.
 
-    Archives may be .tar or .tar.gz files.
-    Or delta.tar or delta.tar.gz files.
+    Archives may be .tar or compressed .tar.gz (or other codec) files.
+    Or delta.tar or delta.tar.gz (or other codec) files.
     If include_snapshot_files is true, it can be .snar files.
     We return all.
 
     If only_timestamps is True, we only return backups that have timestamps.
     That is useful when restoring.
     """
-    filenames = sorted(os.listdir(backup_location))
+    entries = catalog.list_entries(backup_location)
     logger.debug(
         "Looked up filenames in the target dir: %s found. %r.",
-        len(filenames),
-        filenames,
+        len(entries),
+        [entry.name for entry in entries],
     )
     backup_archives = []
-    suffixes = ["delta.tar.gz", "delta.tar", "tar.gz", "tar"]
+    suffixes = compression.archive_suffixes(delta=True)
     if include_snapshot_files:
         suffixes += ["snar"]
     prefix = ""
-    for filename in filenames:
+    parse = get_backup_name_parser(suffixes=suffixes)
+    for entry in entries:
         # We only want files of the form prefix.X.tar.gz, where X is an
         # integer or a timestamp.  There should not be anything else,
         # but we like to be safe.
         # For the deltas, there can be only timestamps, so we might optimize.
+        filename = entry.name
         full_path = os.path.join(backup_location, filename)
-        if not os.path.isfile(full_path):
+        if entry.is_dir:
             continue
-        parts = get_prefix_and_number(filename, suffixes=suffixes)
-        if parts is None:
+        name = parse(filename)
+        if name is None:
             continue
-        num = parts[1]
+        num = name.number
         if only_timestamps and not is_time_stamp(num):
             continue
         if prefix:
-            if parts[0] != prefix:
+            if name.prefix != prefix:
                 logger.error(
                     "Different backup prefixes found in %s (%s, %s). Are you "
                     "mixing two backups in one directory? For safety we will "
                     "exit, because we cannot get a correct sort order.",
                     backup_location,
                     prefix,
-                    parts[0],
+                    name.prefix,
                 )
                 sys.exit(1)
         else:
-            prefix = parts[0]
+            prefix = name.prefix
 
-        mod_time = os.path.getmtime(full_path)
-        backup_archives.append((num, mod_time, full_path))
+        backup_archives.append((num, entry.mtime, full_path))
 
     # We always sort by backup number:
     backup_archives = sorted(backup_archives, key=first_number_key, reverse=True)
@@ -616,7 +705,7 @@ def get_latest_filestorage_timestamp(directory):
         logger.debug("Not a directory: %s", directory)
         return
     # newest file first.
-    for fname in sorted(os.listdir(directory), reverse=True):
+    for fname in reversed(catalog.list_names(directory)):
         if not is_data_file(fname):
             continue
         root, ext = os.path.splitext(fname)
@@ -636,27 +725,50 @@ def get_full_filestorage_timestamp(directory, timestamp=None):
 
     Adapted from find_files in ZODB/scripts/repozo.py.
     """
+    index = get_filestorage_index(directory)
+    if index is None:
+        return
+    if timestamp is None:
+        # Just return the oldest one.
+        paths = [index.paths[index.fulls[0]]] if index.fulls else None
+    else:
+        paths = index.find_full(timestamp)
+    if paths:
+        return os.path.splitext(os.path.basename(paths[0]))[0]
+
+
+def is_full_filestorage_backup(path):
+    return path.endswith((".fs", ".fsz"))
+
+
+def get_filestorage_index(directory):
+    """Get a BackupIndex of the filestorage backups in directory.
+
+    Returns None when directory does not exist.
+    """
     if not directory or not os.path.isdir(directory):
         return
-    # oldest first
-    found = None
-    for fname in sorted(os.listdir(directory)):
-        if not is_data_file(fname):
-            continue
-        root, ext = os.path.splitext(fname)
-        if ext not in (".fs", ".fsz"):
-            # We are not interested in deltas.
-            continue
-        # We have found a timestamp of a full backup.  Now compare it.
-        if timestamp is None:
-            # Just return the oldest one.
-            found = root
-            break
-        if timestamp >= root:
-            found = root
-        else:
-            break
-    return found
+    # The names are timestamps, so this is oldest first.
+    names = [fname for fname in catalog.list_names(directory) if is_data_file(fname)]
+    return BackupIndex(
+        [os.path.splitext(fname)[0] for fname in names],
+        [os.path.join(directory, fname) for fname in names],
+        is_full_filestorage_backup,
+    )
+
+
+def find_filestorage_backups_to_restore(directory, date_string=None):
+    """Find the filestorage backup files that repozo restores.
+
+    This is the full backup (.fs or .fsz) at or before the date, followed
+    by the deltas (.deltafs or .deltafsz) up to the date, oldest first.
+    Without date we take the newest backups.  Returns None when there
+    is no full backup.
+    """
+    index = get_filestorage_index(directory)
+    if index is None:
+        return
+    return index.find_full(date_string or None)
 
 
 def get_actual_snar(directory, base_name, timestamp=None):
@@ -668,7 +780,7 @@ def get_actual_snar(directory, base_name, timestamp=None):
         return
     # oldest first
     found = None
-    for fname in sorted(os.listdir(directory)):
+    for fname in catalog.list_names(directory):
         root, ext = os.path.splitext(fname)
         if ext != ".snar":
             continue
@@ -752,6 +864,43 @@ def find_snapshot_archive(
     return snapshot_archive
 
 
+def find_previous_manifest(fs_backup_location, destination, timestamp, full=False):
+    """Find the previous archive with a manifest, to make a delta on.
+
+    This is for incremental backups with the native blob engine.
+    Returns the path of the newest archive before timestamp, when it
+    has a manifest, and belongs to the same full filestorage backup.
+    Returns None when we should make a full archive.
+    """
+    if full or timestamp is None:
+        return
+    full_stamp = None
+    if fs_backup_location:
+        full_stamp = get_full_filestorage_timestamp(fs_backup_location, timestamp)
+        if full_stamp is None or full_stamp == timestamp:
+            # There is no proper Data.fs backup belonging to the timestamp,
+            # or a full backup is in progress.
+            return
+    if not os.path.isdir(destination):
+        return
+    # Newest first.
+    for num, mod_time, path in get_blob_backup_archives(
+        destination, only_timestamps=True
+    ):
+        if num >= timestamp:
+            continue
+        if full_stamp is not None and num < full_stamp:
+            break
+        if os.path.exists(manifest.get_manifest_path(path)):
+            return path
+        # This archive was made without manifest, so we cannot add to it.
+        break
+    logger.info(
+        "Not making incremental blob backup, because there is no previous "
+        "archive with a manifest.  Making a full archive with a manifest."
+    )
+
+
 def backup_blobs(
     source,
     destination,
@@ -766,6 +915,15 @@ def backup_blobs(
     compress_blob=False,
     incremental_blobs=False,
     rsync_hard_links_on_first_copy=False,
+    blob_engine="rsync",
+    immutable_blobs=False,
+    copy_workers=1,
+    background_delete=False,
+    rsync_workers=1,
+    compress_workers=1,
+    compress_level=6,
+    blob_compression="",
+    blob_index=False,
 ):
     """Copy blobs from source to destination.
 
@@ -782,6 +940,10 @@ def backup_blobs(
     With 'use_rsync' at the default True, we use rsync to copy,
     otherwise we use shutil.copytree.  This is mostly there for
     systems that don't have rsync available.  rsync is recommended.
+    With copy_workers larger than 1, we copy with that many threads.
+    With rsync_workers larger than 1, we run that many rsync processes
+    at the same time, each on a part of the blobstorage.  When one of
+    them fails, we return True.
 
     Note that we end up with something like var/blobstorage copied to
     var/blobbackups/blobstorage.0/blobstorage.  We could copy the
@@ -799,7 +961,14 @@ def backup_blobs(
     With timestamps True, we do not make blobstorage.0, but use timestamps,
     for example blobstorage.2017-01-02-03-04-05.
 
-    For tests, see tests/backup_blobs_dir.rst.
+    With blob_engine 'native' we do not call rsync, but create the hard
+    links ourselves, see the blobtree module.  'use_rsync' is ignored then.
+    With immutable_blobs True as well, blob files are compared by name only,
+    and directories that have not changed since the previous backup are
+    not even listed.
+
+    For tests, see tests/backup_blobs_dir.rst and
+    tests/backup_blobs_native.rst.
     """
     source = source.rstrip(os.sep)
     base_name = os.path.basename(source)
@@ -814,6 +983,12 @@ def backup_blobs(
             compress_blob=compress_blob,
             incremental_blobs=incremental_blobs,
             full=full,
+            blob_engine=blob_engine,
+            copy_workers=copy_workers,
+            compress_workers=compress_workers,
+            compress_level=compress_level,
+            blob_compression=blob_compression,
+            blob_index=blob_index,
         )
         return
 
@@ -848,6 +1023,7 @@ def backup_blobs(
                     keep_blob_days,
                     fs_backup_location=fs_backup_location,
                     latest=latest,
+                    background_delete=background_delete,
                 )
                 return
         else:
@@ -857,7 +1033,86 @@ def backup_blobs(
         rotate_directories(destination, base_name)
         prev = os.path.join(destination, base_name + ".1")
         dest = os.path.join(destination, base_name + ".0")
-    if use_rsync:
+    if blob_engine == "native":
+        if prev and os.path.isdir(prev):
+            link_dest = os.path.join(prev, base_name)
+        elif rsync_hard_links_on_first_copy:
+            # Hard link against the original files.
+            link_dest = source
+        else:
+            link_dest = None
+        target = os.path.join(dest, base_name)
+        if link_dest:
+            logger.info(
+                "Snapshotting %s to %s, linking to %s", source, target, link_dest
+            )
+        else:
+            logger.info("Snapshotting %s to %s", source, target)
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        dir_state = prev_state = listing = None
+        if immutable_blobs:
+            # Record the directory modification times, so the next backup
+            # can skip listing directories that have not changed.
+            dir_state = blobtree.DirState(started_ns=time.time_ns())
+            if prev and os.path.isdir(prev):
+                prev_state = blobtree.read_dir_state(
+                    os.path.join(prev, blobtree.DIR_STATE_FILE)
+                )
+            # Collect the files for the blob list while snapshotting.
+            listing = []
+        try:
+            stats = blobtree.snapshot_tree(
+                source,
+                target,
+                prev=link_dest,
+                immutable=immutable_blobs,
+                prev_state=prev_state,
+                state=dir_state,
+                listing=listing,
+            )
+            if dir_state is not None:
+                blobtree.write_dir_state(
+                    os.path.join(dest, blobtree.DIR_STATE_FILE), dir_state
+                )
+            if immutable_blobs:
+                write_snapshot_blob_list(dest, target, listing, prev)
+        except OSError as exc:
+            logger.error("Snapshotting %s failed: %s", source, exc)
+            return
+        logger.info(
+            "Snapshot done: %d files, %d hard linked, %d copied (%d bytes).",
+            stats.files,
+            stats.linked,
+            stats.copied,
+            stats.bytes_copied,
+        )
+        if stats.pruned:
+            logger.info(
+                "Skipped listing %d unchanged directories out of %d.",
+                stats.pruned,
+                stats.dirs,
+            )
+    elif use_rsync and int(rsync_workers) > 1:
+        if prev and os.path.isdir(prev):
+            link_dest = os.path.join(prev, base_name)
+        elif rsync_hard_links_on_first_copy:
+            link_dest = source
+        else:
+            link_dest = None
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        failed = rsync_sharded(
+            source,
+            os.path.join(dest, base_name),
+            options=rsync_options,
+            link_dest=link_dest,
+            workers=rsync_workers,
+        )
+        if failed:
+            logger.error("rsync failed for %d part(s) of %s.", failed, source)
+            return True
+    elif use_rsync:
         if prev and os.path.exists(prev):
             # Make a 'partial' backup by reusing the previous backup.  We
             # might not want to do this for full backups, but this is a
@@ -892,10 +1147,8 @@ def backup_blobs(
                     options=rsync_options, source=source, dest=dest
                 )
         logger.info(cmd)
-        output, failed = utils.system(cmd)
-        if output:
-            print(output)
-        if failed:
+        result = utils.run(cmd)
+        if result.returncode:
             return
     else:
         if not os.path.exists(dest):
@@ -904,7 +1157,9 @@ def backup_blobs(
             os.makedirs(dest)
         target = os.path.join(dest, base_name)
         logger.info("Copying %s to %s", source, target)
-        shutil.copytree(source, target)
+        copy_tree(source, target, copy_workers)
+    # We have written a new backup.
+    catalog.invalidate(destination)
     # Now possibly remove old backups and remove/create latest symlink.
     if timestamps and not incremental_blobs:
         # Creating a symlink to the latest blob backup only makes sense in this combination.
@@ -918,13 +1173,155 @@ def backup_blobs(
         keep_blob_days,
         fs_backup_location=fs_backup_location,
         latest=latest,
+        background_delete=background_delete,
+    )
+
+
+def copy_tree(source, destination, copy_workers=1):
+    """Copy a directory tree, possibly with several threads."""
+    copy_workers = int(copy_workers)
+    if copy_workers <= 1:
+        shutil.copytree(source, destination)
+        return
+    logger.debug("Copying with %d threads.", copy_workers)
+    stats = blobtree.copy_tree(source, destination, workers=copy_workers)
+    logger.info(
+        "Copied %d files (%d bytes) in %d directories.",
+        stats.files,
+        stats.bytes_copied,
+        stats.dirs,
+    )
+
+
+def get_rsync_shards(source, min_shards, max_depth=RSYNC_SHARDS_MAX_DEPTH):
+    """Split a directory tree in parts that can be synced separately.
+
+    Returns a tuple of two lists with paths relative to source.
+    The first list has the directories whose direct contents we sync
+    non-recursively, parents before children.  The second list has the
+    shards: directories that we sync recursively.  An empty string stands
+    for the source itself.
+
+    We go one level deeper as long as we have less than min_shards
+    shards.  In the bushy layout all blobs are usually in one top level
+    directory 0x00, so only looking at the top level would not help.
+    """
+    frames = []
+    level = [""]
+    depth = 0
+    while len(level) < min_shards and depth < max_depth:
+        subdirs = []
+        for rel in level:
+            path = os.path.join(source, rel)
+            for name in sorted(os.listdir(path)):
+                full_path = os.path.join(path, name)
+                if os.path.isdir(full_path) and not os.path.islink(full_path):
+                    subdirs.append(os.path.join(rel, name))
+        if not subdirs:
+            break
+        frames.extend(level)
+        level = subdirs
+        depth += 1
+    return frames, level
+
+
+def get_rsync_shard_command(
+    source, destination, rel, options="", link_dest=None, recursive=True
+):
+    """Get rsync command for syncing one part of a directory tree.
+
+    This is a list of arguments.  We always use --delete: files that are not in the source
+    should not be in the destination.
+    """
+    parts = ["rsync", "-a"]
+    if not recursive:
+        # Only sync the direct contents of this directory.
+        # Subdirectories are created, but not filled.
+        parts.extend(["--no-recursive", "--dirs"])
+    if options:
+        parts.extend(shlex.split(options))
+    parts.append("--delete")
+    if link_dest:
+        link_dir = os.path.join(link_dest, rel)
+        # rsync complains when this does not exist.
+        if os.path.isdir(link_dir):
+            parts.append("--link-dest=" + os.path.abspath(link_dir))
+    # The trailing slashes are important.
+    parts.append(os.path.join(source, rel, ""))
+    parts.append(os.path.join(destination, rel, ""))
+    return parts
+
+
+def rsync_sharded(source, destination, options="", link_dest=None, workers=2):
+    """Sync source to destination with several rsync processes at the same time.
+
+    One rsync process needs to build a list of all files, which takes
+    a lot of memory and is done on one processor core.  So we split
+    the tree with get_rsync_shards, and sync the parts separately.
+    Top level files like .layout are synced in the first non-recursive
+    pass.
+
+    When link_dest is given, unchanged files are hard linked to the same
+    files in that directory.
+
+    The output of rsync is shown while it runs.
+    Returns the number of failed rsync processes.
+    """
+    workers = int(workers)
+    source = source.rstrip(os.sep)
+    destination = destination.rstrip(os.sep)
+    frames, shards = get_rsync_shards(source, workers * RSYNC_SHARDS_PER_WORKER)
+    logger.info(
+        "Running rsync with %d processes for %d parts of %s.",
+        workers,
+        len(shards),
+        source,
+    )
+    # Parents must be done before their children, because rsync only
+    # creates the last directory of the destination path.
+    by_depth = {}
+    for rel in frames:
+        depth = rel.count(os.sep) + 1 if rel else 0
+        by_depth.setdefault(depth, []).append(rel)
+    batches = [
+        [
+            get_rsync_shard_command(
+                source, destination, rel, options, link_dest, recursive=False
+            )
+            for rel in by_depth[depth]
+        ]
+        for depth in sorted(by_depth)
+    ]
+    batches.append(
+        [
+            get_rsync_shard_command(source, destination, rel, options, link_dest)
+            for rel in shards
+        ]
     )
+    failed = 0
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for commands in batches:
+            for cmd in commands:
+                logger.debug(" ".join(cmd))
+            for result in executor.map(utils.run, commands):
+                if result.returncode:
+                    logger.error(
+                        "rsync failed with exit code %d: %s",
+                        result.returncode,
+                        " ".join(result.command),
+                    )
+                    failed += 1
+            if failed:
+                # Do not continue with the children.
+                break
+    return failed
 
 
 def find_timestamped_filename(destination, filename):
-    # compress_blob may be on now, or may have been on in the past.
-    # Look for both.  And look for deltas too.
-    for suffix in ("tar", "tar.gz", "delta.tar", "delta.tar.gz"):
+    # compress_blob may be on now, or may have been on in the past,
+    # possibly with a different codec.  Look for all.
+    # And look for deltas too.
+    for suffix in compression.archive_suffixes(delta=True):
         fname = f"{filename}.{suffix}"
         dest = os.path.join(destination, fname)
         # If a backup already exists, then apparently there were no
@@ -939,6 +1336,29 @@ def find_timestamped_filename(destination, filename):
             return dest
 
 
+def write_snapshot_blob_list(dest, target, listing, prev=None):
+    """Write the blob list of the snapshot in target to the dest directory.
+
+    listing is what blobtree.snapshot_tree listed while making the
+    snapshot, so we do not walk it again.  Sizes of blob files that it
+    linked without calling stat are taken from the list of the previous
+    snapshot.  restore_mode 'diff' reads the list, instead of walking
+    the snapshot.
+    """
+    prev_list = None
+    if prev and os.path.isdir(prev):
+        prev_list = bloblist.read_blob_list(os.path.join(prev, bloblist.BLOB_LIST_FILE))
+    blob_list = bloblist.from_listing(target, listing, prev=prev_list)
+    bloblist.write_blob_list(os.path.join(dest, bloblist.BLOB_LIST_FILE), blob_list)
+    if prev_list is not None:
+        prev_list.close()
+    logger.info(
+        "Wrote list of %d blob files and %d other files.",
+        len(blob_list.oids),
+        len(blob_list.others),
+    )
+
+
 def backup_blobs_archive(
     source,
     destination,
@@ -948,6 +1368,12 @@ def backup_blobs_archive(
     compress_blob=False,
     incremental_blobs=False,
     full=False,
+    blob_engine="rsync",
+    copy_workers=1,
+    compress_workers=1,
+    compress_level=6,
+    blob_compression="",
+    blob_index=False,
 ):
     """Make archive from blobs in source directory.
 
@@ -957,6 +1383,23 @@ def backup_blobs_archive(
 
     We use 'keep' to simply keep the last X backups.
 
+    With blob_engine 'native' we write the archive with the tarfile module
+    instead of calling tar, reading files with copy_workers threads.
+    Incremental archives then get a manifest instead of a tar snapshot
+    file, see the manifest module.
+
+    With compress_blob and compress_workers larger than 1, we compress
+    with that many threads at compress_level, also when calling tar.
+
+    blob_compression is a codec name with optional level, like 'zstd:3'.
+    When set, this codec is used instead of gzip, also when compress_blob
+    is false.  See the compression module.
+
+    With blob_index we write an index next to the archive, so single
+    blobs can be restored quickly.  Compressed archives are then
+    compressed in blocks, by us instead of by tar.  Archives that
+    tar compresses itself get no index.  See blobarchive.
+
     For tests, see tests/backup_blobs_archive.rst.
     """
     if incremental_blobs and not timestamps:
@@ -968,6 +1411,9 @@ def backup_blobs_archive(
     if not os.path.exists(destination):
         os.makedirs(destination)
     tar_options = ""
+    # With the native engine, incremental archives use manifests.
+    use_manifest = incremental_blobs and blob_engine == "native"
+    previous_manifest = None
     if timestamps:
         timestamp = get_latest_filestorage_timestamp(fs_backup_location)
         if timestamp:
@@ -991,7 +1437,15 @@ def backup_blobs_archive(
         else:
             timestamp = gen_timestamp()
             filename = f"{base_name}.{timestamp}"
-        if incremental_blobs:
+        if use_manifest:
+            previous_archive = find_previous_manifest(
+                fs_backup_location, destination, timestamp, full=full
+            )
+            if previous_archive is not None:
+                previous_manifest = manifest.read_manifest(previous_archive)
+            if previous_manifest is not None:
+                filename += ".delta"
+        elif incremental_blobs:
             # Get the timestamp of the latest full backup,
             # if we have a snapshot archive for it.
             snapshot_archive = find_snapshot_archive(
@@ -1007,26 +1461,108 @@ def backup_blobs_archive(
                     # The snapshot archive exists, so this is a delta backup.
                     # File name should be blobs.timestamp.delta.tar(.gz).
                     filename += ".delta"
-        filename += ".tar"  # .gz may be added a few lines later.
+        filename += ".tar"  # .gz (or similar) may be added a few lines later.
         dest = os.path.join(destination, filename)
     else:
         # Without timestamps we need to rotate backups.
         rotate_archives(destination, base_name)
         dest = os.path.join(destination, base_name + ".0.tar")
-    if compress_blob:
-        dest += ".gz"
-        tar_command = "tar czf"
-    else:
-        tar_command = "tar cf"
+    compress_workers = int(compress_workers)
+    codec, level = compression.parse_compression(blob_compression)
+    if codec is None and compress_blob:
+        codec = compression.get_codec(compression.DEFAULT_CODEC)
+    if level is None and codec is not None:
+        if codec.name == compression.DEFAULT_CODEC:
+            level = int(compress_level)
+        else:
+            level = codec.default_level
+    if codec is not None:
+        dest += "." + codec.extension
     if os.path.exists(dest):
         raise Exception(f"Path already exists: {dest}")
-    cmd = f"{tar_command} {dest} {tar_options} -C {source} ."
-    logger.info(cmd)
-    output, failed = utils.system(cmd)
-    if output:
-        print(output)
-    if failed:
-        return
+    if blob_engine == "native" and not tar_options:
+        new_manifest = paths = None
+        if use_manifest:
+            new_manifest = manifest.make_manifest(
+                os.path.basename(dest), manifest.scan_tree(source), previous_manifest
+            )
+            if new_manifest.is_delta:
+                paths = new_manifest.get_changed()
+                logger.info(
+                    "Writing delta archive %s with %d new or changed files "
+                    "and %d removed files.",
+                    dest,
+                    len(paths),
+                    len(new_manifest.deleted),
+                )
+        if paths is None:
+            logger.info("Writing archive %s from %s", dest, source)
+        try:
+            stats = blobarchive.write_archive(
+                source,
+                dest,
+                workers=copy_workers,
+                compresslevel=level,
+                compress_workers=compress_workers,
+                codec=codec,
+                index=blob_index,
+                paths=paths,
+            )
+        except OSError as exc:
+            logger.error("Writing archive %s failed: %s", dest, exc)
+            return
+        if new_manifest is not None:
+            manifest.forget_files(new_manifest, stats.missing)
+            manifest.write_manifest(dest, new_manifest)
+        logger.info(
+            "Archived %d files (%d bytes) in %d directories, archive size %d bytes.",
+            stats.files,
+            stats.bytes_read,
+            stats.dirs,
+            stats.bytes_written,
+        )
+    elif codec is not None and (
+        compress_workers > 1 or codec.name != compression.DEFAULT_CODEC or blob_index
+    ):
+        # Let tar write to stdout, and compress this ourselves.
+        cmd = f"tar cf - {tar_options} -C {source} ."
+        logger.info(cmd)
+        logger.info(
+            "Compressing to %s with %s level %d, using %d threads.",
+            dest,
+            codec.name,
+            level,
+            compress_workers,
+        )
+        try:
+            returncode = blobarchive.compress_command_output(
+                shlex.split(cmd),
+                dest,
+                workers=compress_workers,
+                compresslevel=level,
+                codec=codec,
+                index=blob_index,
+            )
+        except (OSError, RuntimeError) as exc:
+            logger.error("Writing archive %s failed: %s", dest, exc)
+            return
+        if returncode:
+            logger.error("tar failed with exit code %d.", returncode)
+            return
+    else:
+        tar_command = "tar czf" if codec is not None else "tar cf"
+        cmd = f"{tar_command} {dest} {tar_options} -C {source} ."
+        logger.info(cmd)
+        result = utils.run(cmd)
+        if result.returncode:
+            return
+        if blob_index and codec is None:
+            try:
+                blobarchive.index_tar_archive(dest)
+            except (OSError, tarfile.TarError) as exc:
+                logger.warning("Could not write index for %s: %s", dest, exc)
+    # We have written a new backup.
+    catalog.invalidate(destination)
     # Now possibly remove old backups and remove/create latest symlink.
     if timestamps and not incremental_blobs:
         # Creating a symlink to the latest blob backup only makes sense in this combination.
@@ -1045,11 +1581,39 @@ def is_full_tarball(path):
     """
     if ".delta." in path:
         return False
-    if path.endswith(".tar") or path.endswith(".tar.gz"):
-        return True
+    for suffix in compression.archive_suffixes():
+        if path.endswith("." + suffix):
+            return True
     return False
 
 
+# Kinds of archive files, see get_archive_kind.
+FULL = "full"
+DELTA = "delta"
+SNAR = "snar"
+
+
+@functools.cache
+def get_archive_kind_matcher(suffixes):
+    """Get a compiled search for the suffix of a full tarball."""
+    return re.compile("(?:" + "|".join(map(re.escape, suffixes)) + r")\Z").search
+
+
+def get_archive_kind(path):
+    """Get the kind of archive file: full, delta, snar, or None.
+
+    This uses the same checks as is_snar, is_delta and is_full_tarball,
+    in one go.
+    """
+    if path.endswith(".snar"):
+        return SNAR
+    if ".delta." in path:
+        return DELTA
+    suffixes = normalize_suffixes(compression.archive_suffixes())
+    if get_archive_kind_matcher(suffixes)(path) is not None:
+        return FULL
+
+
 def is_snar(path):
     """Is this a snapshot archive file?"""
     return path.endswith(".snar")
@@ -1081,72 +1645,124 @@ def combine_backups(backups):
     """
     if not backups:
         return []
+    kinds = [get_archive_kind(path) for num, mod_time, path in backups]
     # This function is only useful if there are incremental archives.
-    has_incremental = any([1 for x in backups if is_snar(x[2]) or is_delta(x[2])])
-    if not has_incremental:
+    if SNAR not in kinds and DELTA not in kinds:
         # Put each item in a separate list.
-        result = []
-        for num, mod_time, path in backups:
-            result.append([(num, mod_time, path)])
-        return result
-    result = [[]]
-    for num, mod_time, path in backups:
-        current = (num, mod_time, path)
-        # Does this belong to the previous one?
-        previous = result[-1]
-        if not previous:
-            # obviously not
-            previous.append(current)
-            continue
-        if os.path.isdir(path):
-            # A directory is always on its own.
-            result.append([current])
-            continue
-        # So we have a previous list, and the current item is a file.
-        # Does the previous list have a tarball?
-        has_tar = any([1 for x in previous if is_full_tarball(x[2])])
-        # And a snapshot archive file?
-        has_snar = any([1 for x in previous if is_snar(x[2])])
-        if has_tar and has_snar:
-            # Must be the beginning of a new list.
-            result.append([current])
-            continue
-        if is_delta(path) and (has_tar or has_snar):
-            # Must be an older delta, so start a new list.
-            result.append([current])
-            continue
-        if path.endswith(".snar"):
-            if has_snar:
-                # Strange.  Start a new list.
-                previous = []
-                result.append(previous)
-            elif has_tar:
-                pass
-            previous.append(current)
-            continue
-        if is_full_tarball(path):
-            # Does the previous list have a tarball?
-            if has_tar:
-                # Yes, so we start a new list.
-                result.append([])
-                previous = result[-1]
-            previous.append(current)
-            continue
-        # We should have only deltas now.
-        if ".delta." not in path:
-            logger.warning("Expected .delta. in path %r.", path)
-            # This at least happens in tests, when using names
-            # for directories that do not exist.
-            # Best to keep this separate.
-            result.append([current])
-            continue
+        return [[current] for current in backups]
+    # We go through the backups once.  For the current list we remember
+    # if it has a tarball and a snapshot archive file.
+    result = []
+    previous = None
+    has_tar = has_snar = False
+    for current, kind in zip(backups, kinds):
+        if previous is not None:
+            if has_tar and has_snar:
+                # Must be the beginning of a new list.
+                previous = None
+            elif kind == SNAR:
+                if has_snar:
+                    # Strange.  Start a new list.
+                    previous = None
+            elif kind == FULL:
+                # Start a new list when the previous list has a tarball.
+                if has_tar:
+                    previous = None
+            elif kind == DELTA:
+                if has_tar or has_snar:
+                    # Must be an older delta, so start a new list.
+                    previous = None
+            else:
+                # A directory is always on its own.  We expect only
+                # deltas otherwise.
+                if not os.path.isdir(current[2]):
+                    logger.warning("Expected .delta. in path %r.", current[2])
+                    # This at least happens in tests, when using names
+                    # for directories that do not exist.
+                # Best to keep this separate.
+                previous = None
+        if previous is None:
+            previous = []
+            result.append(previous)
+            has_tar = has_snar = False
         previous.append(current)
-
-    # Filter out any empty lists.
-    result = [x for x in result if x]
+        has_tar = has_tar or kind == FULL
+        has_snar = has_snar or kind == SNAR
     return result
 
 
+class BackupIndex:
+    """Index of backups, for finding the backups at a point in time.
+
+    keys are sorted from old to new: timestamps or modification times.
+    paths are the backups belonging to the keys.  fulls are the positions
+    of the full backups.  A backup that is not full is a delta on the
+    backup before it.
+    """
+
+    __slots__ = ("keys", "paths", "fulls")
+
+    def __init__(self, keys, paths, is_full):
+        self.keys = keys
+        self.paths = paths
+        self.fulls = [pos for pos, path in enumerate(paths) if is_full(path)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_backups(cls, backups, by_mod_time=False):
+        """Make an index for the result of one of the backup getters.
+
+        By default the key is the backup number, which must be a
+        timestamp.  With by_mod_time, the key is the modification time.
+        The backups are sorted by number, so this only works when the
+        modification times are in the same order.  Otherwise we return
+        None.
+        """
+        backups = backups[::-1]
+        paths = [backup[2] for backup in backups]
+        if by_mod_time:
+            keys = [backup[1] for backup in backups]
+            if keys != sorted(keys):
+                return
+        else:
+            keys = [backup[0] for backup in backups]
+        return cls(keys, paths, lambda path: not is_delta(path))
+
+    def find_range(self, key=None):
+        """Find the positions of the backups to restore for key.
+
+        This is the newest full backup at or before key, followed by its
+        deltas up to key.  Without key we take the newest backups.
+        Returns start, end and whether start is a full backup.  When
+        there is no full backup before key, start is 0.
+        """
+        if key is None:
+            end = len(self.keys)
+        else:
+            end = bisect.bisect_right(self.keys, key)
+        pos = bisect.bisect_right(self.fulls, end - 1)
+        if not pos:
+            return 0, end, False
+        return self.fulls[pos - 1], end, True
+
+    def find(self, key=None):
+        """Find the paths of the backups to restore for key, oldest first.
+
+        When there is no full backup before key, we return all deltas
+        before key, like find_conditional_backups_to_restore.
+        """
+        start, end, full = self.find_range(key)
+        return self.paths[start:end]
+
+    def find_full(self, key=None):
+        """Like find, but return None when there is no full backup."""
+        start, end, full = self.find_range(key)
+        if full:
+            return self.paths[start:end]
+
+
 def find_conditional_backups_to_restore(backups, tester=None):
     # We could get deltas, and then we should return several,
     # so we keep a list.
@@ -1206,23 +1822,25 @@ def find_backup_to_restore(source, date_string="", archive=False, timestamps=Fal
     # specifies a timestamp in between, this is an error of the user.
     if timestamps:
         ts_backups = backup_getter(source, only_timestamps=True)
-
-        def tester(num, mod_time, directory):
-            # Both num and date_string are timestamps, so we can compare them.
-            return num <= date_string
-
-        paths = find_conditional_backups_to_restore(ts_backups, tester)
+        # Both the numbers and date_string are timestamps, so we can
+        # compare them.
+        paths = BackupIndex.from_backups(ts_backups).find(date_string)
         if paths:
             return paths
 
     # If timestamps are not used, or do not give a result,
     # we fall back to comparing modification times.
     # Note that in tests, the modification times will be very close together.
-    def tester(num, mod_time, directory):
-        backup_time = datetime.utcfromtimestamp(mod_time)
-        return backup_time <= target_datetime
+    target_time = target_datetime.replace(tzinfo=timezone.utc).timestamp()
+    index = BackupIndex.from_backups(current_backups, by_mod_time=True)
+    if index is not None:
+        paths = index.find(target_time)
+    else:
+
+        def tester(num, mod_time, directory):
+            return mod_time <= target_time
 
-    paths = find_conditional_backups_to_restore(current_backups, tester)
+        paths = find_conditional_backups_to_restore(current_backups, tester)
     if paths:
         return paths
 
@@ -1237,6 +1855,10 @@ def restore_blobs(
     timestamps=False,
     only_check=False,
     incremental_blobs=False,
+    copy_workers=1,
+    background_delete=False,
+    rsync_workers=1,
+    restore_mode="copy",
 ):
     """Restore blobs from source to destination.
 
@@ -1244,6 +1866,16 @@ def restore_blobs(
     otherwise we use shutil.copytree.  This is mostly there for
     systems that don't have rsync available.  rsync is recommended.
 
+    With restore_mode 'hardlink', and when the backup is on the same
+    file system as the destination, we hard link the files of the backup
+    instead of copying them.  Otherwise we copy as usual.
+    With restore_mode 'diff' we compare the destination with the backup,
+    and only restore the files that are missing and remove the files that
+    are not in the backup.
+    With copy_workers larger than 1, we copy with that many threads.
+    With rsync_workers larger than 1, we run that many rsync processes
+    at the same time, each on a part of the blobstorage.
+
     We could remove the destination first (with
     'shutil.rmtree(destination)'), but an 'rsync -a  --delete' works
     faster.
@@ -1289,7 +1921,14 @@ def restore_blobs(
     if archive_blob and archive_source:
         # We want an archive and have found an archive.
         result = restore_blobs_archive(
-            source, destination, date, timestamps=timestamps, only_check=only_check
+            source,
+            destination,
+            date,
+            timestamps=timestamps,
+            only_check=only_check,
+            background_delete=background_delete,
+            copy_workers=copy_workers,
+            restore_mode=restore_mode,
         )
         return result
 
@@ -1321,22 +1960,158 @@ def restore_blobs(
 
     # You should end up with something like this:
     # rsync -a  --delete var/blobstoragebackups/blobstorage.0/blobstorage var/
-    if use_rsync:
+    if restore_mode == "diff":
+        return restore_diff(backup_source, destination)
+    if restore_mode == "hardlink":
+        if blobtree.same_device(backup_source, destination):
+            return restore_hard_links(
+                backup_source, destination, background_delete=background_delete
+            )
+        logger.warning(
+            "Cannot hard link: %s and %s are on different file systems. "
+            "Copying instead.",
+            backup_source,
+            destination,
+        )
+    if use_rsync and int(rsync_workers) > 1:
+        failed = rsync_sharded(
+            backup_source, destination, options=rsync_options, workers=rsync_workers
+        )
+        if failed:
+            logger.error("rsync failed for %d part(s) of %s.", failed, backup_source)
+            return True
+    elif use_rsync:
         cmd = "rsync -a {options} --delete {source} {dest}".format(
             options=rsync_options, source=backup_source, dest=dest_dir
         )
         logger.info(cmd)
-        output, failed = utils.system(cmd)
-        if output:
-            print(output)
-        if failed:
+        result = utils.run(cmd)
+        if result.returncode:
             return
     else:
         if os.path.exists(destination):
             logger.info("Removing %s", destination)
-            shutil.rmtree(destination)
+            trash.remove_tree(destination, deferred=background_delete)
         logger.info("Copying %s to %s", backup_source, destination)
-        shutil.copytree(backup_source, destination)
+        copy_tree(backup_source, destination, copy_workers)
+
+
+def restore_hard_links(backup_source, destination, background_delete=False):
+    """Restore a blob backup directory by hard linking its files.
+
+    We make the new tree next to the destination, and then replace the
+    destination, so the blobstorage is complete at all times, except
+    for the moment between removing the old and renaming the new one.
+    Files that cannot be hard linked are copied.
+
+    Returns True when there is an error.
+    """
+    tmp_destination = destination + RESTORE_TMP_SUFFIX
+    if os.path.exists(tmp_destination):
+        trash.remove_tree(tmp_destination)
+    logger.info("Hard linking %s to %s", backup_source, destination)
+    try:
+        stats = blobtree.snapshot_tree(
+            backup_source, tmp_destination, prev=backup_source
+        )
+    except OSError as exc:
+        logger.error("Hard linking %s failed: %s", backup_source, exc)
+        if os.path.exists(tmp_destination):
+            trash.remove_tree(tmp_destination)
+        return True
+    if os.path.exists(destination):
+        logger.info("Removing %s", destination)
+        trash.remove_tree(destination, deferred=background_delete)
+    os.rename(tmp_destination, destination)
+    logger.info(
+        "Restore done: %d files, %d hard linked, %d copied (%d bytes).",
+        stats.files,
+        stats.linked,
+        stats.copied,
+        stats.bytes_copied,
+    )
+
+
+def remove_extra_files(destination, paths, keep_dir):
+    """Remove files from destination, and directories that become empty.
+
+    keep_dir is called with the relative path of an empty directory, and
+    returns True when we must keep it, because it is in the backup.
+    """
+    for rel in paths:
+        parts = rel.split("/")
+        try:
+            os.remove(os.path.join(destination, *parts))
+        except FileNotFoundError:
+            pass
+        parts.pop()
+        while parts and not keep_dir("/".join(parts)):
+            try:
+                os.rmdir(os.path.join(destination, *parts))
+            except OSError:
+                # Not empty, or already gone.
+                break
+            parts.pop()
+
+
+def restore_diff(backup_source, destination):
+    """Restore a blob backup directory by only changing what differs.
+
+    Files that are missing in the destination are hard linked from the
+    backup, or copied when the backup is on another file system.  Files
+    that are not in the backup are removed.  Other files are left alone,
+    so going back to a backup of a few hours ago is quick.
+
+    Returns True when there is an error.
+    """
+    wanted = bloblist.read_blob_list(
+        os.path.join(os.path.dirname(backup_source), bloblist.BLOB_LIST_FILE)
+    )
+    if wanted is None:
+        wanted = bloblist.scan(backup_source)
+    current = bloblist.scan(destination)
+    restore, remove = bloblist.diff_blob_lists(current, wanted)
+    logger.info(
+        "Comparing %s with %s: %d files to restore, %d files to remove, "
+        "%d files unchanged.",
+        destination,
+        backup_source,
+        len(restore),
+        len(remove),
+        len(wanted) - len(restore),
+    )
+    wanted.close()
+    link = blobtree.same_device(backup_source, destination)
+    stats = blobtree.TreeStats()
+    try:
+        remove_extra_files(
+            destination,
+            remove,
+            lambda rel: os.path.isdir(os.path.join(backup_source, *rel.split("/"))),
+        )
+        for rel in restore:
+            parts = rel.split("/")
+            source_path = os.path.join(backup_source, *parts)
+            dest_path = os.path.join(destination, *parts)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+            blobtree.link_or_copy(
+                source_path,
+                dest_path,
+                link_source=source_path if link else None,
+                stats=stats,
+            )
+    except OSError as exc:
+        logger.error("Restoring %s failed: %s", backup_source, exc)
+        return True
+    logger.info(
+        "Restore done: %d hard linked, %d copied (%d bytes), %d removed.",
+        stats.linked,
+        stats.copied,
+        stats.bytes_copied,
+        len(remove),
+    )
 
 
 def restore_blobs_archive(
@@ -1346,9 +2121,25 @@ def restore_blobs_archive(
     timestamps=False,
     only_check=False,
     incremental_blobs=False,
+    background_delete=False,
+    copy_workers=1,
+    restore_mode="copy",
 ):
     """Restore blobs from source to destination.
 
+    With background_delete, an existing destination is moved to a trash
+    directory next to it, and removed by a background process.
+
+    With restore_mode 'diff' we only extract the files that are missing in
+    the destination, and remove the files that are not in the archives.
+    This needs a list of the files: from the manifest, the index, or the
+    archive itself.  A chain of GNU tar incremental archives is restored
+    completely.
+
+    A chain of native incremental archives with manifests is restored in
+    one pass: each file that is in the final state is extracted once, from
+    the archive that has it, with copy_workers archives at the same time.
+
     Prepare backup for test:
 
     >>> mkdir('blobs')  # noqa F821
@@ -1403,34 +2194,317 @@ def restore_blobs_archive(
         return True
     if only_check:
         return
+    if not isinstance(backup_sources, list):
+        backup_sources = [backup_sources]
+    if restore_mode == "diff":
+        members = get_archive_members(backup_sources)
+        if members is not None:
+            return restore_archive_diff(
+                backup_sources, members, destination, workers=copy_workers
+            )
+        logger.warning(
+            "Cannot list the files in %d incremental archives without manifest. "
+            "Restoring everything.",
+            len(backup_sources),
+        )
     if os.path.exists(destination):
         logger.info("Removing %s", destination)
-        shutil.rmtree(destination)
+        trash.remove_tree(destination, deferred=background_delete)
     os.mkdir(destination)
     tar_options = ""
-    if not isinstance(backup_sources, list):
-        backup_sources = [backup_sources]
+    if len(backup_sources) > 1:
+        chain_manifest = get_chain_manifest(backup_sources)
+        if chain_manifest is not None:
+            return restore_manifest_chain(
+                backup_sources, chain_manifest, destination, workers=copy_workers
+            )
     if len(backup_sources) > 1:
         logger.info("Found %d incremental backups to restore.", len(backup_sources))
         tar_options = " --incremental"
     for backup_source in backup_sources:
         logger.info("Extracting %s to %s", backup_source, destination)
-        if backup_source.endswith("gz"):
-            tar_command = "tar xzf"
+        codec = compression.get_codec_for_path(backup_source)
+        if codec is not None and codec.name != compression.DEFAULT_CODEC:
+            # Decompress it ourselves, and let tar read from stdin.
+            cmd = f"tar xf -{tar_options} -C {destination}"
+            logger.info("Decompressing with %s: %s", codec.name, cmd)
+            try:
+                returncode = blobarchive.decompress_to_command(
+                    backup_source, shlex.split(cmd), codec
+                )
+            except (OSError, RuntimeError) as exc:
+                logger.error("Extracting %s failed: %s", backup_source, exc)
+                return True
+            if returncode:
+                return True
         else:
-            tar_command = "tar xf"
-        cmd = "{} {}{} -C {}".format(
-            tar_command, backup_source, tar_options, destination
+            if backup_source.endswith("gz"):
+                tar_command = "tar xzf"
+            else:
+                tar_command = "tar xf"
+            cmd = "{} {}{} -C {}".format(
+                tar_command, backup_source, tar_options, destination
+            )
+            logger.info(cmd)
+            result = utils.run(cmd)
+            if result.returncode:
+                return True
+        remove_deleted_files(backup_source, destination)
+
+
+def get_chain_manifest(backup_sources):
+    """Get the manifest of the last archive in a chain of archives.
+
+    Returns None when there is no manifest, or when it belongs to another
+    chain of archives, for example when an archive has been removed.
+    """
+    chain_manifest = manifest.read_manifest(backup_sources[-1])
+    if chain_manifest is None:
+        return
+    names = [os.path.basename(path) for path in backup_sources]
+    if chain_manifest.archives != names:
+        logger.warning(
+            "The manifest of %s lists other archives than we found: %r.",
+            backup_sources[-1],
+            chain_manifest.archives,
         )
-        logger.info(cmd)
-        output, failed = utils.system(cmd)
-        if output:
-            print(output)
-        if failed:
-            return True
+        return
+    return chain_manifest
+
+
+def restore_manifest_chain(backup_sources, chain_manifest, destination, workers=1):
+    """Restore a chain of native incremental archives in one pass.
+
+    The manifest of the last archive lists the files that we need, and in
+    which archive they are.  Files that have been removed or replaced
+    later in the chain are not extracted at all.
+
+    Returns True when there is an error.
+    """
+    wanted = [set() for path in backup_sources]
+    for rel, info in chain_manifest.files.items():
+        wanted[info[0]].add(rel)
+    jobs = [(path, names) for path, names in zip(backup_sources, wanted) if names]
+    logger.info(
+        "Restoring %d files from %d of %d incremental archives in one pass.",
+        len(chain_manifest.files),
+        len(jobs),
+        len(backup_sources),
+    )
+    return extract_from_archives(jobs, destination, workers=workers)
+
+
+def extract_from_archives(jobs, destination, workers=1):
+    """Extract files from archives, with several archives at the same time.
+
+    jobs is a list of tuples of archive path and a set of names.
+
+    Returns True when there is an error.
+    """
+    workers = max(min(int(workers), len(jobs)), 1)
+    failed = False
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = {
+            executor.submit(blobarchive.extract_members, path, names, destination): (
+                path,
+                names,
+            )
+            for path, names in jobs
+        }
+        for future in futures.as_completed(results):
+            path, names = results[future]
+            try:
+                found = future.result()
+            except (OSError, RuntimeError, EOFError, tarfile.TarError) as exc:
+                logger.error("Extracting %s failed: %s", path, exc)
+                failed = True
+                continue
+            logger.info("Extracted %d files from %s", len(found), path)
+            if len(found) != len(names):
+                missing = sorted(names.difference(found))
+                logger.error(
+                    "%d files are missing in %s, for example %s",
+                    len(missing),
+                    path,
+                    missing[0],
+                )
+                failed = True
+    if failed:
+        return True
+
+
+def get_archive_members(backup_sources):
+    """Get the files that are in the final state of a list of archives.
+
+    Returns a dictionary of relative path to a tuple of the number of the
+    archive that has it, size, and mtime in seconds.  Returns None for a
+    chain of archives without manifest: only tar knows which files were
+    removed along the way.
+    """
+    if len(backup_sources) > 1:
+        chain_manifest = get_chain_manifest(backup_sources)
+    else:
+        chain_manifest = manifest.read_manifest(backup_sources[0])
+    if chain_manifest is not None:
+        return {
+            rel: (number, size, mtime_ns // 10**9)
+            for rel, (number, size, mtime_ns) in chain_manifest.files.items()
+        }
+    if len(backup_sources) > 1:
+        return
+    return {
+        rel: (0, size, mtime)
+        for rel, (size, mtime) in blobarchive.list_members(backup_sources[0]).items()
+    }
+
+
+def restore_archive_diff(backup_sources, members, destination, workers=1):
+    """Restore archives by only changing what differs.
+
+    members is the result of get_archive_members.  We extract the files
+    that are missing in the destination, and remove the files that are not
+    in the archives.
+
+    Returns True when there is an error.
+    """
+    wanted = bloblist.BlobList.from_files(
+        (rel, size, mtime) for rel, (number, size, mtime) in members.items()
+    )
+    current = bloblist.scan(destination)
+    restore, remove = bloblist.diff_blob_lists(current, wanted)
+    logger.info(
+        "Comparing %s with %s: %d files to restore, %d files to remove, "
+        "%d files unchanged.",
+        destination,
+        backup_sources[-1],
+        len(restore),
+        len(remove),
+        len(wanted) - len(restore),
+    )
+    # Keep the directories that have files in the archives.
+    dirs = set()
+    for rel in members:
+        parts = rel.split("/")[:-1]
+        while parts:
+            dirs.add("/".join(parts))
+            parts.pop()
+    remove_extra_files(destination, remove, dirs.__contains__)
+    os.makedirs(destination, exist_ok=True)
+    names = [set() for path in backup_sources]
+    for rel in restore:
+        names[members[rel][0]].add(rel)
+    jobs = [(path, todo) for path, todo in zip(backup_sources, names) if todo]
+    return extract_from_archives(jobs, destination, workers=workers)
+
+
+def remove_deleted_files(archive, destination):
+    """Remove files that the manifest of a delta archive lists as deleted.
+
+    tar --incremental does this for GNU tar archives.  Native incremental
+    archives have a manifest with a list of deleted files instead.
+    """
+    delta_manifest = manifest.read_manifest(archive)
+    if delta_manifest is None or not delta_manifest.deleted:
+        return
+    logger.info(
+        "Removing %d files that were deleted before %s",
+        len(delta_manifest.deleted),
+        os.path.basename(archive),
+    )
+    for rel in delta_manifest.deleted:
+        try:
+            os.remove(os.path.join(destination, *rel.split("/")))
+        except FileNotFoundError:
+            pass
+
+
+def restore_blob_paths(
+    source,
+    destination,
+    paths,
+    date=None,
+    archive_blob=False,
+    timestamps=False,
+):
+    """Restore only some paths in the blobstorage.
 
+    paths are relative to the blobstorage, like '0x00/0x00/0x01' for the
+    directory of one object in a bushy blobstorage, or the path of a
+    single blob file.  Other files in the destination are left alone.
 
-def remove_orphaned_blob_backups(backup_location, fs_backup_location, archive=False):
+    For archives we search from the newest archive to the oldest, in case
+    of incremental backups.  When an archive has a valid index, we only
+    read the parts that we need.
+
+    Returns True when there is an error, like a path that is not found.
+
+    For tests, see tests/blob_index.rst.
+    """
+    destination = destination.rstrip(os.sep)
+    try:
+        paths = [blobarchive.check_relative_path(path) for path in paths]
+    except ValueError as exc:
+        logger.error(str(exc))
+        return True
+    restored = []
+    missing = []
+    if archive_blob:
+        backup_sources = find_backup_to_restore(
+            source, date_string=date, archive=True, timestamps=timestamps
+        )
+    else:
+        backup_sources = find_backup_to_restore(
+            source, date_string=date, timestamps=timestamps
+        )
+    if not backup_sources:
+        logger.error("There are no backups in %s.", source)
+        return True
+    if not isinstance(backup_sources, list):
+        backup_sources = [backup_sources]
+    if archive_blob:
+        todo = list(paths)
+        for backup_source in reversed(backup_sources):
+            if not todo:
+                break
+            logger.info("Searching %s", backup_source)
+            try:
+                found = blobarchive.extract_paths(backup_source, todo, destination)
+            except (OSError, RuntimeError, EOFError, tarfile.TarError) as exc:
+                logger.error("Extracting from %s failed: %s", backup_source, exc)
+                return True
+            restored.extend(found)
+            todo = [
+                path
+                for path in todo
+                if not any(blobarchive.matches_paths(name, [path]) for name in found)
+            ]
+        missing = todo
+    else:
+        # We have .../blobstorage.0 as backup source, but we need the
+        # destination directory name in it.
+        backup_source = os.path.join(backup_sources[0], os.path.basename(destination))
+        for path in paths:
+            source_path = os.path.join(backup_source, *path.split("/"))
+            dest_path = os.path.join(destination, *path.split("/"))
+            if os.path.isdir(source_path):
+                shutil.copytree(source_path, dest_path, dirs_exist_ok=True)
+            elif os.path.isfile(source_path):
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                shutil.copy2(source_path, dest_path)
+            else:
+                missing.append(path)
+                continue
+            restored.append(path)
+    for path in missing:
+        logger.error("Could not find %s in the blob backup.", path)
+    if missing:
+        return True
+    logger.info("Restored %d blob paths to %s.", len(restored), destination)
+
+
+def remove_orphaned_blob_backups(
+    backup_location, fs_backup_location, archive=False, background_delete=False
+):
     """Remove orphaned blob backups.
 
     This means: blob backups that have a timestamp older than the oldest
@@ -1458,6 +2532,7 @@ def remove_orphaned_blob_backups(backup_location, fs_backup_location, archive=Fa
         # Can't remove what does not exist.
         return True
     deleted = 0
+    directories = []
     for num, mod_time, directory in current_backups:
         if is_time_stamp(num):
             if num >= oldest_timestamp:
@@ -1468,11 +2543,17 @@ def remove_orphaned_blob_backups(backup_location, fs_backup_location, archive=Fa
                 continue
         if archive:
             # It is actually a file.
-            os.remove(directory)
+            remove_archive(directory)
+            logger.debug("Deleted %s.", directory)
         else:
-            shutil.rmtree(directory)
+            directories.append(directory)
         deleted += 1
-        logger.debug("Deleted %s.", directory)
+    if directories:
+        # Remove them together, so there is at most one background worker.
+        trash.remove_trees(directories, deferred=background_delete)
+        catalog.invalidate(backup_location)
+        for directory in directories:
+            logger.debug("Deleted %s.", directory)
     if deleted:
         logger.info(
             "Removed %d blob %s, all backups "
@@ -1492,6 +2573,7 @@ def cleanup(
     keep_blob_days=0,
     fs_backup_location=None,
     latest=None,
+    background_delete=False,
 ):
     """Clean up old blob backups.
 
@@ -1500,12 +2582,17 @@ def cleanup(
     We remove any blob backups that are older than the oldest
     filestorage backup.
 
+    With background_delete, old backups are moved to a .trash directory
+    in the backup location, and removed by a background process.
+
     For tests, see tests/cleanup_dir.rst.
     """
     update_latest_symlink(backup_location, latest=latest)
 
     logger.debug("Starting cleanup of blob backups from %s", backup_location)
-    if remove_orphaned_blob_backups(backup_location, fs_backup_location):
+    if remove_orphaned_blob_backups(
+        backup_location, fs_backup_location, background_delete=background_delete
+    ):
         # A True return value means there is nothing left to do.
         return
 
@@ -1544,7 +2631,7 @@ def cleanup(
     logger.debug("There are older backups that we can remove.")
     remove = backup_dirs[keep:]
     logger.debug("Will possibly remove: %r", remove)
-    deleted = 0
+    directories = []
     now = time.time()
     for num, mod_time, directory in remove:
         if keep_blob_days:
@@ -1552,9 +2639,14 @@ def cleanup(
             if mod_days < keep_blob_days:
                 # I'm too young to die!
                 continue
-        shutil.rmtree(directory)
-        deleted += 1
-        logger.debug("Deleted %s.", directory)
+        directories.append(directory)
+    deleted = len(directories)
+    if deleted:
+        # Remove them together, so there is at most one background worker.
+        trash.remove_trees(directories, deferred=background_delete)
+        catalog.invalidate(backup_location)
+        for directory in directories:
+            logger.debug("Deleted %s.", directory)
     if not deleted:
         logger.debug("Nothing removed.")
         return
@@ -1594,6 +2686,16 @@ def update_latest_symlink(backup_location, latest=None):
         os.symlink(latest, symlink)
     # back to where we came from
     os.chdir(cwd)
+    catalog.invalidate(backup_location)
+
+
+def remove_archive(path):
+    """Remove an archive file, and its index and manifest if it has them."""
+    os.remove(path)
+    for sidecar in SIDECAR_SUFFIXES:
+        if os.path.exists(path + sidecar):
+            os.remove(path + sidecar)
+    catalog.invalidate(os.path.dirname(path))
 
 
 def cleanup_archives(backup_location, keep=0, fs_backup_location=None, latest=None):
@@ -1632,7 +2734,7 @@ def cleanup_archives(backup_location, keep=0, fs_backup_location=None, latest=No
     deleted_files = 0
     for archive in remove:
         for num, mod_time, archive_file in archive:
-            os.remove(archive_file)
+            remove_archive(archive_file)
             deleted_files += 1
             logger.debug("Deleted %s.", archive_file)
         deleted_full += 1
@@ -0,0 +1,425 @@
+"""Native backups of a filestorage, compatible with repozo.
+
+repozo makes a full backup by copying the Data.fs up to the end of the
+last committed transaction into a .fsz file, compressed with gzip in one
+thread.  Next to it, it writes a .dat file with one line per backup
+file: the name, the start and end position in the Data.fs, and the md5
+checksum of those bytes.  Incremental backups add a .deltafsz file and a
+line in the .dat file.
+
+We write the same files, but compress blocks of the Data.fs in several
+threads.  The result is a series of gzip members, which repozo (and
+gzip) read as one gzip file.  So repozo can still make incremental
+backups on top of it and recover it.  We do not write the .index file
+that repozo saves next to a full backup: that needs ZODB.  repozo
+recovers fine without it, and ZODB rebuilds the index when it opens the
+restored Data.fs.
+
+We can restore too.  repozo recovers by reading the backup files one by
+one and appending them to the Data.fs.  But the .dat file tells us where
+the bytes of each backup file go, so we make a file of the right size,
+and let several threads each decompress one backup file into its own
+part.  We check the md5 checksum of each part while writing it.  When
+the Data.fs was restored from an earlier state of the same backups, and
+all its bytes have the right checksums, we only append the newer backup
+files.
+
+A FileStorage is a magic string, followed by transaction records.  Each
+record starts with a header with its length, and ends with the same
+length again.  While a transaction is being committed, its status is
+'c'.  We only copy complete, committed transactions.
+"""
+
+from collective.recipe.backup import compression
+from collective.recipe.backup import copyblobs
+from concurrent import futures
+
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import struct
+import time
+
+logger = logging.getLogger("repozorunner")
+# Magic at the start of a FileStorage, for Python 2 and 3.
+FS_MAGICS = (b"FS21", b"FS30")
+FS_MAGIC_SIZE = 4
+# Transaction header: tid, length, status, user, description and
+# extension lengths.
+TRANS_HDR = struct.Struct(">8sQcHHH")
+# Status of a transaction that is not committed yet.
+CHECKPOINT_STATUS = b"c"
+# Size of the chunks that we read from the Data.fs.
+READ_CHUNK_SIZE = 1024 * 1024
+TMP_SUFFIX = ".tmp"
+
+
+class BackupError(Exception):
+    """A native backup or restore is not possible."""
+
+
+def get_timestamp():
+    """Get a timestamp for a backup file name, like repozo does."""
+    return "{:04d}-{:02d}-{:02d}-{:02d}-{:02d}-{:02d}".format(*time.gmtime()[:6])
+
+
+def read_transaction(f, pos, size):
+    """Read the transaction header at pos.
+
+    Returns the length and status, or None when there is no complete
+    transaction record at pos.
+    """
+    if pos + TRANS_HDR.size > size:
+        return
+    f.seek(pos)
+    tid, length, status, ulen, dlen, elen = TRANS_HDR.unpack(f.read(TRANS_HDR.size))
+    end = pos + length + 8
+    if end > size or length < TRANS_HDR.size + ulen + dlen + elen:
+        return
+    f.seek(pos + length)
+    if struct.unpack(">Q", f.read(8))[0] != length:
+        return
+    return length, status
+
+
+def find_end_of_transactions(path, start=FS_MAGIC_SIZE):
+    """Find the position after the last committed transaction.
+
+    Normally this is the end of the file, which we check by reading the
+    last transaction backwards.  When the file ends with an unfinished
+    transaction, or with garbage, we scan forward from start, which must
+    be the position of a transaction.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if f.read(FS_MAGIC_SIZE) not in FS_MAGICS:
+            raise BackupError(f"{path} is not a FileStorage.")
+        end = size
+        while end > FS_MAGIC_SIZE:
+            if end - 8 < FS_MAGIC_SIZE:
+                break
+            f.seek(end - 8)
+            length = struct.unpack(">Q", f.read(8))[0]
+            pos = end - 8 - length
+            if pos < FS_MAGIC_SIZE:
+                break
+            transaction = read_transaction(f, pos, end)
+            if transaction is None or transaction[0] != length:
+                break
+            if transaction[1] != CHECKPOINT_STATUS:
+                return end
+            # A transaction that is being committed.  Look before it.
+            end = pos
+        else:
+            # Only the magic, or only a transaction being committed.
+            return end
+        logger.warning(
+            "%s does not end with a complete transaction. "
+            "Looking for the last one from the start.",
+            path,
+        )
+        pos = start
+        while True:
+            transaction = read_transaction(f, pos, size)
+            if transaction is None or transaction[1] == CHECKPOINT_STATUS:
+                return pos
+            pos += transaction[0] + 8
+
+
+def copy_range(path, start, end, writer=None, chunk_size=READ_CHUNK_SIZE):
+    """Write the bytes from start to end of path to writer.
+
+    Returns the md5 checksum of these bytes.  Without writer, we only
+    compute the checksum.
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        f.seek(start)
+        todo = end - start
+        while todo > 0:
+            data = f.read(min(todo, chunk_size))
+            if not data:
+                raise BackupError(f"{path} is shorter than expected.")
+            md5.update(data)
+            if writer is not None:
+                writer.write(data)
+            todo -= len(data)
+    return md5.hexdigest()
+
+
+def full_backup(datafs, location, workers=1, compresslevel=6):
+    """Make a full backup of datafs in location, like 'repozo -BFz'.
+
+    Returns a list with the paths of the new .fsz and .dat files.
+    """
+    if not os.path.isdir(location):
+        os.makedirs(location)
+    stamp = get_timestamp()
+    dest = os.path.join(location, stamp + ".fsz")
+    datfile = os.path.join(location, stamp + ".dat")
+    if os.path.exists(dest) or os.path.exists(datfile):
+        raise BackupError(f"Backup {dest} already exists.")
+    end = find_end_of_transactions(datafs)
+    logger.info(
+        "Writing full backup: %d bytes to %s, compressing with %d thread(s).",
+        end,
+        dest,
+        workers,
+    )
+    tmp_dest = dest + TMP_SUFFIX
+    try:
+        with open(tmp_dest, "wb") as f:
+            writer = compression.ParallelGzipWriter(
+                f, workers=workers, compresslevel=compresslevel
+            )
+            try:
+                checksum = copy_range(datafs, 0, end, writer)
+            except BaseException:
+                writer.stop()
+                raise
+            writer.close()
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_dest, dest)
+    except BaseException:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+    with open(datfile, "w") as f:
+        f.write(f"{dest} 0 {end} {checksum}\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return [dest, datfile]
+
+
+def read_dat(datfile):
+    """Read a .dat file that repozo, or full_backup, wrote.
+
+    Returns a list of tuples of backup file name, start and end position
+    in the Data.fs, and md5 checksum.
+    """
+    entries = []
+    try:
+        with open(datfile) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                filename, startpos, endpos, checksum = line.split()
+                entries.append((filename, int(startpos), int(endpos), checksum))
+    except OSError as exc:
+        raise BackupError(f"Cannot read {datfile}: {exc}")
+    except ValueError:
+        raise BackupError(f"Cannot parse line in {datfile}: {line!r}")
+    return entries
+
+
+def get_restore_plan(location, date=None):
+    """Get the backup files to restore, and where their bytes go.
+
+    We restore the same files as repozo with the same date.
+    Returns a list of tuples of path, start and end position in the
+    Data.fs, and md5 checksum, ordered by position.
+    """
+    paths = copyblobs.find_filestorage_backups_to_restore(location, date)
+    if not paths:
+        raise BackupError(f"No full backup found in {location}.")
+    datfile = os.path.splitext(paths[0])[0] + ".dat"
+    # The names in the .dat file may be relative to the directory where
+    # the backup was made, so we only compare the base names.
+    entries = {os.path.basename(entry[0]): entry[1:] for entry in read_dat(datfile)}
+    plan = []
+    pos = 0
+    for path in paths:
+        entry = entries.get(os.path.basename(path))
+        if entry is None:
+            raise BackupError(f"{path} is not in {datfile}.")
+        startpos, endpos, checksum = entry
+        if startpos != pos or endpos < startpos:
+            raise BackupError(f"{path} does not continue where the previous ends.")
+        plan.append((path, startpos, endpos, checksum))
+        pos = endpos
+    return plan
+
+
+def preallocate(fd, size):
+    """Make the file size bytes long.
+
+    When the filesystem supports it, we reserve the space on disk, so we
+    fail early when the disk is too small, and threads that write at
+    different positions do not fragment the file.
+    """
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by this filesystem.
+            pass
+    os.ftruncate(fd, size)
+
+
+def restore_range(fd, path, startpos, endpos, checksum, chunk_size=READ_CHUNK_SIZE):
+    """Write the contents of one backup file at startpos in fd.
+
+    Compressed backup files are decompressed.  The checksum must match.
+    """
+    opener = gzip.open if path.endswith("z") else open
+    md5 = hashlib.md5()
+    pos = startpos
+    with opener(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if pos + len(data) > endpos:
+                raise BackupError(f"{path} is longer than expected.")
+            md5.update(data)
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, pos)
+                view = view[written:]
+                pos += written
+    if pos != endpos:
+        raise BackupError(f"{path} is shorter than expected.")
+    if md5.hexdigest() != checksum:
+        raise BackupError(f"Checksum of {path} does not match.")
+
+
+def restore_ranges(fd, plan, workers=1):
+    """Restore all backup files of a plan in fd, in parallel.
+
+    fd must be large enough.
+    """
+    with futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        jobs = [executor.submit(restore_range, fd, *item) for item in plan]
+        try:
+            for job in jobs:
+                job.result()
+        except BaseException:
+            for job in jobs:
+                job.cancel()
+            raise
+
+
+def restore(plan, output, workers=1):
+    """Restore the backup files of a plan to output, like 'repozo -R'.
+
+    We write a temporary file, and only replace output when all checksums
+    match.  Like repozo, we copy the .index file of the last backup file,
+    when there is one.
+    """
+    size = plan[-1][2]
+    logger.info(
+        "Restoring %d bytes from %d file(s) to %s, with %d thread(s).",
+        size,
+        len(plan),
+        output,
+        workers,
+    )
+    tmp_output = output + TMP_SUFFIX
+    try:
+        fd = os.open(tmp_output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            preallocate(fd, size)
+            restore_ranges(fd, plan, workers=workers)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp_output, output)
+    except BaseException:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+        raise
+    restore_index(plan, output)
+
+
+def restore_index(plan, output, keep=False):
+    """Copy the .index file of the last backup file of the plan, if any.
+
+    Otherwise we remove the .index file of output, which belongs to the
+    old Data.fs, unless keep is true.  ZODB can use the index of a
+    Data.fs that has only been appended to: it reads the rest.
+    """
+    source_index = os.path.splitext(plan[-1][0])[0] + ".index"
+    target_index = output + ".index"
+    if os.path.exists(source_index):
+        logger.info("Restoring index file %s to %s", source_index, target_index)
+        shutil.copyfile(source_index, target_index)
+    elif os.path.exists(target_index) and not keep:
+        os.remove(target_index)
+
+
+def find_restored(plan, output, workers=1):
+    """Find how many backup files of the plan are already in output.
+
+    A FileStorage is only appended to, until it is packed.  So when output
+    was restored from an earlier state of the same backups, its size is
+    the end position of one of the backup files.  All bytes up to there
+    must have the checksums of the backup files.  We check the last one
+    first, as that is most likely to differ, and then the others, with
+    workers threads.
+
+    Returns the number of backup files, or 0.
+    """
+    try:
+        size = os.path.getsize(output)
+    except OSError:
+        return 0
+    for number, entry in enumerate(plan, 1):
+        if entry[2] == size:
+            break
+    else:
+        return 0
+    restored = plan[:number]
+
+    def matches(entry):
+        path, startpos, endpos, checksum = entry
+        return copy_range(output, startpos, endpos) == checksum
+
+    if not matches(restored[-1]):
+        return 0
+    with futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        if not all(executor.map(matches, restored[:-1])):
+            return 0
+    return number
+
+
+def restore_incremental(plan, output, workers=1):
+    """Append the backup files of the plan that are not in output yet.
+
+    This is for a standby server that restores the newest backups
+    regularly.  When a check fails, we cut output back to its old size.
+
+    Returns the part of the plan that we appended, or None when output
+    does not have the start of the plan, and needs a full restore.
+    """
+    done = find_restored(plan, output, workers=workers)
+    if not done:
+        return
+    todo = plan[done:]
+    if not todo:
+        logger.info("%s is already up to date.", output)
+        return todo
+    old_size = todo[0][1]
+    logger.info(
+        "Appending %d bytes from %d file(s) to %s, with %d thread(s).",
+        todo[-1][2] - old_size,
+        len(todo),
+        output,
+        workers,
+    )
+    fd = os.open(output, os.O_WRONLY)
+    try:
+        try:
+            preallocate(fd, todo[-1][2])
+            restore_ranges(fd, todo, workers=workers)
+            os.fsync(fd)
+        except BaseException:
+            os.ftruncate(fd, old_size)
+            raise
+    finally:
+        os.close(fd)
+    restore_index(plan, output, keep=True)
+    return todo
@@ -1,16 +1,19 @@
 """Functions that invoke repozo and/or the blob backup."""
 
+from collective.recipe.backup import catalog
 from collective.recipe.backup import config
 from collective.recipe.backup import copyblobs
 from collective.recipe.backup import repozorunner
 from collective.recipe.backup import utils
 
 import logging
+import os
 import sys
 
 logger = logging.getLogger("backup")
 
 
+@catalog.with_listing_cache
 def backup_main(
     bin_dir,
     storage,
@@ -30,11 +33,25 @@ def backup_main(
     backup_method=config.STANDARD_BACKUP,
     incremental_blobs=False,
     rsync_hard_links_on_first_copy=False,
+    blob_engine="rsync",
+    immutable_blobs=False,
+    copy_workers=1,
+    background_delete=False,
+    rsync_workers=1,
+    compress_workers=1,
+    compress_level=6,
+    blob_compression="",
+    blob_index=False,
+    backup_catalog=False,
+    repozo_in_process=False,
+    filestorage_engine="repozo",
     **kwargs,
 ):
     """Main method, gets called by generated bin/backup."""
     if backup_method not in config.BACKUP_METHODS:
         raise RuntimeError(f"Unknown backup method {backup_method}.")
+    if kwargs.get("rebuild_catalog"):
+        return rebuild_catalogs(storage, backup_method, backup_blobs, only_blobs)
     utils.execute_or_fail(pre_command)
     utils.check_folders(
         storage,
@@ -42,9 +59,23 @@ def backup_main(
         only_blobs=only_blobs,
         backup_method=backup_method,
     )
+    if backup_catalog:
+        for location in get_backup_locations(
+            storage, backup_method, backup_blobs, only_blobs
+        ):
+            catalog.create_catalog(location)
     if not only_blobs:
         result = repozorunner.backup_main(
-            bin_dir, storage, keep, full, verbose, backup_method
+            bin_dir,
+            storage,
+            keep,
+            full,
+            verbose,
+            backup_method,
+            in_process=repozo_in_process,
+            engine=filestorage_engine,
+            workers=compress_workers,
+            compresslevel=compress_level,
         )
         if result:
             if backup_blobs:
@@ -90,7 +121,7 @@ def backup_main(
         fs_backup_location = storage["snapshot_location"]
     elif backup_method == config.ZIP_BACKUP:
         fs_backup_location = storage["zip_location"]
-    copyblobs.backup_blobs(
+    result = copyblobs.backup_blobs(
         blobdir,
         blob_backup_location,
         full,
@@ -104,10 +135,52 @@ def backup_main(
         fs_backup_location=fs_backup_location,
         incremental_blobs=incremental_blobs,
         rsync_hard_links_on_first_copy=rsync_hard_links_on_first_copy,
+        blob_engine=blob_engine,
+        immutable_blobs=immutable_blobs,
+        copy_workers=copy_workers,
+        background_delete=background_delete,
+        rsync_workers=rsync_workers,
+        compress_workers=compress_workers,
+        compress_level=compress_level,
+        blob_compression=blob_compression,
+        blob_index=blob_index,
     )
+    if result:
+        logger.error("Halting execution due to error.")
+        sys.exit(1)
     utils.execute_or_fail(post_command)
 
 
+def get_backup_locations(storage, backup_method, backup_blobs, only_blobs):
+    """Get the backup locations of a storage for this backup method."""
+    if backup_method == config.SNAPSHOT_BACKUP:
+        keys = ["snapshot_location", "blob_snapshot_location"]
+    elif backup_method == config.ZIP_BACKUP:
+        keys = ["zip_location", "blob_zip_location"]
+    else:
+        keys = ["backup_location", "blob_backup_location"]
+    if only_blobs:
+        keys = keys[1:]
+    if not (backup_blobs and storage.get("blobdir")):
+        keys = keys[:1]
+    return [storage[key] for key in keys if storage.get(key)]
+
+
+def rebuild_catalogs(storage, backup_method, backup_blobs, only_blobs):
+    """Rebuild the catalogs of the backup locations from disk.
+
+    This is for 'bin/backup --rebuild-catalog'.
+    """
+    for location in get_backup_locations(
+        storage, backup_method, backup_blobs, only_blobs
+    ):
+        if not os.path.isdir(location):
+            logger.warning("Not rebuilding catalog: %s does not exist.", location)
+            continue
+        entries = catalog.rebuild_catalog(location)
+        logger.info("Rebuilt catalog of %s: %d entries.", location, len(entries))
+
+
 def snapshot_main(*args, **kwargs):
     """Main method, gets called by generated bin/snapshotbackup."""
     kwargs["full"] = True
@@ -190,6 +263,7 @@ def restore_check(
     rsync_options="",
     zip_restore=False,
     blob_timestamps=False,
+    repozo_in_process=False,
     **kwargs,
 ):
     """Method to check that a restore will work.
@@ -233,6 +307,7 @@ def restore_check(
             alt_restore,
             zip_restore,
             only_check=True,
+            in_process=repozo_in_process,
         )
         if result:
             logger.error("Halting execution: " "restoring filestorages would fail.")
@@ -252,6 +327,7 @@ def restore_check(
     return date
 
 
+@catalog.with_listing_cache
 def restore_main(
     bin_dir,
     storage,
@@ -268,9 +344,31 @@ def restore_main(
     zip_restore=False,
     blob_timestamps=False,
     incremental_blobs=False,
+    copy_workers=1,
+    background_delete=False,
+    rsync_workers=1,
+    restore_mode="copy",
+    repozo_in_process=False,
+    filestorage_engine="repozo",
     **kwargs,
 ):
     """Main method, gets called by generated bin/restore."""
+    if kwargs.get("blob_paths"):
+        return restore_blob_paths_main(
+            storage,
+            backup_blobs,
+            use_rsync,
+            kwargs["blob_paths"],
+            restore_snapshot=restore_snapshot,
+            pre_command=pre_command,
+            post_command=post_command,
+            archive_blob=archive_blob,
+            alt_restore=alt_restore,
+            rsync_options=rsync_options,
+            zip_restore=zip_restore,
+            blob_timestamps=blob_timestamps,
+            no_prompt=kwargs.get("no_prompt"),
+        )
     # First run several checks, and get the date that should be restored.
     date = restore_check(
         bin_dir,
@@ -288,12 +386,22 @@ def restore_main(
         zip_restore=zip_restore,
         blob_timestamps=blob_timestamps,
         incremental_blobs=incremental_blobs,
+        repozo_in_process=repozo_in_process,
         **kwargs,
     )
     # Checks have passed, now do the real restore.
     if not only_blobs:
         result = repozorunner.restore_main(
-            bin_dir, storage, verbose, date, restore_snapshot, alt_restore, zip_restore
+            bin_dir,
+            storage,
+            verbose,
+            date,
+            restore_snapshot,
+            alt_restore,
+            zip_restore,
+            in_process=repozo_in_process,
+            engine=filestorage_engine,
+            workers=copy_workers,
         )
         if result:
             if backup_blobs:
@@ -318,6 +426,74 @@ def restore_main(
         archive_blob=archive_blob,
         rsync_options=rsync_options,
         timestamps=blob_timestamps,
+        copy_workers=copy_workers,
+        background_delete=background_delete,
+        rsync_workers=rsync_workers,
+        restore_mode=restore_mode,
+    )
+    if result:
+        logger.error("Halting execution due to error.")
+        sys.exit(1)
+    utils.execute_or_fail(post_command)
+
+
+@catalog.with_listing_cache
+def restore_blob_paths_main(
+    storage,
+    backup_blobs,
+    use_rsync,
+    blob_paths,
+    restore_snapshot=False,
+    pre_command="",
+    post_command="",
+    archive_blob=False,
+    alt_restore=False,
+    rsync_options="",
+    zip_restore=False,
+    blob_timestamps=False,
+    no_prompt=False,
+):
+    """Restore only some paths in the blobstorage.
+
+    This is for 'bin/restore --blob-path 0x00/0x00/0x01', to get back
+    one or a few accidentally removed blobs.  The filestorage and the rest
+    of the blobstorage are left alone.
+    """
+    blobdir = storage.get("blobdir")
+    if not backup_blobs or not blobdir:
+        logger.error("No blob dir defined for %s storage", storage["storage"])
+        sys.exit(1)
+    date = utils.get_date_from_args()
+    if not no_prompt:
+        question = "\nThis will restore these paths in the blobstorage:\n"
+        for path in blob_paths:
+            question += f"    {path}\n"
+        question += f"in:\n    {blobdir}\n"
+        question += "Are you sure?"
+        if not utils.ask(question, default=False, exact=True):
+            logger.info("Not restoring.")
+            sys.exit(0)
+    utils.execute_or_fail(pre_command)
+    check_blobs(
+        storage,
+        use_rsync,
+        restore_snapshot=restore_snapshot,
+        archive_blob=archive_blob,
+        alt_restore=alt_restore,
+        rsync_options=rsync_options,
+        zip_restore=zip_restore,
+        blob_timestamps=blob_timestamps,
+        date=date,
+    )
+    blob_backup_location = storage["blob_backup_location"]
+    logger.info("Restoring blob paths from %s to %s", blob_backup_location, blobdir)
+    result = copyblobs.restore_blob_paths(
+        blob_backup_location,
+        blobdir,
+        blob_paths,
+        date=date,
+        archive_blob=archive_blob,
+        timestamps=blob_timestamps,
     )
     if result:
         logger.error("Halting execution due to error.")
@@ -0,0 +1,178 @@
+"""Manifests for native incremental blob archives.
+
+GNU tar needs a snapshot file (.snar) for incremental archives.  With the
+native blob engine we use a manifest instead, written next to each
+archive of a chain: archive.tar.manifest.  It lists every file that is in
+the blobstorage at the time of the backup, with its size, modification
+time, and the archive in the chain that has its contents.
+
+ZODB blob files are never changed, only added and removed.  So a delta
+archive only needs the new files, and the manifest lists the files that
+were removed since the previous archive.  We compare a listing of the
+blobstorage with the previous manifest, so we only read new files.
+"""
+
+import gzip
+import logging
+import os
+
+logger = logging.getLogger("blobs")
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_HEADER = "collective.recipe.backup blob manifest 1"
+
+
+class Manifest:
+    """Manifest of one archive in a chain of incremental archives.
+
+    archives is a list with the names of the archives in the chain,
+    without directory, the full archive first and this archive last.
+
+    files maps each relative path to a tuple of the number of the
+    archive that has it, size and mtime_ns.
+
+    deleted is a list of paths that were removed since the previous archive.
+    """
+
+    __slots__ = ("archives", "files", "deleted")
+
+    def __init__(self, archives=None, files=None, deleted=None):
+        self.archives = archives or []
+        self.files = files if files is not None else {}
+        self.deleted = deleted or []
+
+    def __repr__(self):
+        return "<Manifest archives={} files={} deleted={}>".format(
+            len(self.archives), len(self.files), len(self.deleted)
+        )
+
+    @property
+    def is_delta(self):
+        return len(self.archives) > 1
+
+    def get_changed(self):
+        """Return the sorted paths that are in the last archive."""
+        last = len(self.archives) - 1
+        return sorted(path for path, info in self.files.items() if info[0] == last)
+
+
+def get_manifest_path(archive):
+    return archive + MANIFEST_SUFFIX
+
+
+def scan_tree(source):
+    """Get the files in source.
+
+    Returns a dictionary of relative path to a tuple of size and mtime_ns.
+    Symbolic links are listed, but not followed.
+    Directories are not listed: they are created when extracting files.
+    """
+    files = {}
+    stack = [(source, "")]
+    while stack:
+        path, prefix = stack.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                rel = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, rel + "/"))
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                files[rel] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def make_manifest(archive_name, files, previous=None):
+    """Make the manifest for a new archive.
+
+    files is the result of scan_tree.  previous is the manifest of the
+    previous archive in the chain, or None for a full archive.
+    Files that are new, or have another size or mtime, go in the new
+    archive.
+    """
+    if previous is None:
+        number = 0
+        return Manifest(
+            archives=[archive_name],
+            files={
+                path: (number, size, mtime_ns)
+                for path, (size, mtime_ns) in files.items()
+            },
+        )
+    number = len(previous.archives)
+    new_files = {}
+    for path, (size, mtime_ns) in files.items():
+        old = previous.files.get(path)
+        if old is not None and old[1] == size and old[2] == mtime_ns:
+            new_files[path] = old
+        else:
+            new_files[path] = (number, size, mtime_ns)
+    deleted = sorted(path for path in previous.files if path not in files)
+    return Manifest(
+        archives=previous.archives + [archive_name],
+        files=new_files,
+        deleted=deleted,
+    )
+
+
+def forget_files(manifest, paths):
+    """Remove paths from the manifest, as if they were deleted.
+
+    This is for files that disappeared while writing the archive.
+    """
+    for path in paths:
+        if manifest.files.pop(path, None) is not None:
+            manifest.deleted.append(path)
+    manifest.deleted.sort()
+
+
+def write_manifest(archive, manifest):
+    """Write the manifest next to the archive."""
+    path = get_manifest_path(archive)
+    tmp_path = path + ".tmp"
+    with gzip.open(
+        tmp_path, "wt", encoding="utf-8", errors="surrogateescape", compresslevel=1
+    ) as f:
+        f.write(MANIFEST_HEADER + "\n")
+        for name in manifest.archives:
+            f.write(f"a {name}\n")
+        for rel, (number, size, mtime_ns) in manifest.files.items():
+            f.write(f"f {number} {size} {mtime_ns} {rel}\n")
+        for rel in manifest.deleted:
+            f.write(f"x {rel}\n")
+    os.rename(tmp_path, path)
+
+
+def read_manifest(archive):
+    """Read the manifest of an archive.
+
+    Returns a Manifest, or None when the file is missing or unreadable.
+    """
+    path = get_manifest_path(archive)
+    if not os.path.isfile(path):
+        return
+    manifest = Manifest()
+    try:
+        with gzip.open(path, "rt", encoding="utf-8", errors="surrogateescape") as f:
+            header = f.readline().rstrip("\n")
+            if header != MANIFEST_HEADER:
+                logger.warning("Ignoring %s: unknown format.", path)
+                return
+            for line in f:
+                kind, value = line.rstrip("\n").split(" ", 1)
+                if kind == "f":
+                    number, size, mtime_ns, rel = value.split(" ", 3)
+                    manifest.files[rel] = (int(number), int(size), int(mtime_ns))
+                elif kind == "x":
+                    manifest.deleted.append(value)
+                elif kind == "a":
+                    manifest.archives.append(value)
+    except (OSError, ValueError, TypeError, EOFError) as exc:
+        logger.warning("Ignoring %s: %s", path, exc)
+        return
+    if not manifest.archives:
+        logger.warning("Ignoring %s: no archives.", path)
+        return
+    return manifest
@@ -7,30 +7,57 @@ restore_main() for bin/restore.
 backup_arguments() and restore_arguments() determine the arguments that are to
 be passed to bin/repozo.
 
+run_repozo() calls bin/repozo, or the repozo module in this process.
+
 cleanup() empties old backups from the backup directory to prevent it from
 filling up the harddisk.
 
 """
 
+from collective.recipe.backup import catalog
 from collective.recipe.backup import config
+from collective.recipe.backup import copyblobs
+from collective.recipe.backup import fsbackup
+from collective.recipe.backup import utils
 from operator import itemgetter
 
+import hashlib
+import importlib
 import logging
 import os
 import sys
 
 logger = logging.getLogger("repozorunner")
+# Module that we call with the repozo_in_process option.
+# Tests can point this to a stub module.
+REPOZO_MODULE = "ZODB.scripts.repozo"
+# When the last backup covers more than this many bytes of the Data.fs,
+# we do not compute its checksum to see if the Data.fs has changed.
+QUICK_CHECK_MAX_BYTES = 16 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class RepozoResult:
+    """Result of running repozo.
+
+    kind is 'full' or 'incremental' for a backup that made a new backup
+    file, 'recover' for a restore, or None when nothing was written.
+    files are the paths that repozo created, and bytes_written is their
+    total size.
+    """
+
+    __slots__ = ("returncode", "kind", "files", "bytes_written")
 
+    def __init__(self, returncode=0, kind=None, files=None, bytes_written=0):
+        self.returncode = returncode
+        self.kind = kind
+        self.files = files if files is not None else []
+        self.bytes_written = bytes_written
 
-def quote_command(command):
-    # Quote the program name, so it works even if it contains spaces
-    command = " ".join([f'"{x}"' for x in command])
-    if sys.platform[:3].lower() == "win":
-        # odd, but true: the windows cmd processor can't handle more than
-        # one quoted item per string unless you add quotes around the
-        # whole line.
-        command = f'"{command}"'
-    return command
+    def __repr__(self):
+        return "<RepozoResult returncode={} kind={} files={} bytes={}>".format(
+            self.returncode, self.kind, len(self.files), self.bytes_written
+        )
 
 
 def backup_main(
@@ -40,9 +67,17 @@ def backup_main(
     full,
     verbose,
     backup_method=config.STANDARD_BACKUP,
+    in_process=False,
+    engine="repozo",
+    workers=1,
+    compresslevel=6,
 ):
-    """Main method, gets called by generated bin/backup."""
-    repozo = os.path.join(bin_dir, "repozo")
+    """Main method, gets called by generated bin/backup.
+
+    With in_process, we call the repozo module instead of bin/repozo.
+    With engine 'native', we make full backups ourselves, compressing
+    with workers threads.
+    """
     fs = storage["datafs"]
     if backup_method == config.STANDARD_BACKUP:
         location = storage["backup_location"]
@@ -57,15 +92,26 @@ def backup_main(
         logger.info(
             "Please wait while backing up database file: %s to %s", fs, location
         )
-    result = os.system(
-        quote_command(
-            [repozo] + backup_arguments(fs, location, full, verbose, as_list=True)
+    if not full and is_datafs_unchanged(fs, location):
+        logger.info(
+            "Database file %s has not changed since the last backup. "
+            "Not calling repozo.",
+            fs,
+        )
+        return
+    if full and engine == "native":
+        result = run_native_backup(fs, location, workers, compresslevel)
+    else:
+        result = run_repozo(
+            bin_dir,
+            backup_arguments(fs, location, full, verbose, as_list=True),
+            in_process=in_process,
         )
-    )
     logger.debug("Repozo command executed.")
-    if result:
+    catalog.invalidate(location)
+    if result.returncode:
         logger.error("Repozo command failed. See message above.")
-        return result
+        return result.returncode
     cleanup(location, keep)
 
 
@@ -78,6 +124,9 @@ def restore_main(
     alt_restore=False,
     zip_restore=False,
     only_check=False,
+    in_process=False,
+    engine="repozo",
+    workers=1,
 ):
     """Main method, gets called by generated bin/restore.
 
@@ -88,6 +137,9 @@ def restore_main(
 
     The idea is to first call this with only_check=True, and do the same for
     restore_blobs.  When all is well, call it normally without only_check.
+
+    With engine 'native' we restore without repozo, with workers threads,
+    when the .dat file has all backup files.  Otherwise we call repozo.
     """
     explicit_restore_opts = [restore_snapshot, alt_restore, zip_restore]
     if sum(1 for opt in explicit_restore_opts if opt) > 1:
@@ -96,7 +148,6 @@ def restore_main(
             "alt_restore and zip_restore."
         )
         sys.exit(1)
-    repozo = os.path.join(bin_dir, "repozo")
     logger.debug("If things break: did you stop zope?")
     if restore_snapshot:
         backup_location = storage["snapshot_location"]
@@ -117,10 +168,214 @@ def restore_main(
     logger.info(
         "Please wait while restoring database file: %s to %s", backup_location, fs
     )
-    result = os.system(quote_command([repozo] + arguments))
-    if result:
+    result = None
+    if engine == "native":
+        result = run_native_restore(fs, backup_location, date, workers)
+    if result is None:
+        result = run_repozo(bin_dir, arguments, in_process=in_process)
+    if result.returncode:
         logger.error("Repozo command failed. See message above.")
+        return result.returncode
+
+
+def read_last_dat_entry(datfile):
+    """Read the last line of a .dat file that repozo wrote.
+
+    Each line has the backup file name, the start and end position in the
+    Data.fs, and the md5 checksum of the bytes in between.
+    Returns a tuple of these four, or None.
+    """
+    last = None
+    try:
+        with open(datfile) as f:
+            for line in f:
+                if line.strip():
+                    last = line
+    except OSError:
+        return
+    if last is None:
+        return
+    try:
+        filename, startpos, endpos, checksum = last.split()
+        return filename, int(startpos), int(endpos), checksum
+    except ValueError:
+        logger.debug("Could not parse last line of %s: %r", datfile, last)
+
+
+def is_datafs_unchanged(datafs, backup_location):
+    """Is the Data.fs the same as at the time of the last backup?
+
+    repozo with --quick does a similar check, but then we have to start
+    repozo first.  We find the .dat file of the newest full backup, and
+    check that its last entry is the newest backup file.  Then the size of
+    the Data.fs must be the end position of that entry.  When the entry
+    is not too large, the checksum of its bytes in the Data.fs must be the
+    same.  Otherwise the Data.fs must not have been changed after the .dat
+    file.
+
+    When in doubt, we return False, and repozo decides.
+    """
+    paths = copyblobs.find_filestorage_backups_to_restore(backup_location)
+    if not paths:
+        return False
+    datfile = os.path.splitext(paths[0])[0] + ".dat"
+    entry = read_last_dat_entry(datfile)
+    if entry is None:
+        return False
+    filename, startpos, endpos, checksum = entry
+    if os.path.basename(filename) != os.path.basename(paths[-1]):
+        # The .dat file does not match the backup files.
+        return False
+    try:
+        stat = os.stat(datafs)
+    except OSError:
+        return False
+    if stat.st_size != endpos:
+        return False
+    if endpos - startpos > QUICK_CHECK_MAX_BYTES:
+        return stat.st_mtime_ns <= os.stat(datfile).st_mtime_ns
+    md5 = hashlib.md5()
+    with open(datafs, "rb") as f:
+        f.seek(startpos)
+        todo = endpos - startpos
+        while todo > 0:
+            data = f.read(min(todo, READ_CHUNK_SIZE))
+            if not data:
+                return False
+            md5.update(data)
+            todo -= len(data)
+    return md5.hexdigest() == checksum
+
+
+def get_backup_kind(filename):
+    """Get the kind of backup, based on a file name that repozo made."""
+    if filename.endswith((".fs", ".fsz")):
+        return "full"
+    if filename.endswith((".deltafs", ".deltafsz")):
+        return "incremental"
+
+
+def call_repozo_module(arguments):
+    """Call the main function of the repozo module.
+
+    Returns the exit code.
+    """
+    try:
+        repozo = importlib.import_module(REPOZO_MODULE)
+    except ImportError as exc:
+        logger.error(
+            "Could not import %s for repozo_in_process: %s", REPOZO_MODULE, exc
+        )
+        return 1
+    try:
+        repozo.main(list(arguments))
+    except SystemExit as exc:
+        if exc.code is None:
+            return 0
+        if isinstance(exc.code, int):
+            return exc.code
+        # sys.exit with a message.
+        print(exc.code, file=sys.stderr)
+        return 1
+    except Exception:
+        logger.exception("Repozo failed.")
+        return 1
+    return 0
+
+
+def run_repozo(bin_dir, arguments, in_process=False):
+    """Run repozo with a list of arguments.
+
+    We call bin/repozo, or with in_process the repozo module in this
+    process, which saves starting a new Python and importing ZODB.
+
+    Returns a RepozoResult.
+    """
+    recover = "--recover" in arguments
+    if recover:
+        output = arguments[arguments.index("-o") + 1]
+    else:
+        location = arguments[arguments.index("-r") + 1]
+        before = set(os.listdir(location)) if os.path.isdir(location) else set()
+    if in_process:
+        logger.debug("Calling %s in process.", REPOZO_MODULE)
+        returncode = call_repozo_module(arguments)
+    else:
+        repozo = os.path.join(bin_dir, "repozo")
+        returncode = utils.run([repozo] + arguments).returncode
+    result = RepozoResult(returncode)
+    if returncode:
         return result
+    if recover:
+        if os.path.isfile(output):
+            result.kind = "recover"
+            result.files = [output]
+            result.bytes_written = os.path.getsize(output)
+        return result
+    if not os.path.isdir(location):
+        return result
+    for filename in sorted(set(os.listdir(location)) - before):
+        path = os.path.join(location, filename)
+        result.files.append(path)
+        result.kind = get_backup_kind(filename) or result.kind
+        try:
+            result.bytes_written += os.path.getsize(path)
+        except OSError:
+            continue
+    logger.debug(
+        "Repozo made %s backup: %d file(s), %d bytes.",
+        result.kind or "no",
+        len(result.files),
+        result.bytes_written,
+    )
+    return result
+
+
+def run_native_backup(datafs, location, workers=1, compresslevel=6):
+    """Make a full backup without repozo.
+
+    Returns a RepozoResult.
+    """
+    try:
+        files = fsbackup.full_backup(
+            datafs, location, workers=workers, compresslevel=compresslevel
+        )
+    except (fsbackup.BackupError, OSError) as exc:
+        logger.error("Native backup of %s failed: %s", datafs, exc)
+        return RepozoResult(1)
+    return RepozoResult(
+        kind="full",
+        files=files,
+        bytes_written=sum(os.path.getsize(path) for path in files),
+    )
+
+
+def run_native_restore(datafs, location, date=None, workers=1):
+    """Restore the Data.fs without repozo.
+
+    When the Data.fs was restored before from the same backups, we only
+    append the newer backup files.
+
+    Returns a RepozoResult, or None when we cannot restore these backups
+    natively, and repozo should do it.
+    """
+    try:
+        plan = fsbackup.get_restore_plan(location, date)
+    except fsbackup.BackupError as exc:
+        logger.warning("Cannot restore natively, using repozo: %s", exc)
+        return
+    try:
+        appended = fsbackup.restore_incremental(plan, datafs, workers=workers)
+        if appended is None:
+            fsbackup.restore(plan, datafs, workers=workers)
+    except (fsbackup.BackupError, OSError) as exc:
+        logger.error("Native restore of %s failed: %s", datafs, exc)
+        return RepozoResult(1)
+    if appended is None:
+        bytes_written = os.path.getsize(datafs)
+    else:
+        bytes_written = sum(endpos - startpos for _, startpos, endpos, _ in appended)
+    return RepozoResult(kind="recover", files=[datafs], bytes_written=bytes_written)
 
 
 def backup_arguments(
@@ -331,19 +586,15 @@ def cleanup(backup_location, keep=0):
         logger.debug("Value of 'keep' is %r, we don't want to remove anything.", keep)
         return
     logger.debug("Trying to clean up old backups.")
-    filenames = sorted(os.listdir(backup_location))
+    entries = catalog.list_entries(backup_location)
     logger.debug(
         "Looked up filenames in the target dir: %s found. %r.",
-        len(filenames),
-        filenames,
+        len(entries),
+        [entry.name for entry in entries],
     )
     num_backups = int(keep)
     logger.debug("Max number of backups: %s.", num_backups)
-    files_modtimes = []
-    for filename in filenames:
-        mod_time = os.path.getmtime(os.path.join(backup_location, filename))
-        file_ = (filename, mod_time)
-        files_modtimes.append(file_)
+    files_modtimes = [(entry.name, entry.mtime) for entry in entries]
     # we are only interested in full backups
     fullbackups = [
         f for f in files_modtimes if f[0].endswith(".fs") or f[0].endswith(".fsz")
@@ -375,6 +626,7 @@ def cleanup(backup_location, keep=0):
                 os.remove(filepath)
                 logger.debug("Deleted %s.", filepath)
                 deleted += 1
+        catalog.invalidate(backup_location)
         logger.info(
             "Removed %d file(s) belonging to old backups, the latest "
             "%s full backups have been kept.",
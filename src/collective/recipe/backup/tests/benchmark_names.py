@@ -0,0 +1,66 @@
+"""Measure how fast we parse and group many blob backup names.
+
+This is not a test: timings depend on the machine, and a trace function,
+like coverage uses, makes them a lot slower.  Run it by hand:
+
+    python -m collective.recipe.backup.tests.benchmark_names [count]
+
+It makes hourly archive names with a full backup each day, and times
+parsing, sorting and grouping them in chains, like the blob getters do.
+On an idle machine 100000 names take about half a second.
+"""
+
+from collective.recipe.backup import compression
+from collective.recipe.backup.copyblobs import combine_backups
+from collective.recipe.backup.copyblobs import first_number_key
+from collective.recipe.backup.copyblobs import get_backup_name_parser
+from datetime import datetime
+from datetime import timedelta
+
+import sys
+import time
+
+
+def make_names(count):
+    """Make names of count hourly archives, with a full backup each day."""
+    start = datetime(2010, 1, 1)
+    names = []
+    for hour in range(count):
+        stamp = (start + timedelta(hours=hour)).strftime("%Y-%m-%d-%H-%M-%S")
+        if hour % 24:
+            names.append(f"blobs.{stamp}.delta.tar.gz")
+        else:
+            names.append(f"blobs.{stamp}.tar.gz")
+            names.append(f"blobs.{stamp}.snar")
+    return names
+
+
+def group_names(names):
+    """Parse, sort and group the names.  Returns the chains."""
+    suffixes = compression.archive_suffixes(delta=True) + ["snar"]
+    parse = get_backup_name_parser(suffixes=suffixes)
+    backups = []
+    for mod_time, filename in enumerate(names):
+        name = parse(filename)
+        backups.append((name.number, mod_time, "/backups/" + filename))
+    backups.sort(key=first_number_key, reverse=True)
+    return combine_backups(backups)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    count = int(args[0]) if args else 100000
+    names = make_names(count)
+    best = None
+    for attempt in range(5):
+        started = time.perf_counter()
+        chains = group_names(names)
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    print(f"{count} backups in {len(chains)} chains: best of 5 is {best:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
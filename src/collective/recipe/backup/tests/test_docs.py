@@ -92,16 +92,29 @@ def test_suite():
         "backup_blobs_archive.rst",
         "backup_blobs_dir.rst",
         "backup_blobs_dir_hard_links.rst",
+        "backup_blobs_native.rst",
+        "background_delete.rst",
         "base.rst",
         "blobs.rst",
+        "blob_index.rst",
+        "bloblist.rst",
         "blob_timestamps.rst",
+        "catalog.rst",
         "cleanup_archives.rst",
         "cleanup_dir.rst",
+        "compression.rst",
+        "fsbackup.rst",
         "incremental_blobs.rst",
         "location.rst",
+        "native_incremental.rst",
         "no_rsync.rst",
         "options.rst",
+        "point_in_time.rst",
         "prefix.rst",
+        "repozo_in_process.rst",
+        "restore_mode.rst",
+        "rsync_workers.rst",
+        "unchanged_datafs.rst",
         "zipbackup.rst",
     ]
     for docfile in docfiles:
@@ -107,6 +107,64 @@ class UtilsTestCase(unittest.TestCase):
         buildout_info["buildout"] = {"parts": "four two one"}
         self.assertEqual(get_zope_option(buildout_info, "wanted"), "four-wanted")
 
+    def test_run(self):
+        from collective.recipe.backup.utils import run
+
+        import sys
+
+        result = run([sys.executable, "-c", "print('hello world')"], echo=False)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.output, b"hello world\n")
+        self.assertGreaterEqual(result.wall_time, 0)
+        self.assertIsNotNone(result.rusage)
+        # A string is split into arguments, without using a shell.
+        result = run("echo 'one two' > three", echo=False)
+        self.assertEqual(result.output, b"one two > three\n")
+        # With a shell we can use redirection.
+        result = run("echo error >&2; exit 3", shell=True, echo=False)
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(result.output, b"error\n")
+        # Input can be passed.
+        result = run(["cat"], echo=False, input="some input")
+        self.assertEqual(result.output, b"some input")
+        # A missing program gives the same exit code as in a shell.
+        result = run(["no-such-program-here"], echo=False)
+        self.assertEqual(result.returncode, 127)
+        self.assertIn(b"no-such-program-here", result.output)
+
+    def test_run_lots_of_output(self):
+        from collective.recipe.backup.utils import run
+
+        import sys
+
+        # Lots of output on stderr does not block the command,
+        # and we only keep the last lines.
+        script = (
+            "import sys\n"
+            "for i in range(100000):\n"
+            "    sys.stderr.write('line %d\\n' % i)\n"
+            "sys.stdout.write('done\\n')\n"
+        )
+        result = run([sys.executable, "-c", script], echo=False, max_lines=3)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.output, b"line 99998\nline 99999\ndone\n")
+
+    def test_get_date_from_args(self):
+        from collective.recipe.backup.utils import get_date_from_args
+        from unittest import mock
+
+        with mock.patch("sys.argv", ["bin/restore", "-n"]):
+            self.assertIsNone(get_date_from_args())
+        with mock.patch("sys.argv", ["bin/restore", "2024-01-02-03-04-05"]):
+            self.assertEqual(get_date_from_args(), "2024-01-02-03-04-05")
+        # The value of --blob-path is not a date.
+        argv = ["bin/restore", "--blob-path", "0x00/0x01", "2024-01-02"]
+        with mock.patch("sys.argv", argv):
+            self.assertEqual(get_date_from_args(), "2024-01-02")
+        argv = ["bin/restore", "--blob-path=0x00/0x01"]
+        with mock.patch("sys.argv", argv):
+            self.assertIsNone(get_date_from_args())
+
 
 class CopyBlobsTestCase(unittest.TestCase):
     """Test the code in copyblobs.py."""
@@ -607,3 +665,107 @@ class CopyBlobsTestCase(unittest.TestCase):
                 ],
             ],
         )
+
+    def test_parse_backup_name(self):
+        from collective.recipe.backup.copyblobs import parse_backup_name
+
+        name = parse_backup_name(
+            "blobs.1999-12-31-23-59-30.delta.tar.gz",
+            suffixes=["tar", "tar.gz", "delta.tar", "delta.tar.gz"],
+        )
+        self.assertEqual(name.prefix, "blobs")
+        self.assertEqual(name.number, "1999-12-31-23-59-30")
+        self.assertEqual(name.suffix, ".delta.tar.gz")
+        self.assertEqual(name.key, (1, "1999-12-31-23-59-30"))
+        name = parse_backup_name("blobs.10")
+        self.assertEqual((name.prefix, name.number, name.suffix), ("blobs", "10", ""))
+        self.assertEqual(name.key, (0, -10))
+        self.assertIsNone(parse_backup_name("blobs.10.tar", suffixes="tgz"))
+        self.assertIsNone(parse_backup_name("blobs.1999-12-31"))
+
+    def test_backup_index(self):
+        from collective.recipe.backup.copyblobs import BackupIndex
+        from collective.recipe.backup.copyblobs import (
+            find_conditional_backups_to_restore,
+        )
+
+        # Most recent first, like the backup getters return them.
+        backups = [
+            ("2000-01-05-00-00-00", 5, "b.2000-01-05-00-00-00.delta.tar"),
+            ("2000-01-04-00-00-00", 4, "b.2000-01-04-00-00-00.tar"),
+            ("2000-01-03-00-00-00", 3, "b.2000-01-03-00-00-00.delta.tar"),
+            ("2000-01-02-00-00-00", 2, "b.2000-01-02-00-00-00.delta.tar"),
+            ("2000-01-01-00-00-00", 1, "b.2000-01-01-00-00-00.tar"),
+            ("1999-12-31-00-00-00", 0, "b.1999-12-31-00-00-00.delta.tar"),
+        ]
+        index = BackupIndex.from_backups(backups)
+        by_mod_time = BackupIndex.from_backups(backups, by_mod_time=True)
+        self.assertEqual(len(index), 6)
+        self.assertEqual(
+            index.find("2000-01-03"),
+            ["b.2000-01-01-00-00-00.tar", "b.2000-01-02-00-00-00.delta.tar"],
+        )
+        self.assertEqual(
+            index.find(),
+            ["b.2000-01-04-00-00-00.tar", "b.2000-01-05-00-00-00.delta.tar"],
+        )
+        self.assertEqual(index.find("1999"), [])
+        self.assertEqual(index.find("2000"), ["b.1999-12-31-00-00-00.delta.tar"])
+        self.assertIsNone(index.find_full("2000"))
+        # The result is the same as with a linear search.
+        for key in range(-1, 7):
+            self.assertEqual(
+                by_mod_time.find(key),
+                find_conditional_backups_to_restore(
+                    backups, lambda num, mod_time, path: mod_time <= key
+                ),
+            )
+        # Modification times that are not in the same order as the
+        # numbers cannot be used.
+        backups[0] = backups[0][0], 0, backups[0][2]
+        self.assertIsNone(BackupIndex.from_backups(backups, by_mod_time=True))
+
+    def test_many_backups(self):
+        # Hourly backups, with a full backup each day, kept for years.
+        from collective.recipe.backup import compression
+        from collective.recipe.backup.copyblobs import combine_backups
+        from collective.recipe.backup.copyblobs import first_number_key
+        from collective.recipe.backup.copyblobs import get_backup_name_parser
+        from datetime import datetime
+        from datetime import timedelta
+
+        start = datetime(2010, 1, 1)
+        names = []
+        for hour in range(100000):
+            stamp = (start + timedelta(hours=hour)).strftime("%Y-%m-%d-%H-%M-%S")
+            if hour % 24:
+                names.append(f"blobs.{stamp}.delta.tar.gz")
+            else:
+                names.append(f"blobs.{stamp}.tar.gz")
+                names.append(f"blobs.{stamp}.snar")
+        suffixes = compression.archive_suffixes(delta=True) + ["snar"]
+        parse = get_backup_name_parser(suffixes=suffixes)
+        backups = []
+        for mod_time, filename in enumerate(names):
+            name = parse(filename)
+            backups.append((name.number, mod_time, "/backups/" + filename))
+        backups.sort(key=first_number_key, reverse=True)
+        combined = combine_backups(backups)
+        self.assertEqual(len(combined), 100000 // 24 + 1)
+        self.assertEqual(len(combined[-1]), 25)
+        self.assertEqual(len(combined[0]), 100000 % 24 + 1)
+
+
+class BlobTreeTestCase(unittest.TestCase):
+    """Test the code in blobtree.py."""
+
+    def test_is_blob_file(self):
+        from collective.recipe.backup.blobtree import is_blob_file
+
+        self.assertTrue(is_blob_file("0x03c6f1a2b7d8e977.blob"))
+        self.assertTrue(is_blob_file("0x01.blob"))
+        self.assertFalse(is_blob_file(".layout"))
+        self.assertFalse(is_blob_file("0x03c6f1a2b7d8e977.blob.tmp"))
+        self.assertFalse(is_blob_file("0x03C6F1A2B7D8E977.blob"))
+        self.assertFalse(is_blob_file("one.txt"))
+        self.assertFalse(is_blob_file("0x.blob"))
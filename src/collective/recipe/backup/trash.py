@@ -0,0 +1,168 @@
+"""Deferred removal of large directory trees.
+
+Removing a blob backup with millions of hard links can take a long time.
+Instead of waiting for that, we can atomically rename the tree into a
+``.trash`` directory next to it, and let a detached process with low
+priority remove it.  The backup or restore command can then finish
+right away.
+
+The worker is this module, run as a script::
+
+    python -m collective.recipe.backup.trash path/to/.trash
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+logger = logging.getLogger("trash")
+TRASH_DIR = ".trash"
+
+
+def get_trash_dir(path):
+    """Get the trash directory for this path.
+
+    This is a sibling of the path, so it is on the same file system,
+    and we can rename the path into it.
+    """
+    path = os.path.abspath(path.rstrip(os.sep))
+    return os.path.join(os.path.dirname(path), TRASH_DIR)
+
+
+def move_to_trash(path):
+    """Move path into the trash directory next to it.
+
+    Returns the trash directory.  Each path gets its own unique
+    subdirectory in the trash, so trashing the same name twice is fine.
+    """
+    trash_dir = get_trash_dir(path)
+    if not os.path.isdir(trash_dir):
+        os.makedirs(trash_dir)
+    name = os.path.basename(path.rstrip(os.sep))
+    holder = tempfile.mkdtemp(prefix=name + ".", dir=trash_dir)
+    try:
+        os.rename(path, os.path.join(holder, name))
+    except OSError:
+        os.rmdir(holder)
+        raise
+    return trash_dir
+
+
+def empty_trash(trash_dir):
+    """Remove everything from the trash directory, and the directory itself.
+
+    Errors are ignored: another worker may be emptying the same trash.
+    """
+    if not os.path.isdir(trash_dir):
+        return
+    for name in os.listdir(trash_dir):
+        path = os.path.join(trash_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    try:
+        os.rmdir(trash_dir)
+    except OSError:
+        # Not empty: something new was trashed in the meantime.
+        # The worker for that will remove it.
+        pass
+
+
+def lower_priority():
+    """Lower the cpu priority of the current process as much as possible."""
+    if not hasattr(os, "nice"):
+        return
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+
+
+def start_worker(*trash_dirs):
+    """Start a detached process that empties the trash directories.
+
+    We do not wait for it.  When the ``ionice`` command is available,
+    the worker runs in the idle I/O scheduling class.
+    """
+    command = [sys.executable, "-m", __name__] + list(trash_dirs)
+    ionice = shutil.which("ionice")
+    if ionice:
+        command = [ionice, "-c", "3"] + command
+    env = os.environ.copy()
+    # The generated scripts set sys.path to find our eggs.
+    env["PYTHONPATH"] = os.pathsep.join(p for p in sys.path if p)
+    kwargs = {}
+    if sys.platform.startswith("win"):
+        kwargs["creationflags"] = getattr(subprocess, "DETACHED_PROCESS", 0)
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            env=env,
+            **kwargs,
+        )
+    except OSError as e:
+        logger.warning("Could not start background removal: %s", e)
+        return False
+    return True
+
+
+def remove_tree(path, deferred=False):
+    """Remove a directory tree.
+
+    With deferred=False this is shutil.rmtree.  Otherwise we move the tree
+    to the trash and start a worker to remove it in the background.
+    When moving fails, we remove the tree directly after all.
+    """
+    remove_trees([path], deferred=deferred)
+
+
+def remove_trees(paths, deferred=False):
+    """Remove several directory trees.
+
+    Like remove_tree, but with deferred=True we first move all trees to
+    the trash, and then start one worker for all of them, so we do not
+    have several processes removing files on the same disk.
+    """
+    if not deferred:
+        for path in paths:
+            shutil.rmtree(path)
+        return
+    trash_dirs = []
+    for path in paths:
+        try:
+            trash_dir = move_to_trash(path)
+        except OSError as e:
+            logger.warning("Could not move %s to trash (%s), removing it now.", path, e)
+            shutil.rmtree(path)
+            continue
+        logger.debug("Moved %s to %s.", path, trash_dir)
+        if trash_dir not in trash_dirs:
+            trash_dirs.append(trash_dir)
+    if trash_dirs and not start_worker(*trash_dirs):
+        for trash_dir in trash_dirs:
+            empty_trash(trash_dir)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    lower_priority()
+    for trash_dir in args:
+        empty_trash(trash_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 # Small utility methods.
+from collections import deque
 from collective.recipe.backup import config
 
 import logging
 import os
+import shlex
 import shutil
 import subprocess
 import sys
+import threading
+import time
 
 try:
     from builtins import input as raw_input
@@ -27,28 +31,129 @@ except NameError:
     stringtypes = str
 
 
-def system(command, input=""):
-    """commands.getoutput() replacement that also works on windows
+# How many lines of output of a command we remember.
+MAX_OUTPUT_LINES = 100
+# Longer lines are split.
+MAX_LINE_LENGTH = 8192
+# Lines of commands that run at the same time should not get mixed.
+_output_lock = threading.Lock()
+
 
-    This was copied from zest.releaser.
+class CommandResult:
+    """Result of running a command.
+
+    output has the last lines of combined stdout and stderr, as bytes.
+    wall_time is in seconds.  rusage is the resource usage of the
+    command, as returned by os.wait4, or None when not available.
     """
-    p = subprocess.Popen(
+
+    __slots__ = ("command", "returncode", "output", "wall_time", "rusage")
+
+    def __init__(self, command, returncode, output=b"", wall_time=0.0, rusage=None):
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+        self.wall_time = wall_time
+        self.rusage = rusage
+
+    def __repr__(self):
+        return "<CommandResult returncode={} wall_time={:.2f}>".format(
+            self.returncode, self.wall_time
+        )
+
+
+def run(command, shell=False, echo=True, input=None, max_lines=MAX_OUTPUT_LINES):
+    """Run a command, streaming its output.
+
+    command is a list of arguments.  A string is split like a shell
+    would, but without using a shell, unless shell is True.  That is
+    only needed for commands from the user, like pre_command.
+
+    stderr is combined with stdout and read line by line, so the command
+    can never block on a full pipe.  With echo=True each line is written
+    to our stdout.  We only remember the last max_lines lines.
+
+    Returns a CommandResult.
+    """
+    if isinstance(command, str) and not shell:
+        command = shlex.split(command)
+    start = time.monotonic()
+    try:
+        p = subprocess.Popen(
+            command,
+            shell=shell,
+            stdin=subprocess.PIPE if input else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=MUST_CLOSE_FDS,
+        )
+    except OSError as e:
+        # Like a shell, report this and return exit code 127.
+        program = command if isinstance(command, str) else command[0]
+        message = f"{program}: {e.strerror}\n"
+        if echo:
+            with _output_lock:
+                sys.stdout.write(message)
+                sys.stdout.flush()
+        return CommandResult(command, 127, output=message.encode())
+    if input:
+        if isinstance(input, str):
+            input = input.encode()
+        try:
+            p.stdin.write(input)
+        except BrokenPipeError:
+            pass
+        p.stdin.close()
+    tail = deque(maxlen=max_lines)
+    for line in iter(lambda: p.stdout.readline(MAX_LINE_LENGTH), b""):
+        tail.append(line)
+        if echo:
+            with _output_lock:
+                sys.stdout.write(line.decode(errors="replace"))
+                sys.stdout.flush()
+    p.stdout.close()
+    rusage = None
+    if hasattr(os, "wait4"):
+        pid, status, rusage = os.wait4(p.pid, 0)
+        # Tell Popen that the process is gone.
+        p.returncode = os.waitstatus_to_exitcode(status)
+    else:
+        p.wait()
+    result = CommandResult(
         command,
-        shell=True,
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        close_fds=MUST_CLOSE_FDS,
+        p.returncode,
+        output=b"".join(tail),
+        wall_time=time.monotonic() - start,
+        rusage=rusage,
     )
-    i, o, e = (p.stdin, p.stdout, p.stderr)
-    if input:
-        i.write(input)
-    i.close()
-    result = o.read() + e.read()
-    o.close()
-    e.close()
+    if rusage is not None:
+        logger.debug(
+            "Command exited with %d after %.2f seconds "
+            "(user %.2f, system %.2f, max rss %d).",
+            result.returncode,
+            result.wall_time,
+            rusage.ru_utime,
+            rusage.ru_stime,
+            rusage.ru_maxrss,
+        )
+    else:
+        logger.debug(
+            "Command exited with %d after %.2f seconds.",
+            result.returncode,
+            result.wall_time,
+        )
+    return result
+
+
+def system(command, input=""):
+    """commands.getoutput() replacement that also works on windows
+
+    Runs the command in a shell, and returns the last lines of output
+    and the exit code.  New code should use run.
+    """
+    result = run(command, shell=True, echo=False, input=input)
     # Return the result plus a return value (0: all is fine)
-    return result, p.wait()
+    return result.output, result.returncode
 
 
 def ask(question, default=True, exact=False):
@@ -94,11 +199,10 @@ def ask(question, default=True, exact=False):
 def execute_or_fail(command):
     if not command:
         return
-    output, failed = system(command)
+    # This is a command from the user, so it may use shell features.
+    result = run(command, shell=True)
     logger.debug("command executed: %r", command)
-    if output:
-        print(output)
-    if failed:
+    if result.returncode:
         logger.error("command %r failed. See message above.", command)
         sys.exit(1)
 
@@ -200,8 +304,18 @@ def try_create_folder(pathdir):
 def get_date_from_args():
     # Try to find a date in the command line arguments
     date = None
+    skip_next = False
     for arg in sys.argv:
-        if arg in ("-q", "-n", "--quiet", "--no-prompt"):
+        if skip_next:
+            skip_next = False
+            continue
+        if arg in ("-q", "-n", "--quiet", "--no-prompt", "--rebuild-catalog"):
+            continue
+        if arg == "--blob-path":
+            # The next argument is the path.
+            skip_next = True
+            continue
+        if arg.startswith("--blob-path="):
             continue
         if arg.find("restore") != -1:
             continue